@@ -0,0 +1,184 @@
+#! /usr/bin/python3
+
+# Benchmark for create_vm.py and create_vswitch.py.
+# Runs the scripts against the fake vCenter (fake_vcenter.py) and
+# reports for every scenario the number of round-trips (API calls
+# that would be SOAP requests against a real vCenter), the wall-clock
+# time and the peak memory. Round-trips do not depend on the machine,
+# so comparing them to a saved baseline catches regressions such as
+# an extra lookup per VM. WaitForUpdatesEx calls are counted apart
+# (waits), how often a task is polled depends on timing.
+#
+# Usage:
+#   python3 bench.py [--vms=N] [--hosts=N] [--latency=S] [--json]
+#                    [--save=baseline.json] [--compare=baseline.json]
+#
+# --compare exits with status 1 when a scenario needs more round-trips
+# than in the baseline.
+
+import os
+os.environ['VMWARE_SCRIPTS_SESSION'] = '' # no session file, inventory cache or journal, every run starts cold
+os.environ['VMWARE_SCRIPTS_CACHE'] = ''
+os.environ['VMWARE_SCRIPTS_JOURNAL'] = ''
+
+import io
+import sys
+import csv
+import json
+import time
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import connection
+import fake_vcenter
+import create_vm
+import create_vswitch
+
+def run_script(module, argv):
+    """
+        Run main() of a script with the given arguments,
+        the output of the script is kept in a buffer.
+    """
+    saved = sys.argv
+    sys.argv = [module.__name__ + '.py'] + argv
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            module.main()
+    except SystemExit: # the scripts exit on bad input, the output says why
+        pass
+    finally:
+        sys.argv = saved
+    return output.getvalue()
+
+def measure(name, endpoint, module, argv):
+    """
+        Run one scenario against a new fake vCenter and
+        collect round-trips, wall-clock time and peak memory.
+    """
+    connection.HOST = endpoint
+    del fake_vcenter.INSTANCES[:]
+    tracemalloc.start()
+    start = time.time()
+    output = run_script(module, argv)
+    seconds = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    calls = {}
+    for fake in fake_vcenter.INSTANCES:
+        for call, count in fake.calls.items():
+            calls[call] = calls.get(call, 0) + count
+    waits = calls.get('PropertyCollector.WaitForUpdatesEx', 0)
+    return {
+        'scenario': name,
+        'round_trips': sum(calls.values()) - waits,
+        'waits': waits,
+        'seconds': round(seconds, 3),
+        'peak_kb': peak // 1024,
+        'calls': calls,
+        'output': output
+    }
+
+def write_manifest(path, vms):
+    """
+        Manifest with vms new VMs for the batch scenario.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['name', 'port_group', 'cpu', 'ram', 'disk', 'provision'])
+        for i in range(vms):
+            writer.writerow(['bench{:04d}'.format(i + 1), 'VM Network', 2, 4, 20, 'thin'])
+
+def run_benchmarks(vms=50, hosts=16, latency=0.0):
+    """
+        Run every scenario and return a list of results.
+    """
+    endpoint = 'fake://?clusters=2&hosts={}&vms=200&latency={}&task_seconds=0.01'
+    vswitch_endpoint = 'fake://?clusters=1&hosts={}&vms=20&latency={}&task_seconds=0.01'
+    results = []
+    results.append(measure('single-vm', endpoint.format(4, latency), create_vm,
+                           ['bench-vm', 'VM Network', '2', '4', '20', 'thin']))
+    directory = tempfile.mkdtemp()
+    manifest = os.path.join(directory, 'bench.csv')
+    write_manifest(manifest, vms)
+    results.append(measure('batch-vm ({} VMs)'.format(vms), endpoint.format(4, latency), create_vm,
+                           ['--batch', manifest, '10']))
+    os.remove(manifest)
+    os.rmdir(directory)
+    results.append(measure('vswitch ({} hosts)'.format(hosts), vswitch_endpoint.format(hosts, latency), create_vswitch,
+                           ['Cluster1', 'vSwitchBench', '1600', '128', 'BenchPG', '100']))
+    results.append(measure('vswitch-reconcile ({} hosts)'.format(hosts), vswitch_endpoint.format(hosts, latency), create_vswitch,
+                           ['--reconcile', 'Cluster1', 'vSwitchBench', '1600', '128', 'BenchPG', '100']))
+    results.append(measure('vswitch-dvs ({} hosts)'.format(hosts), vswitch_endpoint.format(hosts, latency), create_vswitch,
+                           ['--dvs', 'Cluster1', 'DSwitchBench', '1600', '128', 'BenchPG', '100', 'vmnic1']))
+    return results
+
+def compare(results, baseline):
+    """
+        Compare round-trips with a baseline.
+        Returns the list of scenarios that got worse.
+    """
+    before = dict((result['scenario'], result) for result in baseline)
+    worse = []
+    for result in results:
+        old = before.get(result['scenario'])
+        if old is not None and result['round_trips'] > old['round_trips']:
+            worse.append((result['scenario'], old['round_trips'], result['round_trips']))
+    return worse
+
+def print_results(results, baseline=None):
+    """
+        Print a table with one row per scenario.
+    """
+    before = dict((result['scenario'], result) for result in baseline or [])
+    print('Scenario'.ljust(30) + 'Round-trips'.ljust(14) + 'Waits'.ljust(8) + 'Seconds'.ljust(10) + 'Peak memory')
+    for result in results:
+        trips = '{}'.format(result['round_trips'])
+        if result['scenario'] in before:
+            trips += ' ({:+d})'.format(result['round_trips'] - before[result['scenario']]['round_trips'])
+        print(' {}'.format(result['scenario']).ljust(30, '.') + trips.ljust(14, '.') + '{}'.format(result['waits']).ljust(8, '.') +
+              '{:.2f}'.format(result['seconds']).ljust(10, '.') + '{}KB'.format(result['peak_kb']))
+
+def main():
+    options = {'--vms': '50', '--hosts': '16', '--latency': '0', '--save': None, '--compare': None}
+    try:
+        for arg in sys.argv[1:]:
+            key, value = arg.split('=', 1) if '=' in arg else (arg, None)
+            if key == '--json':
+                continue
+            if key not in options or value is None:
+                raise NameError('Unknown argument: {}'.format(arg))
+            options[key] = value
+        vms = int(options['--vms'])
+        hosts = int(options['--hosts'])
+        latency = float(options['--latency'])
+    except (NameError, ValueError) as err:
+        print('{}\nUsage:\n python3 bench.py [--vms=N] [--hosts=N] [--latency=S] [--json] [--save=file] [--compare=file]'.format(err))
+        sys.exit(2)
+
+    results = run_benchmarks(vms, hosts, latency)
+    for result in results:
+        del result['output']
+
+    baseline = None
+    if options['--compare'] is not None:
+        with open(options['--compare']) as f:
+            baseline = json.load(f)
+    if options['--save'] is not None:
+        with open(options['--save'], 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if '--json' in sys.argv:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_results(results, baseline)
+
+    if baseline is not None:
+        worse = compare(results, baseline)
+        for scenario, old, new in worse:
+            print('REGRESSION: {} needs {} round-trips, was {}'.format(scenario, new, old))
+        if worse:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
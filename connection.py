@@ -0,0 +1,297 @@
+#! /usr/bin/python3
+
+# Shared connection handling for create_vm.py and create_vswitch.py.
+# Logging in is one of the slowest calls and vCenter only allows a
+# limited number of sessions, so the session cookie is saved to disk
+# and the next run reuses the session when it is still alive instead
+# of logging in again. Inside one process several worker threads can
+# borrow their own ServiceInstance (own HTTP connection, same session)
+# from a pool.
+#
+# Set VMWARE_SCRIPTS_SESSION to an empty value to turn off session
+# reuse, the session is then logged out when the script exits.
+#
+# The vCenter is read from VMWARE_HOST, which has to be set. The user
+# and password come from VMWARE_USER and VMWARE_PASSWORD and are asked
+# for when they are not set. A host starting with fake:// connects to
+# the in-process stand-in in fake_vcenter.py instead, e.g.
+# VMWARE_HOST='fake://?hosts=8&vms=500'.
+#
+# With VMWARE_SCRIPTS_PROFILE set every connection is instrumented,
+# see profiling.py.
+
+import os
+import ssl
+import sys
+import json
+import queue
+import atexit
+import getpass
+import threading
+from contextlib import contextmanager
+from pyVim.connect import SmartConnect, Disconnect
+from pyVmomi import vim, vmodl, SoapStubAdapter
+from profiling import PROFILE, instrument
+
+HOST = os.environ.get('VMWARE_HOST', '')
+USER = os.environ.get('VMWARE_USER', '')
+PASSWORD = os.environ.get('VMWARE_PASSWORD', '')
+
+SESSION_FILE = os.environ.get('VMWARE_SCRIPTS_SESSION', os.path.join(os.path.expanduser('~'), '.vmware-scripts', 'session.json'))
+
+services = {} # (host, session cookie) -> ServiceContent, see service
+services_lock = threading.Lock()
+
+def is_fake(host):
+    """
+        True when the endpoint is the fake vCenter.
+    """
+    return host.startswith('fake:')
+
+def unverified_context():
+    """
+        SSL context that does not check the certificate,
+        used when the vCenter certificate is not trusted.
+    """
+    cert = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    cert.check_hostname = False
+    cert.verify_mode = ssl.CERT_NONE # bypass SSL errors, whoops...
+    return cert
+
+def credential(value, prompt, secret=False):
+    """
+        A value from the environment, asked for
+        when it is not set. Secrets are not echoed.
+    """
+    if value:
+        return value
+    if secret == True:
+        return getpass.getpass(prompt)
+    return input(prompt)
+
+def session_alive(connection):
+    """
+        Check if the session behind a connection is still
+        logged in. currentSession is None when it is not.
+    """
+    try:
+        return connection.content.sessionManager.currentSession is not None
+    except (vmodl.MethodFault, OSError):
+        return False
+
+def save_session(connection, verified):
+    """
+        Save what is needed to reuse the session: the
+        cookie, the API version and if the certificate
+        was valid. Only readable by the current user.
+    """
+    if not SESSION_FILE:
+        return
+    directory = os.path.dirname(SESSION_FILE)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    descriptor = os.open(SESSION_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(descriptor, 'w') as f:
+        json.dump({'host': HOST, 'user': USER, 'version': connection._stub.version,
+                   'cookie': connection._stub.cookie, 'verified': verified}, f)
+
+def load_session():
+    """
+        Reconnect to the session saved by a previous run.
+        Returns (1 or 2, connection) like connect(), or
+        None when there is no session that can be reused.
+    """
+    if not SESSION_FILE or not os.path.isfile(SESSION_FILE):
+        return None
+    try:
+        with open(SESSION_FILE) as f:
+            saved = json.load(f)
+    except ValueError:
+        return None
+    if saved.get('host') != HOST or saved.get('user') != USER:
+        return None
+
+    if is_fake(HOST): # a fake only lives as long as its process
+        import fake_vcenter
+        connection = fake_vcenter.session(saved['cookie'])
+        if connection is None:
+            return None
+    else:
+        connection = new_service_instance(saved['version'], saved['cookie'], saved['verified'])
+    if session_alive(connection) == False:
+        return None
+    if saved['verified'] == True:
+        return (1, connection)
+    return (2, connection)
+
+def new_service_instance(version, cookie, verified):
+    """
+        Create a ServiceInstance with its own HTTP
+        connection that uses an existing session.
+    """
+    if verified == True:
+        stub = SoapStubAdapter(host=HOST, version=version)
+    else:
+        stub = SoapStubAdapter(host=HOST, version=version, sslContext=unverified_context())
+    stub.cookie = cookie # this is what makes it the same session
+    connection = vim.ServiceInstance('ServiceInstance', stub)
+    if PROFILE:
+        instrument(connection)
+    return connection
+
+def release(connection):
+    """
+        Release the session when the script is done.
+        A saved session is kept alive on purpose so the
+        next run can use it, without session reuse the
+        session is logged out so it does not linger on
+        vCenter until it times out.
+    """
+    if SESSION_FILE:
+        return
+    try:
+        Disconnect(connection)
+    except Exception: # already logged out or vCenter is gone, nothing left to release
+        pass
+
+def connect():
+    """
+        Create a connection to a VMware host.
+        0. Reuse the session from the last run if it is alive.
+        1. First attempt with a valid cert.
+        2. If no valid cert, then try without cert
+        and notify this to the user.
+        3. If this does not work then an exception is raised
+        and notify the user.
+
+        Returns a tuple: (1, connection), (2, connection) or (3, error)
+    """
+    global USER, PASSWORD
+    if not HOST:
+        return (3, NameError('VMWARE_HOST is not set, e.g. export VMWARE_HOST=vcenter.example.com'))
+    if is_fake(HOST): # no login, no session to save or release
+        import fake_vcenter
+        result = (1, fake_vcenter.connect(HOST))
+        if PROFILE:
+            instrument(result[1])
+        return result
+    try:
+        USER = credential(USER, 'vCenter user: ') # the saved session belongs to a user, so it is needed first
+        reused = load_session()
+        if reused is not None:
+            result = reused
+        else:
+            PASSWORD = credential(PASSWORD, 'Password for {}: '.format(USER), True)
+            try: # Try to connect with default SSL options
+                result = (1, SmartConnect(host=HOST, user=USER, pwd=PASSWORD))
+            except ssl.SSLError: # By pass SSL errors if any are given
+                result = (2, SmartConnect(host=HOST, user=USER, pwd=PASSWORD, sslContext=unverified_context()))
+            save_session(result[1], result[0] == 1)
+    except Exception as err:
+        return (3, err)
+
+    if PROFILE:
+        instrument(result[1])
+    atexit.register(release, result[1]) # always give the session back, also when the script calls sys.exit()
+    return result
+
+def connect_or_exit():
+    """
+        Connect (see connect) and tell the user how it
+        went, for the main() of a script. Exits when
+        there is no connection.
+
+        Returns the connection.
+    """
+    print('Attempting to connect...')
+    c = connect()
+    if c[0] == 3:
+        print('Something went wrong: {}'.format(c[1])) # the second index contains the raised exception
+        sys.exit()
+    if c[0] == 2:
+        print('WARNING: Invalid certificate.\nSuccessfully connected anyways because magic.')
+    else:
+        print('Success')
+    return c[1]
+
+def create_pool(connection, size):
+    """
+        Create a pool of ServiceInstances for worker threads.
+        They all use the session of connection (no extra
+        logins), but each has its own HTTP connection so
+        the workers do not wait for each other.
+    """
+    stub = connection._stub
+    if is_fake(HOST): # the fake stub is thread-safe, all workers can share it
+        pool = queue.Queue()
+        for i in range(size):
+            pool.put(connection)
+        return pool
+    context = getattr(stub, 'schemeArgs', {}).get('context')
+    verified = context is None or context.verify_mode != ssl.CERT_NONE
+    pool = queue.Queue()
+    for i in range(size):
+        pool.put(new_service_instance(stub.version, stub.cookie, verified))
+    return pool
+
+def rebind(obj, connection):
+    """
+        The same managed object, but calls go through the
+        HTTP connection of another ServiceInstance.
+    """
+    return type(obj)(obj._moId, connection._stub)
+
+def close_pool(pool):
+    """
+        Close the HTTP connections of a pool when the
+        workers are done. The ServiceInstances share the
+        session of the main connection, so they are not
+        logged out: that would end the session for the
+        main connection as well (see release).
+    """
+    while True:
+        try:
+            connection = pool.get_nowait()
+        except queue.Empty:
+            return
+        if is_fake(HOST) == False:
+            connection._stub.DropConnections()
+
+def service_content(connection):
+    """
+        The ServiceContent of a connection. Reading
+        connection.content is a request of its own, so it
+        is read once per session and shared by every
+        connection of that session (the pool connections).
+    """
+    key = (HOST, connection._stub.cookie)
+    with services_lock:
+        content = services.get(key)
+    if content is None:
+        content = connection.content
+        with services_lock:
+            services[key] = content
+    return content
+
+def service(connection, name):
+    """
+        A managed object of the ServiceContent, e.g.
+        'propertyCollector', 'taskManager' or 'rootFolder',
+        bound to connection. The morefs differ between
+        vCenter and ESXi, so they are never hard-coded.
+    """
+    return rebind(getattr(service_content(connection), name), connection)
+
+@contextmanager
+def borrow(pool):
+    """
+        Borrow a ServiceInstance from a pool:
+
+            with borrow(pool) as connection:
+                ...
+    """
+    connection = pool.get()
+    try:
+        yield connection
+    finally:
+        pool.put(connection)
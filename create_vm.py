@@ -8,77 +8,74 @@
 #   Email:  b15benko@student.his.se
 #-------------------------------
 
-# Usage: python3 create_vm.py <VM name> <port group> <CPU's> <Memory allocation GB> <Disk Space GB>
+# Usage: python3 create_vm.py <VM name> <port group> <CPU's> <Memory allocation GB> <Disk Space GB[,GB...]> <thin/thick> <OPTIONAL: --two-step>
+#        python3 create_vm.py --batch <manifest.csv|.jsonl|.yaml> <OPTIONAL: max in-flight tasks>
+#        add --clone=<template> (and optionally --linked) to clone a template instead of creating an empty VM
+#        python3 create_vm.py --resume <OPTIONAL: journal> (finish a batch that was interrupted, see journal.py)
 
 import pyVmomi
 import sys
-import ssl
-from pyVim.connect import SmartConnect, Disconnect
+import csv
+import copy
+import json
+from concurrent.futures import ThreadPoolExecutor
 from pyVmomi import vim, vmodl
-from time import sleep
-
-def select_network(datacenter, net_name):
+from connection import connect, create_pool, close_pool, borrow, rebind
+from tasks import wait_for_task, start_monitor, stop_monitor
+from events import emit, start_progress, stop_progress, setup_events
+from journal import start_journal, stop_journal, load_journal, latest_journal, item_done
+from inventory_cache import cached_inventory
+from inventory import find, get, names, retrieve_properties
+from placement import new_placement, place, release
+
+def select_network(snapshot, net_name):
     """
         Convert the user network name input from
         string to API method. this is important
         for the NIC creation when a VM is created.
+        Standard port groups and distributed port
+        groups are both networks.
+        Returns None if there is no such network.
     """
-    for i in datacenter.network:
-        if i.name == net_name:
-            return i
+    return find(snapshot, vim.Network, net_name)
 
-def vm_name_check(vm_folder, vm_name):
+def select_port(snapshot, network):
     """
-        Check if the vm_name given by the
-        user already exists.
+        The switch port connection of a distributed port
+        group (the uuid of its switch and its key), read
+        from the snapshot. None for a standard network.
     """
-    vms = [vm.name for vm in vm_folder.childEntity]
-    if vm_name in vms:
-        return False
-    else:
-        return True
+    if not isinstance(network, vim.dvs.DistributedVirtualPortgroup):
+        return None
+    dvs = get(snapshot, network, 'config.distributedVirtualSwitch')
+    return vim.dvs.PortConnection(switchUuid=get(snapshot, dvs, 'uuid'), portgroupKey=get(snapshot, network, 'key'))
 
-def memory_check(datacenter, RAM):
+def nic_backing(net_name, network_name, port=None):
     """
-        Check if the RAM given by
-        the user is less than the
-        maximum available memory
-        in the cluster.
-
-        According to API: effectiveMemory = Effective memory resources (in MB) available to run virtual machines. 
-        This is the aggregated effective resource level from all running hosts. 
-        Hosts that are in maintenance mode or are unresponsive are not counted. 
-        Resources used by the VMware Service Console are not included in the aggregate. 
-        This value represents the amount of resources available for the root resource pool for running virtual machines.
+        Backing of a NIC: a distributed port group needs
+        a DistributedVirtualPortBackingInfo with the switch
+        port connection (see select_port, read from vCenter
+        when it is not given), a standard network is
+        connected by name.
     """
-    available_mem = datacenter.hostFolder.childEntity[0].summary.effectiveMemory
-    if RAM < available_mem:
-        return True # enough free memory
-    else:
-        return False # not enough free memory
-
-def cpu_check(datacenter, CPU):
+    if isinstance(net_name, vim.dvs.DistributedVirtualPortgroup):
+        if port is None:
+            port = vim.dvs.PortConnection(switchUuid=net_name.config.distributedVirtualSwitch.uuid, portgroupKey=net_name.key)
+        return vim.vm.device.VirtualEthernetCard.DistributedVirtualPortBackingInfo(port=port)
+    backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo()
+    backing.network = net_name # Associate an existing network with the device description
+    backing.deviceName = network_name # set the device name to the physical or logical network the nic is connected to.
+    return backing
+
+def vm_name_check(snapshot, vm_name):
     """
-        Check if the CPU given by
-        the user is less than the
-        maximum CPU cores
-        in the cluster.
-
-        According to API: numCpuCores = Number of physical CPU cores. Physical CPU cores are the processors contained by a CPU package.
+        Check if the vm_name given by the
+        user already exists.
     """
-    available_cpu = datacenter.hostFolder.childEntity[0].summary.numCpuCores
-    if CPU < available_cpu:
-        return True # enough free memory
+    if vm_name in names(snapshot, vim.VirtualMachine):
+        return False
     else:
-        return False # not enough free memory
-
-def datastore_space_check(datacenter, disk):
-    nfs_store = [datastore for datastore in datacenter.hostFolder.childEntity[0].datastore if datastore.name == 'NFS_share'][0]
-    free_space = nfs_store.summary.freeSpace // 1024  # this converted to KB since it comes as bytes from the API
-    if disk < free_space:
         return True
-    else:
-        return False
 
 def convert_gb_to_mb(RAM):
     """
@@ -94,6 +91,23 @@ def convert_gb_to_kb(disk):
     """
     return int(disk) * (1024 * 1024)
 
+def parse_disks(disks):
+    """
+        Disk sizes can be given as one number or
+        as a comma separated list ("20,50") when
+        the VM needs more than one disk.
+        Returns a list of sizes in KB.
+    """
+    if isinstance(disks, (list, tuple)):
+        sizes = [str(size).strip() for size in disks]
+    else:
+        sizes = [size.strip() for size in str(disks).split(',')]
+    if len(sizes) == 0 or False in [size.isdigit() for size in sizes]:
+        raise NameError('\nDisk size must be numerical')
+    if len(sizes) > 15: # 16 units on the controller, 7 is reserved for the controller itself
+        raise NameError('\nA VM can have at most 15 disks on one controller')
+    return [convert_gb_to_kb(size) for size in sizes]
+
 def convert_kb_to_gb(disk):
     """
         used to preserve the original input
@@ -106,34 +120,32 @@ def mb_to_gb(RAM):
     """
     return int(RAM) // 1024 
 
-def connect():
-    """
-        Create a connection to a VMware host.
-        1. First attempt with a valid cert.
-        2. If no valid cert, then try without cert
-        and notify this to the user.
-        3. If this does not work then an exception is raised
-        and notify the user.
-    """
-    cert = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-    cert.verify_mode = ssl.CERT_NONE # ignore SSL
-
-    try:
-        try:
-            connection = SmartConnect(host="10.207.3.10", user="administrator@b15benko.nsa.his.se", pwd='Syp9393!!') 
-            return (1, connection)
-        except ssl.SSLError:
-            connection = SmartConnect(host="10.207.3.10", user="administrator@b15benko.nsa.his.se", pwd='Syp9393!!', sslContext=cert) 
-            return (2, connection)
-    except Exception as err: 
-        return (3, err)
-
-def create_vm(vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision):
+def create_vm(connection, vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision, two_step=False,
+              network_name=None, datastore_name=None, port=None):
     """
         Create a VM with following configurations: CPU, memory, disk
         RAM and attached network/switch
+
+        disk is a size in KB or a list of sizes in KB.
+        All devices (NIC, controller and disks) are sent
+        in one ConfigSpec, so a VM needs a single task.
+        With two_step=True the VM is created without disks
+        and the disks are added afterwards (old behaviour).
+        network_name and datastore_name come from the
+        snapshot, without them both names are read from
+        vCenter (one request each). port is the switch
+        port connection of a distributed port group, see
+        select_port.
+
+        Returns a list with the tracked result of every
+        task that was needed: (step, result) where result
+        comes from tasks.wait_for_task.
     """
-    new_datastore = '[' + datastore.name + '] ' + vm_name # This creates a new directory with the same naming scheme as the new VM
+    if network_name is None:
+        network_name = net_name.name
+    if datastore_name is None:
+        datastore_name = datastore.name
+    new_datastore = '[' + datastore_name + '] ' + vm_name # This creates a new directory with the same naming scheme as the new VM
     vm_config = vim.vm.ConfigSpec()
     """ 
         Create a custom nic specification...
@@ -149,9 +161,7 @@ def create_vm(vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM,
     nic_edit.operation = vim.vm.device.VirtualDeviceSpec.Operation.add # tell the API that we want to create a new device
     nic_edit.device = nic_type # create a device specikation with the nic_edit name
     nic_edit.device.deviceInfo = vim.Description() # Initialize methods to set info for the NIC
-    nic_edit.device.backing = vim.vm.device.VirtualEthernetCard.NetworkBackingInfo() # Add backing information to the device specification
-    nic_edit.device.backing.network = net_name # Associate an existing network with the device description
-    nic_edit.device.backing.deviceName = net_name.name # set the device name to the physical or logical network the nic is connected to.
+    nic_edit.device.backing = nic_backing(net_name, network_name, port) # Add backing information to the device specification
     device_config.append(nic_edit)
 
 
@@ -163,13 +173,19 @@ def create_vm(vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM,
     scsi_ctl.device.deviceInfo = vim.Description()
     scsi_ctl.device.slotInfo = vim.vm.device.VirtualDevice.PciBusSlotInfo()
     scsi_ctl.device.slotInfo.pciSlotNumber = 16
-    scsi_ctl.device.key = 22 # random number
+    scsi_ctl.device.key = -100 # temporary key, vCenter replaces it with a real one
     scsi_ctl.device.sharedBus = vim.vm.device.VirtualSCSIController.sharedBus = 'noSharing'
     scsi_ctl.device.busNumber = 0
     scsi_ctl.device.device = 0
     scsi_ctl.device.scsiCtlrUnitNumber = 7
     device_config.append(scsi_ctl)
 
+    disks = disk if isinstance(disk, list) else [disk]
+    if two_step == False:
+        # Add the disks to the same spec, they point at the controller through its temporary key
+        for index, (unit_number, disk_kb) in enumerate(zip(free_unit_numbers(), disks)):
+            device_config.append(build_disk_spec(disk_kb, provision, scsi_ctl.device.key, unit_number, key=-101 - index))
+
     vm_config.numCPUs = CPU
     vm_config.name = vm_name
     vm_config.memoryMB = RAM
@@ -180,30 +196,40 @@ def create_vm(vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM,
     vm_files.vmPathName = new_datastore
     vm_config.files = vm_files
     
-    print('\nCreating VM without disk...')
-    vm_folder.CreateVM_Task(config=vm_config, pool=resource_pool)
-    add_disk_to_vm(vm_folder, vm_name, disk, provision, datastore)
-    return True
-
-def add_disk_to_vm(vm_folder, vm_name, disk, provision, datastore):
-    device_config = []
-    sleep(5)
-    print('\nAdding disk now...')
-    # Create virtualdisk
-    spec = vim.vm.ConfigSpec()
-    vm = [dev for dev in vm_folder.childEntity if dev.name==vm_name][0]
-    for dev in vm.config.hardware.device:
-        if dev.unitNumber:
-            unit_number = int(dev.unitNumber) + 1
-            # unit_number 7 reserved for scsi controller
-            if unit_number == 7:
-                unit_number += 1
-        if isinstance(dev, vim.vm.device.VirtualLsiLogicController):
-            controller = dev
+    if two_step == False:
+        print('\nCreating VM...')
+    else:
+        print('\nCreating VM without disk...')
+    created = wait_for_task(connection, vm_folder.CreateVM_Task(config=vm_config, pool=resource_pool), name=vm_name, step='create')
+    if created['state'] != 'success':
+        raise NameError('\nCreating VM {} failed: {}'.format(vm_name, created['error']))
+    steps = [('create', created)]
+    if two_step == False:
+        return steps
+
+    vm = created['result'] # the finished task hands us the new VM directly, no need to look it up again
+    for number, disk_kb in enumerate(disks):
+        disk_added = wait_for_task(connection, add_disk_to_vm(vm, disk_kb, provision), name=vm_name, step='disk {}'.format(number + 1))
+        if disk_added['state'] != 'success':
+            raise NameError('\nAdding disk to VM {} failed: {}'.format(vm_name, disk_added['error']))
+        steps.append(('add disk', disk_added))
+    return steps
+
+def free_unit_numbers():
+    """
+        Unit numbers a disk can use on a
+        new SCSI controller, 7 is reserved
+        for the controller itself.
+    """
+    return [unit for unit in range(16) if unit != 7]
 
-    # add disk here
-    dev_changes = []
-    new_disk_kb = int(disk)
+def build_disk_spec(disk, provision, controller_key, unit_number, key=None):
+    """
+        Create the device specification for a new
+        virtual disk of disk KB on the given controller.
+        key is only needed when the controller and disk
+        are created in the same ConfigSpec.
+    """
     disk_spec = vim.vm.device.VirtualDeviceSpec()
     disk_spec.fileOperation = "create"
     disk_spec.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
@@ -213,14 +239,550 @@ def add_disk_to_vm(vm_folder, vm_name, disk, provision, datastore):
     if provision == 'thin':
         disk_spec.device.backing.thinProvisioned = True
     disk_spec.device.backing.diskMode = 'persistent'
+    if key is not None:
+        disk_spec.device.key = key
     disk_spec.device.unitNumber = unit_number
-    disk_spec.device.capacityInKB = new_disk_kb
-    disk_spec.device.controllerKey = controller.key
-    dev_changes.append(disk_spec)
-    spec.deviceChange = dev_changes
-    vm.ReconfigVM_Task(spec=spec)
+    disk_spec.device.capacityInKB = int(disk)
+    disk_spec.device.controllerKey = controller_key
+    return disk_spec
+
+def add_disk_to_vm(vm, disk, provision):
+    """
+        Add a new disk to an existing VM, on the first
+        free unit of its SCSI controller.
+        Returns the ReconfigVM_Task so the caller
+        can wait for it.
+    """
+    print('\nAdding disk now...')
+    devices = vm.config.hardware.device
+    controllers = [dev for dev in devices if isinstance(dev, vim.vm.device.VirtualSCSIController)]
+    if not controllers:
+        raise NameError('\nVM {} has no SCSI controller for the disk'.format(vm.name))
+    controller = controllers[0]
+    used = set(dev.unitNumber for dev in devices if getattr(dev, 'controllerKey', None) == controller.key)
+    free_units = [unit for unit in free_unit_numbers() if unit not in used] # unit 7 is the controller itself
+    if not free_units:
+        raise NameError('\nNo free unit left on the SCSI controller of VM {}'.format(vm.name))
+
+    # add disk here
+    spec = vim.vm.ConfigSpec()
+    spec.deviceChange = [build_disk_spec(disk, provision, controller.key, free_units[0])]
+    return vm.ReconfigVM_Task(spec=spec)
+
+def template_details(connection, template):
+    """
+        Read the devices and the current snapshot of a
+        template with one request. The result is shared
+        by every clone of the template in a batch.
+    """
+    props = retrieve_properties(connection, [template], vim.VirtualMachine,
+                                ['config.hardware.device', 'snapshot.currentSnapshot']).get(template, {})
+    devices = props.get('config.hardware.device', [])
+    return {
+        'template': template,
+        'devices': devices,
+        'snapshot': props.get('snapshot.currentSnapshot'),
+        'disk': sum(dev.capacityInKB for dev in devices if isinstance(dev, vim.vm.device.VirtualDisk)) # KB
+    }
+
+def clone_vm(connection, template, vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision, linked=False,
+             network_name=None, port=None):
+    """
+        Create a VM as a clone of a template (see template_details)
+        instead of an empty VM that still needs an OS install.
+        The NIC is moved to the chosen port group, CPU and RAM
+        are set and the disks are grown in the same CloneSpec,
+        so a clone is a single task.
+
+        disk is a list of sizes in KB: the first one is the new
+        size of the first template disk (0 or smaller keeps the
+        template size), the others are added as new disks.
+        With linked=True the clone shares the disks of the
+        template snapshot and only stores its own changes.
+        network_name and port (see select_port) come from
+        the snapshot, without them they are read from vCenter.
+
+        Returns a list with the tracked result of the clone task.
+    """
+    disks = disk if isinstance(disk, list) else [disk]
+    device_config = []
+    if network_name is None:
+        network_name = net_name.name
+
+    nics = [dev for dev in template['devices'] if isinstance(dev, vim.vm.device.VirtualEthernetCard)]
+    nic_edit = vim.vm.device.VirtualDeviceSpec()
+    if nics: # reconnect the NIC of the template to the chosen port group
+        nic_edit.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+        nic_edit.device = copy.deepcopy(nics[0]) # the template devices are shared by the whole batch
+    else: # template without NIC, add one like create_vm does
+        nic_edit.operation = vim.vm.device.VirtualDeviceSpec.Operation.add
+        nic_edit.device = vim.vm.device.VirtualE1000()
+        nic_edit.device.deviceInfo = vim.Description()
+    nic_edit.device.backing = nic_backing(net_name, network_name, port)
+    device_config.append(nic_edit)
+
+    template_disks = [dev for dev in template['devices'] if isinstance(dev, vim.vm.device.VirtualDisk)]
+    if disks and template_disks and disks[0] > template_disks[0].capacityInKB: # grow the first disk (not for linked clones, see clone_disk_errors)
+        disk_edit = vim.vm.device.VirtualDeviceSpec()
+        disk_edit.operation = vim.vm.device.VirtualDeviceSpec.Operation.edit
+        disk_edit.device = copy.deepcopy(template_disks[0])
+        disk_edit.device.capacityInKB = disks[0]
+        device_config.append(disk_edit)
+
+    if len(disks) > 1: # extra disks go on the controller of the template
+        controller = [dev for dev in template['devices'] if isinstance(dev, vim.vm.device.VirtualSCSIController)][0]
+        used = set(dev.unitNumber for dev in template['devices'] if getattr(dev, 'controllerKey', None) == controller.key)
+        free_units = [unit for unit in free_unit_numbers() if unit not in used]
+        for index, (unit_number, disk_kb) in enumerate(zip(free_units, disks[1:])):
+            device_config.append(build_disk_spec(disk_kb, provision, controller.key, unit_number, key=-101 - index))
+
+    clone_spec = vim.vm.CloneSpec()
+    clone_spec.location = vim.vm.RelocateSpec(pool=resource_pool, datastore=datastore)
+    if linked == True:
+        if template['snapshot'] is None:
+            raise NameError('\nTemplate for VM {} has no snapshot, a linked clone needs one'.format(vm_name))
+        clone_spec.snapshot = template['snapshot']
+        clone_spec.location.diskMoveType = 'createNewChildDiskBacking' # share the disks of the snapshot
+    clone_spec.config = vim.vm.ConfigSpec(numCPUs=CPU, memoryMB=RAM, deviceChange=device_config)
+    clone_spec.powerOn = False
+    clone_spec.template = False
+
+    if linked == True:
+        print('\nCreating linked clone...')
+    else:
+        print('\nCreating clone...')
+    cloned = wait_for_task(connection, template['template'].CloneVM_Task(folder=vm_folder, name=vm_name, spec=clone_spec), name=vm_name, step='clone')
+    if cloned['state'] != 'success':
+        raise NameError('\nCloning VM {} failed: {}'.format(vm_name, cloned['error']))
+    return [('clone', cloned)]
+
+def clone_disk_errors(template, disk, linked):
+    """
+        Check the disks of a clone against its template
+        before anything is created: the disk of a linked
+        clone cannot be grown, extra disks need a free
+        unit on the SCSI controller of the template.
+
+        Returns a list of errors.
+    """
+    errors = []
+    template_disks = [dev for dev in template['devices'] if isinstance(dev, vim.vm.device.VirtualDisk)]
+    if linked == True and disk and template_disks and disk[0] > template_disks[0].capacityInKB:
+        errors.append('the disk of a linked clone cannot be grown, use a full clone')
+    if len(disk) > 1:
+        controllers = [dev for dev in template['devices'] if isinstance(dev, vim.vm.device.VirtualSCSIController)]
+        if not controllers:
+            errors.append('template has no SCSI controller for the extra disks')
+        else:
+            used = set(dev.unitNumber for dev in template['devices'] if getattr(dev, 'controllerKey', None) == controllers[0].key)
+            if len(disk) - 1 > len([unit for unit in free_unit_numbers() if unit not in used]):
+                errors.append('not enough free units on the SCSI controller of the template for {} extra disk(s)'.format(len(disk) - 1))
+    return errors
+
+def clone_disk_need(template, disk, linked):
+    """
+        Space (KB) a clone will take on its datastore, used
+        for placement. A linked clone only needs its new
+        disks, a full clone copies the template disks.
+    """
+    extra = sum(disk[1:])
+    if linked == True:
+        return extra
+    return max(disk[0] if disk else 0, template['disk']) + extra
+
+def load_manifest(path):
+    """
+        Read a manifest of VM specifications from
+        a CSV, JSONL or YAML file. Every entry must
+        contain: name, port_group, cpu, ram (GB),
+        disk (GB) and provision (thin/thick).
+
+        Returns a list of dictionaries, one per VM.
+    """
+    if path.endswith('.csv'):
+        with open(path, newline='') as f:
+            specs = [dict(row) for row in csv.DictReader(f)]
+    elif path.endswith('.jsonl'):
+        with open(path) as f:
+            specs = [json.loads(line) for line in f if line.strip()]
+    elif path.endswith('.yaml') or path.endswith('.yml'):
+        try:
+            import yaml # only needed for YAML manifests
+        except ImportError:
+            raise NameError('\nPyYAML is required to read YAML manifests (pip install pyyaml).')
+        with open(path) as f:
+            specs = yaml.safe_load(f) or []
+    else:
+        raise NameError('\nUnknown manifest format: {} (use .csv, .jsonl or .yaml)'.format(path))
+    return specs
+
+def validate_batch(snapshot, specs, connection=None, template=None, linked=False, planned_networks=()):
+    """
+        Validate every VM specification in the manifest
+        against a single inventory snapshot and choose
+        where every VM goes (see placement.place).
+        Every check is run for every VM, so all problems
+        of a batch are reported at once instead of the
+        first one only.
+
+        A VM is cloned when its spec has a "template" (or
+        when template is given for the whole batch), "linked"
+        makes it a linked clone. The details of every template
+        are read only once (needs connection).
+
+        planned_networks are port groups that do not exist
+        yet but will be created before the VMs (see
+        preflight.py), their specs get no network object.
+
+        Returns a tuple: (list of valid VM specs, list of (name, error))
+        The valid specs have their values converted to
+        the units the API expects (MB for RAM, KB for disk).
+    """
+    valid = []
+    errors = []
+    seen = set()
+    placement = new_placement(snapshot) # tracks what the VMs before this one will use
+    templates = {} # template name -> template_details
+    for spec in specs:
+        vm_name = str(spec.get('name', '')).strip()
+        problems = []
+        if vm_name == '':
+            problems.append('VM name is missing')
+        elif vm_name_check(snapshot, vm_name) == False:
+            problems.append('VM with the name "{}" already exists'.format(vm_name))
+        elif vm_name in seen:
+            problems.append('VM name "{}" is used more than once in the manifest'.format(vm_name))
+        seen.add(vm_name) # also when this copy fails for another reason, the next copy is still a duplicate
+
+        port_group = str(spec.get('port_group', ''))
+        network = select_network(snapshot, port_group)
+        if network is None and port_group not in planned_networks:
+            problems.append('port group "{}" does not exist'.format(port_group))
+
+        CPU = str(spec.get('cpu', ''))
+        if CPU.isdigit() == False:
+            problems.append('CPU value must be numerical')
+            CPU = None
+        else:
+            CPU = int(CPU)
+
+        RAM = str(spec.get('ram', ''))
+        if RAM.isdigit() == False:
+            problems.append('RAM size must be numerical')
+            RAM = None
+        else:
+            RAM = convert_gb_to_mb(RAM)
+
+        template_name = spec.get('template') or template
+        clone_linked = str(spec.get('linked', linked)).lower() in ('true', '1', 'yes')
+        disk = [] # a clone keeps the disks of its template
+        if not template_name or spec.get('disk') not in (None, ''):
+            try:
+                disk = parse_disks(spec.get('disk', ''))
+            except NameError as err:
+                problems.append(str(err).strip())
+                disk = None
+
+        provision = str(spec.get('provision', 'thin'))
+        if provision != 'thin' and provision != 'thick':
+            problems.append('provision can only be "thin" or "thick"')
+
+        details = None
+        needed = sum(disk or [])
+        if template_name:
+            if template_name not in templates:
+                source = find(snapshot, vim.VirtualMachine, template_name)
+                templates[template_name] = template_details(connection, source) if source is not None else None
+            details = templates[template_name]
+            if details is None:
+                problems.append('template "{}" does not exist'.format(template_name))
+            elif clone_linked == True and details['snapshot'] is None:
+                problems.append('template "{}" has no snapshot, a linked clone needs one'.format(template_name))
+            elif disk is not None:
+                problems.extend(clone_disk_errors(details, disk, clone_linked))
+                needed = clone_disk_need(details, disk, clone_linked)
+
+        target = None
+        if CPU is not None and RAM is not None and disk is not None and (details is not None or not template_name):
+            target = place(placement, CPU, RAM, needed, network)
+            if target is None:
+                problems.append('No cluster with port group "{}" and enough CPU, memory and datastore space'.format(port_group))
+        if problems:
+            if target is not None:
+                release(placement, target, RAM, needed) # the VM is not created, its room goes back to the rest of the batch
+            for problem in problems:
+                errors.append((vm_name or '<unnamed>', problem))
+                emit('validation', name=vm_name or '<unnamed>', state='invalid', error=problem)
+            continue
+
+        emit('validation', name=vm_name, state='valid', cluster=get(snapshot, target['cluster'], 'name'), datastore=get(snapshot, target['datastore'], 'name'))
+        valid.append({
+            'name': vm_name,
+            'network': network,
+            'network_name': port_group,
+            'port': select_port(snapshot, network),
+            'datastore_name': get(snapshot, target['datastore'], 'name'),
+            'cpu': CPU,
+            'ram': RAM,
+            'disk': disk,
+            'provision': provision,
+            'placement': target,
+            'template': details,
+            'linked': clone_linked
+        })
+    return valid, errors
+
+def format_timings(steps):
+    """
+        Turn the task results returned by create_vm
+        into a short text, e.g. "create 2.1s, add disk 0.8s"
+    """
+    timings = []
+    for step, result in steps:
+        if result['seconds'] is None:
+            timings.append('{} ?s'.format(step))
+        else:
+            timings.append('{} {:.1f}s'.format(step, result['seconds']))
+    return ', '.join(timings)
+
+def provision_vm(connection, spec, two_step=False):
+    """
+        Create (or clone) one VM from a spec returned by
+        validate_batch. The objects in the spec may come
+        from another connection, they are rebound so the
+        calls go through this one.
+
+        Returns the steps, see create_vm and clone_vm.
+    """
+    target = spec['placement']
+    if spec['template'] is not None:
+        template = dict(spec['template'], template=rebind(spec['template']['template'], connection))
+        return clone_vm(connection, template, rebind(target['vm_folder'], connection), rebind(target['resource_pool'], connection),
+                        rebind(target['datastore'], connection), rebind(spec['network'], connection), spec['name'],
+                        spec['cpu'], spec['ram'], spec['disk'], spec['provision'], spec['linked'], spec['network_name'], spec['port'])
+    return create_vm(connection, rebind(target['vm_folder'], connection), rebind(target['resource_pool'], connection),
+                     rebind(target['datastore'], connection), rebind(spec['network'], connection), spec['name'],
+                     spec['cpu'], spec['ram'], spec['disk'], spec['provision'], two_step,
+                     spec['network_name'], spec['datastore_name'], spec['port'])
+
+def vm_steps(spec, two_step=False):
+    """
+        The tasks provision_vm runs for a spec from
+        validate_batch, in order. The VM is complete when
+        the last one succeeded.
+    """
+    if spec['template'] is not None:
+        return ['clone']
+    if two_step == True:
+        return ['create'] + ['disk {}'.format(number + 1) for number in range(len(spec['disk']))]
+    return ['create']
+
+def provision_batch(connection, specs, max_in_flight=10, two_step=False):
+    """
+        Create all VMs in the batch concurrently. The calls
+        are I/O-bound (most of the time is spent waiting on
+        vCenter) so a bounded pool of worker threads is
+        enough, max_in_flight limits how many VMs are
+        being created at the same time. Every VM goes
+        where validate_batch placed it. All tasks are
+        watched by one task monitor (see tasks.start_monitor)
+        and the progress of the batch is reported as events.
+
+        Returns a list of (name, status) tuples in manifest order.
+    """
+    pool = create_pool(connection, max_in_flight) # same session, one HTTP connection per worker
+
+    def worker(spec):
+        with borrow(pool) as own:
+            try:
+                steps = provision_vm(own, spec, two_step)
+            except Exception as err: # one failed VM should not stop the rest of the batch
+                emit('item_completed', name=spec['name'], state='error', error=str(err).strip())
+                return (spec['name'], 'failed: {}'.format(err))
+            emit('item_completed', name=spec['name'], state='success', vm=steps[0][1]['result']._moId,
+                 seconds=sum(result['seconds'] or 0 for step, result in steps))
+            return (spec['name'], 'created ({})'.format(format_timings(steps)))
+
+    start_monitor(connection)
+    start_progress('Creating VMs', len(specs))
+    try:
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor: # not "pool", that is the session pool the workers borrow from
+            return list(executor.map(worker, specs))
+    finally:
+        stop_progress()
+        stop_monitor()
+        close_pool(pool)
+
+def print_batch_results(results):
+    """
+        Print a per-VM result table.
+    """
+    print('\nBatch results:')
+    for name, status in results:
+        print(' {}'.format(name).ljust(30, '.') + '{}'.format(status))
+
+def batch_main(connection, two_step=False, template=None, linked=False):
+    """
+        Batch mode: create every VM listed in a manifest
+        using a single connection and a single inventory
+        snapshot.
+    """
+    try:
+        if len(sys.argv) < 3:
+            raise IndexError
+        specs = load_manifest(sys.argv[2])
+
+        max_in_flight = sys.argv[3] if len(sys.argv) > 3 else '10'
+        if max_in_flight.isdigit() == False or int(max_in_flight) < 1:
+            raise NameError('\nMax in-flight tasks must be a number larger than 0')
+        max_in_flight = int(max_in_flight)
+    except IndexError as err:
+        print('\nMissing paramters - Usage:\n python3 create_vm.py --batch <manifest.csv|.jsonl|.yaml> <OPTIONAL: max in-flight tasks>')
+        sys.exit()
+    except (NameError, OSError, ValueError) as err:
+        print(err)
+        sys.exit()
+
+    snapshot = cached_inventory(connection) # one request (or only the changes since the last run) for everything the checks below need
+
+    print('\nValidating {} VM(s) from {}...'.format(len(specs), sys.argv[2]))
+    valid, errors = validate_batch(snapshot, specs, connection, template, linked)
+    for name, err in errors:
+        print(' {}'.format(name).ljust(30, '.') + 'invalid: {}'.format(err))
+
+    manifest = dict((str(spec.get('name', '')).strip(), spec) for spec in specs)
+    path = start_journal('create_vm', {'manifest': sys.argv[2], 'two_step': two_step, 'template': template, 'linked': linked,
+                                       'max_in_flight': max_in_flight},
+                         dict((spec['name'], manifest[spec['name']]) for spec in valid),
+                         steps=dict((spec['name'], vm_steps(spec, two_step)) for spec in valid))
+    if path is not None:
+        print('\nJournal: {} (python3 create_vm.py --resume {} continues an interrupted run)'.format(path, path))
+
+    print('\nCreating {} VM(s), {} at a time...'.format(len(valid), max_in_flight))
+    try:
+        results = provision_batch(connection, valid, max_in_flight, two_step)
+    finally:
+        stop_journal()
+    print_batch_results([(name, 'invalid: {}'.format(err)) for name, err in errors] + results)
+    print('\nDone.')
+
+def reattach(connection, name, item):
+    """
+        Wait for the last task of a VM of an interrupted run
+        if vCenter still knows it. Its outcome goes to the
+        journal like that of any other task.
+
+        Returns the state of the task ('success', 'error'),
+        None when vCenter no longer knows the task.
+    """
+    try:
+        return wait_for_task(connection, rebind(vim.Task(item['task']), connection), name=name, step=item['step'])['state']
+    except vmodl.fault.ManagedObjectNotFound: # tasks are only kept for a while, the outcome is unknown
+        return None
+
+def finish_vm(connection, vm, name, item):
+    """
+        Add the disks of a two-step VM of an interrupted
+        run that have no success record in the journal
+        yet (its "disk N" steps), in order.
+
+        Returns the task results like create_vm, raises
+        NameError when a disk cannot be added.
+    """
+    disks = parse_disks(item['spec'].get('disk', ''))
+    provision = str(item['spec'].get('provision', 'thin'))
+    steps = []
+    for step in item['steps']:
+        if step in item['completed'] or step.startswith('disk ') == False:
+            continue
+        disk_added = wait_for_task(connection, add_disk_to_vm(vm, disks[int(step.split()[1]) - 1], provision), name=name, step=step)
+        if disk_added['state'] != 'success':
+            raise NameError('\nAdding disk to VM {} failed: {}'.format(name, disk_added['error']))
+        item['completed'].append(step)
+        steps.append(('add disk', disk_added))
+    return steps
+
+def resume_main(connection):
+    """
+        Resume a batch from its journal. A VM is only
+        done when the last of its steps (create, clone or
+        its last disk) has a success record. Tasks that were
+        still running are waited for. VMs that do not exist
+        are validated and created again. A VM that was
+        created but misses disks gets the rest of them (see
+        finish_vm). Any other VM that exists but is not done
+        is reported, it is never counted as created. The
+        journal is continued, so a resume can be resumed as
+        well.
+    """
+    path = sys.argv[2] if len(sys.argv) > 2 else latest_journal('create_vm')
+    try:
+        if path is None:
+            raise NameError('\nNo journal found, give the path of one: python3 create_vm.py --resume <journal>')
+        state = load_journal(path)
+        if state['script'] != 'create_vm':
+            raise NameError('\n{} is not a journal of create_vm.py'.format(path))
+    except (NameError, OSError) as err:
+        print(err)
+        sys.exit()
+    run = state['run']
+    items = state['items']
+
+    done = [name for name, item in items.items() if item_done(item)]
+    in_flight = [name for name, item in items.items() if name not in done and item['task'] is not None
+                 and item['state'] is None and item['step'] not in item['completed']] # the last task has no outcome yet
+    print('\nResuming {}: {} VM(s) done, {} in flight, {} to check.'.format(path, len(done), len(in_flight),
+                                                                           len(items) - len(done) - len(in_flight)))
+    start_journal('create_vm', run, {}, path)
+    try:
+        results = [(name, 'already created') for name in done]
+        for name in in_flight:
+            print('Waiting for task {} ({} of {})...'.format(items[name]['task'], items[name]['step'], name))
+            outcome = reattach(connection, name, items[name])
+            if outcome == 'success':
+                items[name]['completed'].append(items[name]['step'])
+            elif outcome is not None:
+                items[name]['state'] = 'error'
+            if item_done(items[name]):
+                emit('item_completed', name=name, state='success')
+                results.append((name, 'created (task re-attached)'))
+
+        snapshot = cached_inventory(connection) # after the waits, VMs their tasks created are in it
+        retry = []
+        for name, item in items.items():
+            if name in done or item_done(item):
+                continue
+            if vm_name_check(snapshot, name) == False and 'create' in item['completed']:
+                vm = find(snapshot, vim.VirtualMachine, name) # created, only (some of) its disks are missing
+                try:
+                    steps = finish_vm(connection, vm, name, item)
+                except NameError as err:
+                    emit('item_completed', name=name, state='error', error=str(err).strip())
+                    results.append((name, 'failed: {}'.format(err)))
+                    continue
+                emit('item_completed', name=name, state='success', vm=vm._moId,
+                     seconds=sum(result['seconds'] or 0 for step, result in steps))
+                results.append((name, 'created (finished: {})'.format(format_timings(steps))))
+            elif vm_name_check(snapshot, name) == False: # half built: its first step failed or its outcome is unknown
+                finished = ', '.join(item['completed']) or 'none'
+                err = 'incomplete: the VM exists but not all steps finished (finished: {}), check it or remove it (teardown.py) and resume again'.format(finished)
+                emit('item_completed', name=name, state='error', error=err)
+                results.append((name, err))
+            else:
+                retry.append(item['spec'])
+
+        valid, errors = validate_batch(snapshot, retry, connection, run['template'], run['linked'])
+        for name, err in errors:
+            emit('item_completed', name=name, state='error', error=err)
+        print('\nCreating {} VM(s), {} at a time...'.format(len(valid), run['max_in_flight']))
+        results += provision_batch(connection, valid, run['max_in_flight'], run['two_step'])
+    finally:
+        stop_journal()
+    print_batch_results(results + [(name, 'invalid: {}'.format(err)) for name, err in errors])
+    print('\nDone.')
 
 def main():
+    setup_events() # with the events on stdout the output below goes to stderr
     print('Attempting to connect...')
     c = connect() # returns a tuple: (1, connection) or (2, error_msg) or (3, connection)
     if c[0] == 1:
@@ -233,74 +795,75 @@ def main():
         print('Something went wrong: {}'.format(c[1])) # the second index contains the raised exception
         sys.exit()
 
-    inventory = connection.RetrieveContent()
-    datacenter = inventory.rootFolder.childEntity[0] # first datacenter (the only one)
-    vm_folder = datacenter.vmFolder # This folder is used to place the VM in
-    resource_pool = datacenter.hostFolder.childEntity[0].resourcePool # the resource pool of the first and only cluster
-    datastore = datacenter.hostFolder.childEntity[0].datastore[0] # NFS_share (indexing can be different when more datastores are added)
-
-    try:
-        if len(sys.argv) < 6:
-            raise IndexError
-
-        vm_name = sys.argv[1]
-        if vm_name_check(vm_folder, vm_name) == False:
-            raise NameError('\nVM with the name "{}" already exists.'.format(vm_name))
-
-        port_group = sys.argv[2] # create a checker that looks for exisitng port groups
-
-        CPU = sys.argv[3]
-        if CPU.isdigit() == False:
-            raise NameError('\nCPU value must be numerical')
-            sys.exit()
-        elif CPU.isdigit() == True:
-            CPU = int(CPU)
-            if cpu_check(datacenter, CPU) == False:
-                raise NameError('\nNo sufficient CPU cores in cluster...')
-                    
-        RAM = sys.argv[4] # in megabytes. Must implement a GB to MB converter!
-        if RAM.isdigit() == True:
-            RAM = convert_gb_to_mb(RAM)
-            if memory_check(datacenter, RAM) == False:
-                raise NameError('\nNo sufficient memory in cluster...')
-        elif RAM.isdigit() == False:
-            raise NameError('\nRAM size must be numerical')
-            sys.exit()
-
-        disk = sys.argv[5] # must be numberical
-        if disk.isdigit() == False:
-            raise NameError('\nDisk size must be numerical')
-            sys.exit()
-        elif disk.isdigit() == True:
-            disk = convert_gb_to_kb(disk)
-            if datastore_space_check(datacenter, disk) == False:
-                raise NameError('\nNo sufficient space in datastore...')
-        
-        provision = sys.argv[6]
-        if provision == 'thin' or provision == 'thick':
-            pass
-        else:
-            raise NameError('\nCan only be the "thin" or "thick". It determines if thin provisioning should be used or not')
-
-    except IndexError as err:
-        print('\nMissing paramters - Usage:\n python3 create_vm.py <VM name> <port group> <CPU\s> <Memory allocation: GB> <Disk Space: GB> <Thin provisioning: true/false>')
+    two_step = '--two-step' in sys.argv # optional flag: create the VM first and add the disks afterwards
+    if two_step == True:
+        sys.argv.remove('--two-step')
+    template_name = None # optional flag --clone=<template>: clone a template instead of creating an empty VM
+    linked = '--linked' in sys.argv # optional flag: make a linked clone off the current snapshot of the template
+    for arg in list(sys.argv):
+        if arg.startswith('--clone='):
+            sys.argv.remove(arg)
+            template_name = arg.split('=', 1)[1]
+        elif arg == '--linked':
+            sys.argv.remove(arg)
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+        batch_main(connection, two_step, template_name, linked)
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == '--resume':
+        resume_main(connection)
+        return
+
+    snapshot = cached_inventory(connection) # one request (or only the changes since the last run) for everything the checks below need
+
+    if len(sys.argv) < 7:
+        print('\nMissing paramters - Usage:\n python3 create_vm.py <VM name> <port group> <CPU\s> <Memory allocation: GB> <Disk Space: GB[,GB...]> <Thin provisioning: thin/thick> <OPTIONAL: --two-step> <OPTIONAL: --clone=<template> [--linked]>')
         sys.exit()
-    except NameError as err:
-        print(err)
+
+    # every argument is checked against the snapshot in one pass, all problems are reported at once
+    spec = {'name': sys.argv[1], 'port_group': sys.argv[2], 'cpu': sys.argv[3], 'ram': sys.argv[4], 'disk': sys.argv[5], 'provision': sys.argv[6]}
+    valid, errors = validate_batch(snapshot, [spec], connection, template_name, linked)
+    if errors:
+        for name, err in errors:
+            print('\n{}'.format(err))
         sys.exit()
+    spec = valid[0]
+    vm_name = spec['name']
+    port_group = spec['network_name']
+    CPU = spec['cpu']
+    RAM = spec['ram']
+    disk = spec['disk']
+    provision = spec['provision']
+    template = spec['template']
+    target = spec['placement']
+    vm_folder = target['vm_folder'] # This folder is used to place the VM in
+    resource_pool = target['resource_pool']
+    datastore = target['datastore']
 
     print('\nAttempting to create Virtual machine with following settings:')
-    #print(' Cluster'.ljust(20, '.') + '{}'.format(cluster_name))
+    print(' Cluster'.ljust(20, '.') + '{}'.format(get(snapshot, target['cluster'], 'name')))
+    print(' Datastore'.ljust(20, '.') + '{}'.format(get(snapshot, datastore, 'name')))
     print(' Name'.ljust(20, '.') + '{}'.format(vm_name))
     print(' Port Group'.ljust(20, '.') + '{}'.format(port_group))
     print(' CPUs'.ljust(20, '.') + '{}'.format(CPU))
     print(' Memory'.ljust(20, '.') + '{}GB'.format(mb_to_gb(RAM)))
-    print(' Disk'.ljust(20, '.') + '{}GB'.format(convert_kb_to_gb(disk)))
+    print(' Disk'.ljust(20, '.') + ', '.join(['{}GB'.format(convert_kb_to_gb(size)) for size in disk]))
     print(' Provision'.ljust(20, '.') + '{}'.format(provision))
+    if template is not None:
+        print(' Template'.ljust(20, '.') + '{}{}'.format(template_name, ' (linked clone)' if linked == True else ''))
 
-    net_name  = select_network(datacenter, port_group)
-    if create_vm(vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision) == True:
-        print('\nVM {} successfully created.\nDone.'.format(vm_name))
+    net_name  = spec['network']
+    try:
+        if template is not None:
+            steps = clone_vm(connection, template, vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision, linked,
+                             port_group, spec['port'])
+        else:
+            steps = create_vm(connection, vm_folder, resource_pool, datastore, net_name, vm_name, CPU, RAM, disk, provision, two_step,
+                              port_group, get(snapshot, datastore, 'name'), spec['port'])
+    except NameError as err:
+        print(err)
+        sys.exit()
+    print('\nVM {} successfully created ({}).\nDone.'.format(vm_name, format_timings(steps)))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -10,23 +10,82 @@
 
 import pyVmomi
 import sys
-import ssl
-from pyVim.connect import SmartConnect, Disconnect
+import json
+import copy
+from concurrent.futures import ThreadPoolExecutor
 from pyVmomi import vim, vmodl
+from connection import connect, create_pool, close_pool, borrow, rebind
+from inventory_cache import cached_inventory
+from inventory import find, get, retrieve_properties
+from events import emit, start_progress, stop_progress, setup_events
+from tasks import wait_for_task
+from journal import start_journal, stop_journal, load_journal, latest_journal, item_done
+from placement import datacenter_of
+
+def host_network_systems(snapshot, cluster):
+    """
+        The network system of every host in the
+        cluster, read from the inventory snapshot
+        instead of asking every host for it.
+    """
+    return [(get(snapshot, node, 'name'), get(snapshot, node, 'configManager.networkSystem')) for node in get(snapshot, cluster, 'host', [])]
+
+def switch_spec(num_port, MTU, nic_name=None):
+    """
+        Create the specification of a vSwitch,
+        nic_name is the optional physical NIC.
+    """
+    sw_spec = vim.host.VirtualSwitch.Specification() # create a template-ish object
+    sw_spec.numPorts = int(num_port)
+    if nic_name is not None: # See if the optional parameter is given (Physical NIC)
+        sw_spec.bridge = vim.host.VirtualSwitch.BondBridge(nicDevice=[nic_name])
+    sw_spec.mtu = int(MTU)
+    return sw_spec
+
+def port_group_spec(port_group_name, switch_name, VID):
+    """
+        Create the specification of a port group
+        with a VLAN, attached to a vSwitch.
+    """
+    pg_spec = vim.host.PortGroup.Specification() # Create a specification tree (Looks like JSON)
+    pg_spec.name = port_group_name # assign a name to the specs
+    pg_spec.vswitchName = switch_name # assign a vSwitch to portgroup
+    pg_spec.vlanId = int(VID) # assign a VID
+
+    security_policy = vim.host.NetworkPolicy.SecurityPolicy() # set standard security policies
+    security_policy.allowPromiscuous = True 
+    security_policy.forgedTransmits = True
+    security_policy.macChanges = False
+    pg_spec.policy = vim.host.NetworkPolicy(security=security_policy)
+    return pg_spec
+
+def teaming_order(nic_order, uplinks):
+    """
+        Teaming order of a vSwitch whose uplinks change:
+        NICs that stay keep their place (active or standby),
+        new NICs are added as active and removed NICs are
+        dropped. At least one NIC stays active.
+    """
+    active = [nic for nic in getattr(nic_order, 'activeNic', None) or [] if nic in uplinks]
+    standby = [nic for nic in getattr(nic_order, 'standbyNic', None) or [] if nic in uplinks]
+    active += [nic for nic in uplinks if nic not in active and nic not in standby]
+    if not active: # every active NIC was removed, a standby one takes over
+        active, standby = standby[:1], standby[1:]
+    return vim.host.NetworkPolicy.NicOrderPolicy(activeNic=active, standbyNic=standby)
 
 def create_switch(*args):
     """
         Create a virtual switch for a host.
-        The arguments are given in order from line 170-178
+        The arguments are given in order: list of
+        (host name, network system) as returned by
+        host_network_systems, switch name, number of
+        ports, MTU, optional physical NIC.
     """
-    for node in args[0].host: # iterate through all hosts in cluster
-        network_system = node.configManager.networkSystem
-
-        sw_spec = vim.host.VirtualSwitch.Specification() # create a template-ish object
-        sw_spec.numPorts = int(args[2])
+    for host_name, network_system in args[0]: # iterate through all hosts in cluster
         if len(args) == 5: # See if the optional parameter is given (Physical NIC)
-            sw_spec.bridge = vim.host.VirtualSwitch.BondBridge(nicDevice=[args[4]])
-        sw_spec.mtu = int(args[3])
+            sw_spec = switch_spec(args[2], args[3], args[4])
+        else:
+            sw_spec = switch_spec(args[2], args[3])
         network_system.AddVirtualSwitch(vswitchName=args[1], spec=sw_spec)
     return True
 
@@ -39,43 +98,689 @@ def create_port_group(*args):
         they are given in a specific order.
 
     """
-    for node in args[0].host: # iterate through all hosts in cluster
-        network_system = node.configManager.networkSystem
+    for host_name, network_system in args[0]: # iterate through all hosts in cluster
+        network_system.AddPortGroup(portgrp=port_group_spec(args[1], args[2], args[3])) # Create the portgroup with the new specifications
+    return True
 
-        port_group_spec = vim.host.PortGroup.Specification() # Create a specification tree (Looks like JSON)
-        port_group_spec.name = args[1] # assign a name to the specs
-        port_group_spec.vswitchName = args[2] # assign a vSwitch to portgroup
-        port_group_spec.vlanId = args[3] # assign a VID
+def rollout(connection, network_systems, switch_name, num_port, MTU, port_group_name, VID, nic_name=None, fan_out=8):
+    """
+        Create the vSwitch and the port group on all
+        hosts at the same time, fan_out hosts at once.
+        Every host adds its port group as soon as its own
+        switch is done, it does not wait for the others.
+        A failing host does not stop the other hosts.
 
-        security_policy = vim.host.NetworkPolicy.SecurityPolicy() # set standard security policies
-        security_policy.allowPromiscuous = True 
-        security_policy.forgedTransmits = True
-        security_policy.macChanges = False
-        port_group_spec.policy = vim.host.NetworkPolicy(security=security_policy)
-        
-        network_system.AddPortGroup(portgrp=port_group_spec) # Create the portgroup with the new specifications
-    return True
+        Returns a list of (host name, status) tuples.
+    """
+    pool = create_pool(connection, fan_out) # same session, one HTTP connection per worker
+
+    def worker(host):
+        host_name, network_system = host
+        with borrow(pool) as own:
+            network_system = rebind(network_system, own)
+            try:
+                network_system.AddVirtualSwitch(vswitchName=switch_name, spec=switch_spec(num_port, MTU, nic_name))
+            except Exception as err:
+                return (host_name, 'failed to create switch: {}'.format(getattr(err, 'msg', None) or err))
+            try:
+                network_system.AddPortGroup(portgrp=port_group_spec(port_group_name, switch_name, VID))
+            except Exception as err:
+                return (host_name, 'switch created, failed to create port group: {}'.format(getattr(err, 'msg', None) or err))
+        return (host_name, 'ok')
+
+    try:
+        return run_hosts(worker, network_systems, fan_out, 'Creating vSwitch {}'.format(switch_name), lambda status: status == 'ok')
+    finally:
+        close_pool(pool)
+
+def run_hosts(worker, entries, fan_out, label, succeeded):
+    """
+        Run worker for every entry, fan_out at once, and
+        report every host as an item_completed event
+        (succeeded(status) tells if the host went well).
+
+        Returns the (host name, status) tuples of worker.
+    """
+    def report(entry):
+        host_name, status = worker(entry)
+        emit('item_completed', name=host_name, state='success' if succeeded(status) else 'error', status=status)
+        return (host_name, status)
+
+    start_progress(label, len(entries))
+    try:
+        with ThreadPoolExecutor(max_workers=fan_out) as executor:
+            return list(executor.map(report, entries))
+    finally:
+        stop_progress()
+
+def print_host_results(results):
+    """
+        Print a per-host result table.
+    """
+    print('\nHost results:')
+    for host_name, status in results:
+        print(' {}'.format(host_name).ljust(30, '.') + '{}'.format(status))
+
+def load_network_spec(path):
+    """
+        Read a declarative network specification from
+        a JSON or YAML file:
+
+        vswitches: [{name, mtu, num_ports, uplinks: [vmnic, ...]}, ...]
+        portgroups: [{name, vswitch, vlan, security: {allow_promiscuous,
+                      forged_transmits, mac_changes}}, ...]
+
+        mtu, num_ports, uplinks, vlan and security (and each of
+        its keys) are optional. What is left out is not changed on
+        an existing vSwitch or port group, a new one gets the
+        defaults (see network_changes).
+    """
+    if path.endswith('.yaml') or path.endswith('.yml'):
+        try:
+            import yaml # only needed for YAML specifications
+        except ImportError:
+            raise NameError('PyYAML is required to read YAML specifications (pip install pyyaml).')
+        with open(path) as f:
+            spec = yaml.safe_load(f) or {}
+    else:
+        with open(path) as f:
+            spec = json.load(f)
+    return check_network_spec(spec)
+
+def check_network_spec(spec):
+    """
+        Check the values in a network specification.
+        Raises NameError with every invalid value, see
+        network_spec_errors.
+    """
+    spec, errors = network_spec_errors(spec)
+    if errors:
+        raise NameError('\n'.join(errors))
+    return spec
 
-def connect():
+def spec_number(item, key, errors):
     """
-        Create a connection to a VMware host.
-        1. First attempt with a valid cert.
-        2. If no valid cert, then try without cert
-        and notify this to the user.
-        3. If this does not work then an exception is raised
-        and notify the user.
+        Integer value of item[key], None when it is
+        not given. None and an error when it is not a number.
     """
+    if item.get(key) is None:
+        return None
     try:
-        try: # Try to connect with default SSL options
-            connection = SmartConnect(host="10.207.3.10", user="administrator@b15benko.nsa.his.se", pwd='Syp9393!!') 
-            return (1, connection)
-        except ssl.SSLError: # By pass SSL errors if any are given
-            cert = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
-            cert.verify_mode = ssl.CERT_NONE # bypass SSL errors, whoops...
-            connection = SmartConnect(host="10.207.3.10", user="administrator@b15benko.nsa.his.se", pwd='Syp9393!!', sslContext=cert) 
-            return (2, connection)
-    except Exception as err: 
-        return (3, err)
+        return int(item[key])
+    except (ValueError, TypeError):
+        errors.append('Spec error: {} of {} must be a number.'.format(key, item.get('name')))
+        return None
+
+def network_spec_errors(spec):
+    """
+        Check every value in a network specification.
+        Values that are not given are None (leave alone),
+        like uplinks.
+
+        Returns (specification, list of errors), the
+        specification is only usable when there are no errors.
+    """
+    errors = []
+    vswitches = []
+    for vswitch in spec.get('vswitches', []):
+        if not vswitch.get('name'):
+            errors.append('Spec error: every vSwitch needs a name.')
+            continue
+        MTU = spec_number(vswitch, 'mtu', errors)
+        if MTU is not None and (MTU < 1500 or MTU > 9000):
+            errors.append('Spec error: MTU of {} cannot be lower than 1500 or higher than 9000.'.format(vswitch['name']))
+        num_port = spec_number(vswitch, 'num_ports', errors)
+        if num_port is not None and (num_port < 1 or num_port > 1024):
+            errors.append('Spec error: the number of ports of {} may not exceed 1024 or be lower than 1.'.format(vswitch['name']))
+        vswitches.append({'name': vswitch['name'], 'mtu': MTU, 'num_ports': num_port,
+                          'uplinks': vswitch.get('uplinks')}) # None means: leave the uplinks alone
+
+    switch_names = [vswitch['name'] for vswitch in vswitches]
+    portgroups = []
+    for portgroup in spec.get('portgroups', []):
+        if not portgroup.get('name') or not portgroup.get('vswitch'):
+            errors.append('Spec error: every port group needs a name and a vswitch.')
+            continue
+        VID = spec_number(portgroup, 'vlan', errors)
+        if VID is not None and (VID < 0 or VID > 4095):
+            errors.append('Spec error: VID of {} cannot be lower than 0 or exceed 4095.'.format(portgroup['name']))
+        security = portgroup.get('security') or {}
+        portgroups.append({'name': portgroup['name'], 'vswitch': portgroup['vswitch'], 'vlan': VID,
+                           'security': dict((key, bool(security[key]) if security.get(key) is not None else None)
+                                            for key in ('allow_promiscuous', 'forged_transmits', 'mac_changes'))})
+
+    for name in sorted(set(name for name in switch_names if switch_names.count(name) > 1)):
+        errors.append('Spec error: vSwitch name {} is used more than once.'.format(name))
+    group_names = [pg['name'] for pg in portgroups]
+    for name in sorted(set(name for name in group_names if group_names.count(name) > 1)):
+        errors.append('Spec error: port group name {} is used more than once.'.format(name))
+    uplinks = [nic for vswitch in vswitches for nic in vswitch['uplinks'] or []]
+    for nic in sorted(set(nic for nic in uplinks if uplinks.count(nic) > 1)):
+        errors.append('Spec error: physical NIC {} is an uplink of more than one vSwitch.'.format(nic))
+    return {'vswitches': vswitches, 'portgroups': portgroups}, errors
+
+def read_networks(connection, network_systems):
+    """
+        The current network (vSwitches, port groups and
+        physical NICs, distributed switches the host is a
+        member of) of every host, read with one
+        PropertyCollector request.
+
+        Returns a dictionary: network system -> HostNetworkInfo
+    """
+    current = retrieve_properties(connection, [network_system for host_name, network_system in network_systems],
+                                  vim.host.NetworkSystem, ['networkInfo.vswitch', 'networkInfo.portgroup', 'networkInfo.pnic',
+                                                           'networkInfo.proxySwitch'])
+    networks = {}
+    for host_name, network_system in network_systems:
+        props = current.get(network_system, {})
+        networks[network_system] = vim.host.NetworkInfo(vswitch=props.get('networkInfo.vswitch', []),
+                                                        portgroup=props.get('networkInfo.portgroup', []),
+                                                        pnic=props.get('networkInfo.pnic', []),
+                                                        proxySwitch=props.get('networkInfo.proxySwitch', []))
+    return networks
+
+def host_network_errors(network_info, spec, create_only=False):
+    """
+        Check a network specification against the current
+        network of one host: the uplinks must exist and may
+        not be used by another vSwitch, a vSwitch with a port
+        group in use keeps at least one uplink, every port
+        group needs a vSwitch. With create_only (plain create mode) a
+        vSwitch or port group that already exists is an error,
+        otherwise it is edited.
+
+        Returns a list of errors.
+    """
+    errors = []
+    switches = dict((vswitch.name, vswitch) for vswitch in network_info.vswitch or [])
+    groups = set(portgroup.spec.name for portgroup in network_info.portgroup or [])
+    nics = set(pnic.device for pnic in network_info.pnic or [])
+    used = {} # physical NIC -> vSwitch (or distributed switch) it is an uplink of
+    for vswitch in network_info.vswitch or []:
+        for nic in getattr(vswitch.spec.bridge, 'nicDevice', None) or []:
+            used[nic] = vswitch.name
+    for proxy in network_info.proxySwitch or []:
+        for pnic_spec in getattr(proxy.spec.backing, 'pnicSpec', None) or []:
+            used[pnic_spec.pnicDevice] = proxy.dvsName
+
+    for wanted in spec['vswitches']:
+        if create_only == True and wanted['name'] in switches:
+            errors.append('vSwitch {} already exists'.format(wanted['name']))
+        for nic in wanted['uplinks'] or []:
+            if nic not in nics:
+                errors.append('physical NIC {} does not exist'.format(nic))
+            elif used.get(nic, wanted['name']) != wanted['name']:
+                errors.append('physical NIC {} is already used by {}'.format(nic, used[nic]))
+        current = switches.get(wanted['name'])
+        if wanted['uplinks'] == [] and current is not None and current.spec.bridge is not None:
+            for portgroup in network_info.portgroup or []:
+                if portgroup.spec.vswitchName == wanted['name'] and portgroup.port:
+                    errors.append('vSwitch {} cannot lose its uplinks, port group {} is in use'.format(wanted['name'], portgroup.spec.name))
+    wanted_switches = [wanted['name'] for wanted in spec['vswitches']]
+    for wanted in spec['portgroups']:
+        if create_only == True and wanted['name'] in groups:
+            errors.append('port group {} already exists'.format(wanted['name']))
+        if wanted['vswitch'] not in wanted_switches and wanted['vswitch'] not in switches:
+            errors.append('vSwitch {} of port group {} does not exist'.format(wanted['vswitch'], wanted['name']))
+    return errors
+
+def check_hosts(connection, snapshot, network_systems, spec, create_only=False):
+    """
+        Check a network specification against every host
+        before anything is changed, so a problem on one
+        host does not leave the cluster half configured.
+
+        Returns (list of (host name, error), current networks
+        as returned by read_networks, to be reused by plan_network).
+    """
+    networks = read_networks(connection, network_systems)
+    errors = []
+    for host_name, network_system in network_systems:
+        host = find(snapshot, vim.HostSystem, host_name)
+        if host is not None and get(snapshot, host, 'runtime.connectionState') != vim.HostSystem.ConnectionState.connected:
+            errors.append((host_name, 'host is not connected'))
+        for err in host_network_errors(networks[network_system], spec, create_only):
+            errors.append((host_name, err))
+    return errors, networks
+
+def print_errors(errors):
+    """
+        Print every error found before a change, one per line.
+    """
+    print('\nFound {} problem(s), nothing was changed:'.format(len(errors)))
+    for subject, err in errors:
+        print(' {}'.format(subject).ljust(30, '.') + '{}'.format(err))
+
+def network_changes(network_info, spec):
+    """
+        Compare the current network of a host (its
+        HostNetworkInfo) with a network specification.
+        Values the specification leaves out (None) are
+        kept, a new vSwitch gets MTU 1500 and 128 ports,
+        a new port group VLAN 0 and the security policy
+        of create_port_group.
+
+        Returns (HostNetworkConfig, list of changes as text),
+        the config is None when the host already matches.
+    """
+    config = vim.host.NetworkConfig(vswitch=[], portgroup=[])
+    changes = []
+
+    current_switches = dict((vswitch.name, vswitch) for vswitch in network_info.vswitch or [])
+    for wanted in spec['vswitches']:
+        current = current_switches.get(wanted['name'])
+        if current is None:
+            config.vswitch.append(vim.host.VirtualSwitch.Config(changeOperation='add', name=wanted['name'],
+                                  spec=switch_spec(wanted['num_ports'] if wanted['num_ports'] is not None else 128,
+                                                   wanted['mtu'] if wanted['mtu'] is not None else 1500, None)))
+            if wanted['uplinks']:
+                config.vswitch[-1].spec.bridge = vim.host.VirtualSwitch.BondBridge(nicDevice=list(wanted['uplinks']))
+            changes.append('add vSwitch {}'.format(wanted['name']))
+            continue
+
+        sw_spec = copy.deepcopy(current.spec) # edit a copy of the current spec so policies we do not manage are kept
+        edits = []
+        if wanted['mtu'] is not None and sw_spec.mtu != wanted['mtu']:
+            edits.append('MTU {} -> {}'.format(sw_spec.mtu, wanted['mtu']))
+            sw_spec.mtu = wanted['mtu']
+        if wanted['num_ports'] is not None and sw_spec.numPorts != wanted['num_ports']:
+            edits.append('ports {} -> {}'.format(sw_spec.numPorts, wanted['num_ports']))
+            sw_spec.numPorts = wanted['num_ports']
+        if wanted['uplinks'] is not None:
+            current_uplinks = list(getattr(sw_spec.bridge, 'nicDevice', None) or [])
+            if sorted(current_uplinks) != sorted(wanted['uplinks']):
+                edits.append('uplinks {} -> {}'.format(current_uplinks, wanted['uplinks']))
+                if wanted['uplinks']:
+                    sw_spec.bridge = vim.host.VirtualSwitch.BondBridge(nicDevice=list(wanted['uplinks']))
+                else:
+                    sw_spec.bridge = None
+                if sw_spec.policy is not None and sw_spec.policy.nicTeaming is not None: # the old order names NICs the switch no longer has
+                    sw_spec.policy.nicTeaming.nicOrder = teaming_order(sw_spec.policy.nicTeaming.nicOrder, wanted['uplinks']) if wanted['uplinks'] else None
+        if edits:
+            config.vswitch.append(vim.host.VirtualSwitch.Config(changeOperation='edit', name=wanted['name'], spec=sw_spec))
+            changes.append('edit vSwitch {}: {}'.format(wanted['name'], ', '.join(edits)))
+
+    current_groups = dict((portgroup.spec.name, portgroup) for portgroup in network_info.portgroup or [])
+    for wanted in spec['portgroups']:
+        current = current_groups.get(wanted['name'])
+        if current is None:
+            pg_spec = port_group_spec(wanted['name'], wanted['vswitch'], wanted['vlan'] if wanted['vlan'] is not None else 0)
+            for field, key in (('allowPromiscuous', 'allow_promiscuous'), ('forgedTransmits', 'forged_transmits'), ('macChanges', 'mac_changes')):
+                if wanted['security'][key] is not None:
+                    setattr(pg_spec.policy.security, field, wanted['security'][key])
+            config.portgroup.append(vim.host.PortGroup.Config(changeOperation='add', spec=pg_spec))
+            changes.append('add port group {}'.format(wanted['name']))
+            continue
+
+        pg_spec = copy.deepcopy(current.spec)
+        edits = []
+        if pg_spec.vswitchName != wanted['vswitch']:
+            edits.append('vSwitch {} -> {}'.format(pg_spec.vswitchName, wanted['vswitch']))
+            pg_spec.vswitchName = wanted['vswitch']
+        if wanted['vlan'] is not None and pg_spec.vlanId != wanted['vlan']:
+            edits.append('VLAN {} -> {}'.format(pg_spec.vlanId, wanted['vlan']))
+            pg_spec.vlanId = wanted['vlan']
+        if pg_spec.policy is None:
+            pg_spec.policy = vim.host.NetworkPolicy()
+        if pg_spec.policy.security is None:
+            pg_spec.policy.security = vim.host.NetworkPolicy.SecurityPolicy()
+        security = pg_spec.policy.security
+        for field, key in (('allowPromiscuous', 'allow_promiscuous'), ('forgedTransmits', 'forged_transmits'), ('macChanges', 'mac_changes')):
+            if wanted['security'][key] is not None and getattr(security, field) != wanted['security'][key]:
+                edits.append('{} {} -> {}'.format(field, getattr(security, field), wanted['security'][key]))
+                setattr(security, field, wanted['security'][key])
+        if edits:
+            config.portgroup.append(vim.host.PortGroup.Config(changeOperation='edit', spec=pg_spec))
+            changes.append('edit port group {}: {}'.format(wanted['name'], ', '.join(edits)))
+
+    if not changes:
+        return None, changes
+    return config, changes
+
+def plan_network(connection, network_systems, spec, networks=None):
+    """
+        Work out what has to change on every host. The
+        current vSwitches and port groups of all hosts are
+        read with one PropertyCollector request (unless
+        check_hosts already read them), nothing is changed
+        on the hosts.
+
+        Returns a list of (host name, network system,
+        HostNetworkConfig or None, list of changes as text).
+    """
+    if networks is None:
+        networks = read_networks(connection, network_systems)
+    plan = []
+    for host_name, network_system in network_systems:
+        config, changes = network_changes(networks[network_system], spec)
+        plan.append((host_name, network_system, config, changes))
+    return plan
+
+def print_plan(plan):
+    """
+        Print what will change on every host and a summary.
+    """
+    print('\nPlan:')
+    for host_name, network_system, config, changes in plan:
+        if config is None:
+            print(' {}'.format(host_name).ljust(30, '.') + 'compliant')
+        else:
+            print(' {}'.format(host_name).ljust(30, '.') + '; '.join(changes))
+    to_change = [entry for entry in plan if entry[2] is not None]
+    print('\n{} host(s) compliant, {} host(s) to change, {} change(s) in total.'.format(
+                                                                                    len(plan) - len(to_change),
+                                                                                    len(to_change),
+                                                                                    sum(len(entry[3]) for entry in to_change)
+                                                                                ))
+
+def apply_plan(connection, plan, fan_out=8):
+    """
+        Apply a plan from plan_network. All changes of a host
+        are sent in one UpdateNetworkConfig call (changeMode=modify),
+        so a host is either changed completely or not at all.
+        Compliant hosts are not touched.
+
+        Returns a list of (host name, status) tuples.
+    """
+    pool = create_pool(connection, fan_out) # same session, one HTTP connection per worker
+
+    def worker(entry):
+        host_name, network_system, config, changes = entry
+        if config is None:
+            return (host_name, 'no changes')
+        with borrow(pool) as own:
+            try:
+                rebind(network_system, own).UpdateNetworkConfig(config=config, changeMode='modify')
+                return (host_name, 'updated: {}'.format('; '.join(changes)))
+            except Exception as err: # one failing host should not stop the others
+                return (host_name, 'failed: {}'.format(getattr(err, 'msg', None) or err))
+
+    try:
+        return run_hosts(worker, plan, fan_out, 'Updating host networks', lambda status: status.startswith('failed') == False)
+    finally:
+        close_pool(pool)
+
+def reconcile(connection, network_systems, spec, fan_out=8, dry_run=False, networks=None):
+    """
+        Plan and (unless dry_run) apply a network
+        specification, printing the plan and the results.
+        networks are the current networks from check_hosts.
+    """
+    plan = plan_network(connection, network_systems, spec, networks)
+    print_plan(plan)
+    if dry_run == True:
+        print('\nDry run (--plan), nothing was changed.')
+        return
+    if not [entry for entry in plan if entry[2] is not None]:
+        for entry in plan: # nothing to do is done as well (journal, progress)
+            emit('item_completed', name=entry[0], state='success', status='no changes')
+        return
+    results = apply_plan(connection, plan, fan_out)
+    print_host_results(results)
+    failed = [host_name for host_name, status in results if status.startswith('failed')]
+    print('\nApplied: {} host(s) updated, {} failed.'.format(
+                                                            len([status for host_name, status in results if status.startswith('updated')]),
+                                                            len(failed)
+                                                        ))
+
+def dvs_port_group_spec(port_group_name, num_port, VID, config_version=None):
+    """
+        Create the specification of a distributed port
+        group with a VLAN and the same security policy
+        as port_group_spec.
+    """
+    port_config = vim.dvs.VmwareDistributedVirtualSwitch.VmwarePortConfigPolicy()
+    port_config.vlan = vim.dvs.VmwareDistributedVirtualSwitch.VlanIdSpec(vlanId=int(VID), inherited=False)
+    port_config.securityPolicy = vim.dvs.VmwareDistributedVirtualSwitch.SecurityPolicy(
+        inherited=False,
+        allowPromiscuous=vim.BoolPolicy(value=True, inherited=False),
+        forgedTransmits=vim.BoolPolicy(value=True, inherited=False),
+        macChanges=vim.BoolPolicy(value=False, inherited=False))
+    return vim.dvs.DistributedVirtualPortgroup.ConfigSpec(name=port_group_name, type='earlyBinding', numPorts=int(num_port),
+                                                          defaultPortConfig=port_config, configVersion=config_version)
+
+def host_member_spec(host, operation, nic_name=None):
+    """
+        Add (or edit) a host as member of a distributed
+        switch, nic_name is the optional physical NIC
+        that becomes its uplink.
+    """
+    member = vim.dvs.HostMember.ConfigSpec(operation=operation, host=host)
+    if nic_name is not None:
+        member.backing = vim.dvs.HostMember.PnicBacking(pnicSpec=[vim.dvs.HostMember.PnicSpec(pnicDevice=nic_name)])
+    return member
+
+def plan_dvs(connection, snapshot, cluster, switch_name, MTU, num_port, port_group_name, VID, nic_name=None):
+    """
+        Work out what the distributed switch and its port
+        group need: create them, or only the differences
+        (MTU, hosts of the cluster that are not members yet,
+        uplink, VLAN, ports). The current configuration is
+        read with one request per object, nothing is changed.
+
+        Returns a dictionary: {'dvs', 'switch_spec', 'port_group',
+        'port_group_spec', 'folder', 'changes'} where a spec is
+        None when there is nothing to change.
+    """
+    hosts = get(snapshot, cluster, 'host', [])
+    plan = {'dvs': find(snapshot, vim.DistributedVirtualSwitch, switch_name), 'switch_spec': None,
+            'port_group': None, 'port_group_spec': None, 'changes': [],
+            'folder': get(snapshot, datacenter_of(snapshot, cluster), 'networkFolder')}
+
+    if plan['dvs'] is None:
+        config = vim.dvs.VmwareDistributedVirtualSwitch.ConfigSpec(name=switch_name, maxMtu=int(MTU),
+                     host=[host_member_spec(host, 'add', nic_name) for host in hosts])
+        plan['switch_spec'] = vim.DistributedVirtualSwitch.CreateSpec(configSpec=config)
+        plan['changes'].append('create distributed switch {} with {} host(s)'.format(switch_name, len(hosts)))
+    else:
+        current = retrieve_properties(connection, [plan['dvs']], vim.dvs.VmwareDistributedVirtualSwitch,
+                                      ['config.configVersion', 'config.maxMtu', 'config.host']).get(plan['dvs'], {})
+        config = vim.dvs.VmwareDistributedVirtualSwitch.ConfigSpec(configVersion=current.get('config.configVersion'), host=[])
+        if current.get('config.maxMtu') != int(MTU):
+            config.maxMtu = int(MTU)
+            plan['changes'].append('MTU {} -> {}'.format(current.get('config.maxMtu'), MTU))
+        members = dict((member.config.host, member.config) for member in current.get('config.host', []))
+        added = [host for host in hosts if host not in members]
+        for host in added:
+            config.host.append(host_member_spec(host, 'add', nic_name))
+        if added:
+            plan['changes'].append('add {} host(s)'.format(len(added)))
+        if nic_name is not None:
+            edited = [host for host in hosts if host in members and
+                      nic_name not in [pnic_spec.pnicDevice for pnic_spec in getattr(members[host].backing, 'pnicSpec', None) or []]]
+            for host in edited:
+                config.host.append(host_member_spec(host, 'edit', nic_name))
+            if edited:
+                plan['changes'].append('uplink {} on {} host(s)'.format(nic_name, len(edited)))
+        if config.maxMtu is not None or config.host:
+            plan['switch_spec'] = config
+
+        port_group = find(snapshot, vim.Network, port_group_name)
+        if port_group is not None and get(snapshot, port_group, 'config.distributedVirtualSwitch') == plan['dvs']:
+            plan['port_group'] = port_group
+
+    if plan['port_group'] is None:
+        plan['port_group_spec'] = dvs_port_group_spec(port_group_name, num_port, VID)
+        plan['changes'].append('add distributed port group {} (VLAN {})'.format(port_group_name, VID))
+        return plan
+
+    current = retrieve_properties(connection, [plan['port_group']], vim.dvs.DistributedVirtualPortgroup,
+                                  ['config.configVersion', 'config.numPorts', 'config.defaultPortConfig']).get(plan['port_group'], {})
+    port_config = current.get('config.defaultPortConfig')
+    current_VID = getattr(getattr(port_config, 'vlan', None), 'vlanId', None)
+    edits = []
+    if current_VID != int(VID):
+        edits.append('VLAN {} -> {}'.format(current_VID, VID))
+    if current.get('config.numPorts') != int(num_port):
+        edits.append('ports {} -> {}'.format(current.get('config.numPorts'), num_port))
+    if edits:
+        plan['port_group_spec'] = dvs_port_group_spec(port_group_name, num_port, VID, current.get('config.configVersion'))
+        plan['changes'].append('edit distributed port group {}: {}'.format(port_group_name, ', '.join(edits)))
+    return plan
+
+def apply_dvs(connection, plan):
+    """
+        Apply a plan from plan_dvs: at most one task for the
+        switch (create, or reconfigure with all hosts at once)
+        and one for the port group, instead of a call per host.
+
+        Returns a list of (step, status) tuples.
+    """
+    results = []
+    dvs = plan['dvs']
+    if plan['switch_spec'] is not None:
+        if dvs is None:
+            step = 'create switch'
+            result = wait_for_task(connection, plan['folder'].CreateDVS_Task(spec=plan['switch_spec']), name=plan['switch_spec'].configSpec.name)
+            dvs = result['result']
+        else:
+            step = 'update switch'
+            result = wait_for_task(connection, dvs.ReconfigureDvs_Task(spec=plan['switch_spec']), name=step)
+        if result['state'] != 'success':
+            results.append((step, 'failed: {}'.format(result['error'])))
+            return results # the port group needs the switch
+        results.append((step, 'ok ({:.1f}s)'.format(result['seconds'] or 0)))
+
+    if plan['port_group_spec'] is not None:
+        if plan['port_group'] is None:
+            step = 'add port group'
+            result = wait_for_task(connection, dvs.AddDVPortgroup_Task(spec=[plan['port_group_spec']]), name=plan['port_group_spec'].name)
+        else:
+            step = 'update port group'
+            result = wait_for_task(connection, plan['port_group'].ReconfigureDVPortgroup_Task(spec=plan['port_group_spec']),
+                                   name=plan['port_group_spec'].name)
+        if result['state'] != 'success':
+            results.append((step, 'failed: {}'.format(result['error'])))
+        else:
+            results.append((step, 'ok ({:.1f}s)'.format(result['seconds'] or 0)))
+    return results
+
+def dvs_main(connection, snapshot, cluster, network_systems, switch_name, MTU, num_port, port_group_name, VID, nic_name, dry_run=False):
+    """
+        Distributed switch mode: create or update a
+        distributed switch with every host of the cluster
+        as member and a distributed port group on it.
+    """
+    # the uplink must exist on every host and may not belong to another switch
+    spec = {'vswitches': [{'name': switch_name, 'uplinks': [nic_name] if nic_name is not None else None}], 'portgroups': []}
+    errors, networks = check_hosts(connection, snapshot, network_systems, spec)
+    if errors:
+        print_errors(errors)
+        sys.exit()
+
+    plan = plan_dvs(connection, snapshot, cluster, switch_name, MTU, num_port, port_group_name, VID, nic_name)
+    print('\nPlan:')
+    for change in plan['changes'] or ['compliant']:
+        print(' {}'.format(switch_name).ljust(30, '.') + change)
+    if dry_run == True:
+        print('\nDry run (--plan), nothing was changed.')
+        return
+    if not plan['changes']:
+        return
+    print('\nResults:')
+    for step, status in apply_dvs(connection, plan):
+        print(' {}'.format(step).ljust(30, '.') + status)
+
+def spec_main(connection, fan_out, dry_run=False):
+    """
+        Declarative mode: apply a network specification
+        file to every host in a cluster.
+    """
+    try:
+        if len(sys.argv) < 4:
+            raise IndexError
+        spec = load_network_spec(sys.argv[2])
+        cluster_name = sys.argv[3]
+
+        snapshot = cached_inventory(connection)
+        cluster = find(snapshot, vim.ClusterComputeResource, cluster_name)
+        if cluster is None:
+            raise NameError('Argument error: cluster "{}" does not exist.'.format(cluster_name))
+    except IndexError as err:
+        print('Missing parameter(s) - Usage:\n>  ./vSwitch.py --spec <network.json|.yaml> <Target cluster name> <OPTIONAL: --fan-out=N> <OPTIONAL: --plan>')
+        sys.exit()
+    except (NameError, OSError, ValueError, TypeError) as err:
+        print(err)
+        sys.exit()
+
+    print('Applying {} vSwitch(es) and {} port group(s) to {}...'.format(len(spec['vswitches']), len(spec['portgroups']), cluster_name))
+    network_systems = host_network_systems(snapshot, cluster)
+    errors, networks = check_hosts(connection, snapshot, network_systems, spec)
+    if errors:
+        print_errors(errors)
+        sys.exit()
+    if dry_run == False:
+        start_host_journal(cluster_name, spec, network_systems)
+    try:
+        reconcile(connection, network_systems, spec, fan_out, dry_run, networks)
+    finally:
+        stop_journal()
+    print('Done.')
+
+def start_host_journal(cluster_name, spec, network_systems):
+    """
+        Journal a run over the hosts of a cluster (see
+        journal.py). A resume reconciles the hosts that did
+        not finish, whatever mode the run was started in.
+    """
+    path = start_journal('create_vswitch', {'cluster': cluster_name, 'spec': spec},
+                         dict((host_name, None) for host_name, network_system in network_systems))
+    if path is not None:
+        print('Journal: {} (python3 create_vswitch.py --resume {} continues an interrupted run)'.format(path, path))
+
+def resume_main(connection, fan_out):
+    """
+        Resume a run from its journal: hosts that were
+        finished are skipped, the network specification
+        of the run is reconciled on the other hosts, so
+        what a host already got is not added twice.
+    """
+    path = sys.argv[2] if len(sys.argv) > 2 else latest_journal('create_vswitch')
+    try:
+        if path is None:
+            raise NameError('No journal found, give the path of one: python3 create_vswitch.py --resume <journal>')
+        state = load_journal(path)
+        if state['script'] != 'create_vswitch':
+            raise NameError('{} is not a journal of create_vswitch.py'.format(path))
+        spec = check_network_spec(state['run']['spec'])
+        snapshot = cached_inventory(connection)
+        cluster = find(snapshot, vim.ClusterComputeResource, state['run']['cluster'])
+        if cluster is None:
+            raise NameError('Argument error: cluster "{}" does not exist.'.format(state['run']['cluster']))
+    except (NameError, OSError) as err:
+        print(err)
+        sys.exit()
+
+    done = [name for name, item in state['items'].items() if item_done(item)]
+    network_systems = [(host_name, network_system) for host_name, network_system in host_network_systems(snapshot, cluster)
+                       if host_name in state['items'] and host_name not in done]
+    print('Resuming {}: {} host(s) finished, {} to do.'.format(path, len(done), len(network_systems)))
+    errors, networks = check_hosts(connection, snapshot, network_systems, spec)
+    if errors:
+        print_errors(errors)
+        sys.exit()
+    start_journal('create_vswitch', state['run'], {}, path)
+    try:
+        reconcile(connection, network_systems, spec, fan_out, False, networks)
+    finally:
+        stop_journal()
+    print('Done.')
+
+def parse_fan_out():
+    """
+        Read and remove the optional --fan-out=N flag
+        (number of hosts configured at the same time).
+    """
+    fan_out = 8
+    for arg in list(sys.argv):
+        if arg.startswith('--fan-out='):
+            sys.argv.remove(arg)
+            fan_out = arg.split('=', 1)[1]
+            if fan_out.isdigit() == False or int(fan_out) < 1:
+                raise NameError('Argument error: fan-out must be a number larger than 0.')
+            fan_out = int(fan_out)
+    return fan_out
 
 def main():
     """
@@ -86,6 +791,7 @@ def main():
         This whole block can be removed if
         this script is used as a module
     """
+    setup_events() # with the events on stdout the output below goes to stderr
     print('Attempting to connect...')
     c = connect() # returns a tuple: (1, connection) or (2, error_msg) or (3, connection)
     if c[0] == 1:
@@ -95,10 +801,25 @@ def main():
         connection = c[1] # The second index contains the connection information
         print('WARNING: Invalid certificate.\nSuccess!')
     elif c[0] == 3:
-        print('Something went wrong: {}'.formt(c[1])) # the second index contains the raised exception
+        print('Something went wrong: {}'.format(c[1])) # the second index contains the raised exception
         sys.exit()
 
     try:
+        fan_out = parse_fan_out()
+        reconcile_mode = '--reconcile' in sys.argv # optional flag: only change what differs from the arguments
+        dry_run = '--plan' in sys.argv # optional flag: only show what would change
+        dvs_mode = '--dvs' in sys.argv # optional flag: one distributed switch for the cluster instead of a vSwitch per host
+        for flag in ('--reconcile', '--plan', '--dvs'):
+            if flag in sys.argv:
+                sys.argv.remove(flag)
+
+        if len(sys.argv) > 1 and sys.argv[1] == '--spec':
+            spec_main(connection, fan_out, dry_run)
+            return
+        if len(sys.argv) > 1 and sys.argv[1] == '--resume':
+            resume_main(connection, fan_out)
+            return
+
         if len(sys.argv) < 7: # perform some error checks before moving on the other selection blocks
             raise IndexError
 
@@ -140,44 +861,66 @@ def main():
         print(' Number of ports'.ljust(20, '.') + '{}'.format(num_port))
         print(' Port group'.ljust(20, '.') + '{}'.format(port_group_name))
         print(' VLAN'.ljust(20, '.') + '{}'.format(VID))
-        if len(sys.argv) == 9:
-            nic_name = sys.argv[8]
+        nic_name = None
+        if len(sys.argv) == 8:
+            nic_name = sys.argv[7]
             print(' Physical NIC'.ljust(20, '.') + '{}'.format(nic_name))
+        print(' Hosts at once'.ljust(20, '.') + '{}'.format(fan_out))
 
-        inventory = connection.RetrieveContent() # Retrieve the start of the API heirarchy
-        dc = inventory.rootFolder.childEntity[0]
-        cluster = dc.hostFolder.childEntity[0]
-        
-        if 'nic_name' in locals(): # see if optional argument is given, if not then do not pass it to the function
-            if create_switch(cluster, switch_name, num_port, MTU, nic_name) == True:
-                print('{} created with {} ports and attached to {}...'.format(  
-                                                                                switch_name, 
-                                                                                num_port, 
-                                                                                nic_name
-                                                                            ))
-        else:
-            if create_switch(cluster, switch_name, num_port, MTU) == True:
-                print('{} created with {} ports...'.format(
-                                                            switch_name, 
-                                                            num_port
-                                                        ))
+        snapshot = cached_inventory(connection) # Retrieve the whole inventory in one request, or only what changed since the last run
+        cluster = find(snapshot, vim.ClusterComputeResource, cluster_name)
+        if cluster is None:
+            raise NameError('Argument error: cluster "{}" does not exist.'.format(cluster_name))
+        network_systems = host_network_systems(snapshot, cluster)
 
-        if create_port_group(cluster, port_group_name, switch_name, VID) == True: # Create portgroup and assign new vSwitch to it
-            print('{} added to the portgroup {}...'.format(
-                                                            switch_name, 
-                                                            port_group_name
-                                                        ))
+        if dvs_mode == True:
+            if int(VID) > 4095: # the VID check above only prints a warning
+                raise NameError('VID cannot be lower than 0 or exceed 4095.')
+            dvs_main(connection, snapshot, cluster, network_systems, switch_name, MTU, num_port, port_group_name, VID, nic_name, dry_run)
+            print('Done.')
+            sys.exit()
+
+        spec = check_network_spec({
+            'vswitches': [{'name': switch_name, 'mtu': MTU, 'num_ports': num_port,
+                           'uplinks': [nic_name] if nic_name is not None else None}],
+            'portgroups': [{'name': port_group_name, 'vswitch': switch_name, 'vlan': VID}]
+        })
+        # check every host before the first change, in create mode an existing switch or port group is a clash
+        errors, networks = check_hosts(connection, snapshot, network_systems, spec, reconcile_mode == False and dry_run == False)
+        if errors:
+            print_errors(errors)
+            sys.exit()
+
+        if dry_run == True:
+            reconcile(connection, network_systems, spec, fan_out, dry_run, networks)
+            print('Done.')
+            sys.exit()
+
+        start_host_journal(cluster_name, spec, network_systems)
+        try:
+            if reconcile_mode == True:
+                reconcile(connection, network_systems, spec, fan_out, dry_run, networks)
+                print('Done.')
+                sys.exit()
+            results = rollout(connection, network_systems, switch_name, num_port, MTU, port_group_name, VID, nic_name, fan_out)
+        finally:
+            stop_journal()
+        print_host_results(results)
+        failed = [host_name for host_name, status in results if status != 'ok']
+        if failed:
+            print('\n{} of {} host(s) failed.'.format(len(failed), len(results)))
+        else:
+            print('\n{} and port group {} created on {} host(s)...'.format(switch_name, port_group_name, len(results)))
 
     except IndexError as err:
-        print('Missing parameter(s) - Usage:\n>  ./vSwitch.py <Target cluster name> <Switch_name> <MTU(1000-9000)> <Number_of_ports(1-1024)> <VLAN_name> <VLAN_ID(1-4095)> <OPTIONAL: Physical_NIC_name>')
+        print('Missing parameter(s) - Usage:\n>  ./vSwitch.py <Target cluster name> <Switch_name> <MTU(1000-9000)> <Number_of_ports(1-1024)> <VLAN_name> <VLAN_ID(1-4095)> <OPTIONAL: Physical_NIC_name> <OPTIONAL: --fan-out=N> <OPTIONAL: --reconcile> <OPTIONAL: --plan> <OPTIONAL: --dvs>\n>  ./vSwitch.py --resume <OPTIONAL: journal>')
         sys.exit()
     except NameError as err:
         print(err)
         sys.exit()
     
     print('Done.')
-    Disconnect(connection) # Disconnect first before existing program, to ensure the cluster terminates the connection as well
-    sys.exit() # Exit the script
+    sys.exit() # Exit the script, the session is released by connection.release
 
 if __name__ == "__main__": 
     main()
@@ -0,0 +1,148 @@
+#! /usr/bin/python3
+
+# Structured progress events for the scripts.
+# Every phase of a run (validation, task submitted, task progress,
+# task completed, errors, batch progress) is written as one JSON
+# object per line (NDJSON) with a timestamp, so a pipeline can act
+# on a VM as soon as it is ready instead of waiting for the batch.
+#
+# Set VMWARE_SCRIPTS_EVENTS to a file to append the events to, or to
+# "-" to write them to stdout; the scripts call setup_events() from
+# their main() so their normal output then goes to stderr and stdout
+# only carries events.
+#
+# During a batch a live progress line (done, failed, running and
+# their average task progress) is shown on stderr when it is a
+# terminal.
+
+import os
+import sys
+import json
+import time
+import threading
+import datetime
+
+EVENTS = os.environ.get('VMWARE_SCRIPTS_EVENTS', '')
+
+lock = threading.Lock()
+stream = None # where the events go, opened on the first event
+active = None # progress of the batch that is running, see start_progress
+listeners = [] # functions called with (event, fields) for every event, see add_listener
+
+def setup_events():
+    """
+        Called from the main() of a script: with the events
+        on stdout the print() output of the script moves
+        to stderr, out of the way of the events.
+    """
+    global stream
+    if EVENTS == '-' and stream is None:
+        stream = sys.stdout
+        sys.stdout = sys.stderr
+
+def timestamp():
+    """
+        Current time in UTC, ISO 8601.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+def emit(event, **fields):
+    """
+        Write one event, e.g.
+        emit('task_completed', name='vm01', state='success', seconds=12.3)
+        Values that are not JSON (managed objects, dates)
+        are written as text. The progress line of a running
+        batch and the listeners get the same events.
+    """
+    global stream
+    with lock:
+        if active is not None:
+            update_progress(active, event, fields)
+        for listener in listeners:
+            listener(event, fields)
+        if not EVENTS:
+            return
+        if stream is None: # first event, setup_events was not called for stdout
+            stream = sys.stdout if EVENTS == '-' else open(EVENTS, 'a')
+        fields['event'] = event
+        fields['ts'] = timestamp()
+        stream.write(json.dumps(fields, default=str, sort_keys=True) + '\n')
+        stream.flush()
+
+def add_listener(listener):
+    """
+        Call listener(event, fields) for every event
+        from now on (e.g. the journal, see journal.py).
+    """
+    with lock:
+        listeners.append(listener)
+
+def remove_listener(listener):
+    """
+        Stop calling a listener.
+    """
+    with lock:
+        if listener in listeners:
+            listeners.remove(listener)
+
+def start_progress(label, total):
+    """
+        Start the progress view of a batch of total items.
+    """
+    global active
+    with lock:
+        active = {'label': label, 'total': total, 'done': 0, 'failed': 0, 'running': {}, 'started': time.time()}
+    emit('batch_started', label=label, total=total)
+
+def update_progress(progress, event, fields):
+    """
+        Follow the events of the items of a batch:
+        task_progress updates the percentage of an item,
+        item_completed counts it as done (or failed).
+    """
+    name = fields.get('name')
+    if event == 'task_progress' and name is not None:
+        progress['running'][name] = fields.get('percent') or 0
+    elif event == 'task_submitted' and name is not None:
+        progress['running'].setdefault(name, 0)
+    elif event == 'item_completed':
+        progress['running'].pop(name, None)
+        progress['done'] += 1
+        if fields.get('state') != 'success':
+            progress['failed'] += 1
+    else:
+        return
+    show_progress(progress)
+
+def progress_line(progress):
+    """
+        One line summary of a batch.
+    """
+    running = progress['running']
+    average = sum(running.values()) / float(len(running)) if running else 0
+    return '{}: {}/{} done, {} failed, {} running ({:.0f}%), {:.1f}s'.format(
+        progress['label'], progress['done'], progress['total'], progress['failed'],
+        len(running), average, time.time() - progress['started'])
+
+def show_progress(progress):
+    """
+        Redraw the progress line, only on a terminal.
+    """
+    if sys.stderr.isatty():
+        sys.stderr.write('\r' + progress_line(progress).ljust(79))
+        sys.stderr.flush()
+
+def stop_progress():
+    """
+        End the progress view and report the totals.
+    """
+    global active
+    with lock:
+        progress = active
+        active = None
+    if progress is None:
+        return
+    if sys.stderr.isatty():
+        sys.stderr.write('\r' + progress_line(progress).ljust(79) + '\n')
+    emit('batch_completed', label=progress['label'], total=progress['total'], done=progress['done'],
+         failed=progress['failed'], seconds=round(time.time() - progress['started'], 3))
@@ -0,0 +1,858 @@
+#! /usr/bin/python3
+
+# In-process stand-in for vCenter, used by bench.py and for trying
+# the scripts without a lab. It plays the part of the pyVmomi stub
+# adapter: the scripts get real pyVmomi managed objects, but every
+# method call and property read ends up here instead of being sent
+# as a SOAP request. Every call counts as one round-trip and can be
+# given an artificial latency, tasks finish in the background after
+# a configurable time.
+#
+# Select it with the endpoint setting (see connection.py), e.g.
+#   VMWARE_HOST='fake://?clusters=2&hosts=8&vms=500&latency=0.002'
+#
+# Only what the scripts in this repository use is modelled: one
+# datacenter with clusters, hosts, datastores, networks, VMs and a
+# template, host networking, distributed switches and the
+# PropertyCollector.
+
+import re
+import copy
+import uuid
+import time
+import threading
+from collections import Counter
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError: # python 2
+    from urlparse import urlparse, parse_qs
+from pyVmomi import vim, vmodl, VmomiSupport
+
+GB = 1024 * 1024 * 1024
+
+DEFAULTS = {
+    'clusters': 1,
+    'hosts': 4, # per cluster
+    'datastores': 2, # shared by all hosts
+    'networks': 4,
+    'vms': 20,
+    'latency': 0.0, # seconds added to every call
+    'task_seconds': 0.01, # how long a task runs before it finishes
+    'max_running': 0 # tasks running at the same time, the rest is queued (0 is no limit)
+}
+
+RECENT_TASKS = 200 # length of TaskManager.recentTask
+
+def parse_endpoint(host):
+    """
+        Read the model settings from an endpoint like
+        fake://?hosts=8&vms=500&latency=0.002
+    """
+    settings = dict(DEFAULTS)
+    for key, values in parse_qs(urlparse(host).query).items():
+        if key in settings:
+            settings[key] = type(DEFAULTS[key])(values[-1])
+    return settings
+
+INSTANCES = [] # every fake created in this process, bench.py reads the call counters from here
+
+def connect(host='fake://'):
+    """
+        Build a fake vCenter and return its ServiceInstance,
+        the same thing SmartConnect returns.
+    """
+    fake = FakeVCenter(**parse_endpoint(host))
+    INSTANCES.append(fake)
+    return fake.service_instance
+
+def session(cookie):
+    """
+        The ServiceInstance of the fake with this session
+        cookie, None when there is none (it was made by
+        another process). See connection.load_session.
+    """
+    for fake in INSTANCES:
+        if fake.cookie == cookie:
+            return fake.service_instance
+    return None
+
+def typed(value):
+    """
+        The model keeps lists of managed objects as plain
+        lists, on the wire they are typed arrays. Lists
+        inside data objects are always kept typed.
+    """
+    if type(value) is list and all(isinstance(item, VmomiSupport.ManagedObject) for item in value):
+        return VmomiSupport.ManagedObject.Array(value)
+    return value
+
+class FakeVCenter(object):
+    """
+        The fake server. It is handed to pyVmomi as the stub
+        of every managed object, so pyVmomi calls
+        InvokeMethod and InvokeAccessor on it.
+    """
+    def __init__(self, clusters=1, hosts=4, datastores=2, networks=4, vms=20, latency=0.0, task_seconds=0.01, max_running=0):
+        self.latency = latency
+        self.task_seconds = task_seconds
+        self.max_running = max_running
+        self.running = 0
+        self.queued = [] # (task, work) waiting for a free slot
+        self.calls = Counter() # 'Type.method' -> number of calls
+        self.version = 'vim.version.version8'
+        self.cookie = 'vmware_soap_session="fake-{}"'.format(uuid.uuid4()) # a session of its own, see connection.service_content
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.objects = {} # moId -> {'mo', 'props', 'changes'}
+        self.counter = 0
+        self.filters = {} # filter moId -> {'collector', 'spec', 'reported'}
+        self.tokens = {} # RetrievePropertiesEx token -> remaining ObjectContent
+        self.cancelled = set() # collectors whose WaitForUpdatesEx has to return
+        self.task_manager = self.new(vim.TaskManager, 'TaskManager', 'TaskManager', recentTask=[])
+        self.build(clusters, hosts, datastores, networks, vms)
+
+    def __deepcopy__(self, memo):
+        return self # same as SoapStubAdapter, the stub is shared, never copied
+
+    # ---- model ----
+
+    def new(self, obj_type, prefix, moid=None, **props):
+        """
+            Create a managed object in the model. Objects
+            with a fixed id in vCenter (e.g. propertyCollector)
+            get that id as moid.
+        """
+        with self.lock:
+            self.counter += 1
+            mo = obj_type(moid or '{}-{}'.format(prefix, self.counter), self)
+            self.objects[mo._moId] = {'mo': mo, 'props': props, 'changes': 0}
+        return mo
+
+    def props(self, mo):
+        if mo._moId not in self.objects:
+            raise vmodl.fault.ManagedObjectNotFound(obj=mo)
+        return self.objects[mo._moId]['props']
+
+    def touch(self, mo):
+        """
+            Mark an object as changed, wakes up WaitForUpdatesEx.
+        """
+        with self.lock:
+            if mo._moId in self.objects:
+                self.objects[mo._moId]['changes'] += 1
+            self.changed.notify_all()
+
+    def build(self, clusters, hosts, datastores, networks, vms):
+        """
+            Build the inventory: one datacenter with the
+            given number of clusters, hosts per cluster,
+            shared datastores, networks and VMs.
+        """
+        self.root = self.new(vim.Folder, 'group-d', name='Datacenters', childEntity=[])
+        dc = self.new(vim.Datacenter, 'datacenter', name='Datacenter', parent=self.root, network=[], datastore=[])
+        self.props(self.root)['childEntity'].append(dc)
+        vm_folder = self.new(vim.Folder, 'group-v', name='vm', parent=dc, childEntity=[])
+        host_folder = self.new(vim.Folder, 'group-h', name='host', parent=dc, childEntity=[])
+        net_folder = self.new(vim.Folder, 'group-n', name='network', parent=dc, childEntity=[])
+        self.props(dc).update(vmFolder=vm_folder, hostFolder=host_folder, networkFolder=net_folder)
+        self.datacenter = dc
+
+        stores = []
+        for i in range(datastores):
+            store = self.new(vim.Datastore, 'datastore', name='datastore{}'.format(i + 1), parent=dc)
+            self.props(store)['summary'] = vim.Datastore.Summary(datastore=store, name='datastore{}'.format(i + 1), url='ds:///fake/{}/'.format(i + 1),
+                                                                 capacity=16384 * GB, freeSpace=12288 * GB, accessible=True, type='NFS')
+            stores.append(store)
+        self.props(dc)['datastore'] = list(stores)
+
+        for i in range(networks):
+            self.add_network('VM Network' if i == 0 else 'VLAN{}'.format(100 + i))
+
+        for c in range(clusters):
+            cluster = self.new(vim.ClusterComputeResource, 'domain-c', name='Cluster{}'.format(c + 1), parent=host_folder,
+                               host=[], datastore=list(stores), network=list(self.props(dc)['network']))
+            pool = self.new(vim.ResourcePool, 'resgroup', name='Resources', parent=cluster, owner=cluster)
+            self.props(cluster)['resourcePool'] = pool
+            self.props(host_folder)['childEntity'].append(cluster)
+            for h in range(hosts):
+                self.add_host(cluster, 'esx{:02d}-{:02d}.lab.local'.format(c + 1, h + 1))
+            self.props(cluster)['summary'] = vim.ClusterComputeResource.Summary(
+                totalCpu=hosts * 24 * 2400, totalMemory=hosts * 256 * GB, numCpuCores=hosts * 24, numCpuThreads=hosts * 48,
+                effectiveCpu=hosts * 24 * 2200, effectiveMemory=hosts * 250 * 1024, numHosts=hosts, numEffectiveHosts=hosts,
+                overallStatus='green')
+
+        template = self.add_vm(vm_folder, 'template-ubuntu', 2, 2048, [16 * 1024 * 1024], self.first_network(), stores[0])
+        snapshot = self.new(vim.vm.Snapshot, 'snapshot', vm=template)
+        self.props(template)['snapshot'] = vim.vm.SnapshotInfo(currentSnapshot=snapshot, rootSnapshotList=[
+            vim.vm.SnapshotTree(snapshot=snapshot, vm=template, name='base', id=1, createTime=self.now(), state='poweredOff', quiesced=False)])
+        self.props(template)['config'].template = True
+        for i in range(vms):
+            vm = self.add_vm(vm_folder, 'vm{:04d}'.format(i + 1), 2, 4096, [20 * 1024 * 1024], self.first_network(), stores[i % len(stores)])
+            if i % 2 == 0: # half of the VMs are running
+                self.props(vm)['runtime'].powerState = 'poweredOn'
+
+    def first_network(self):
+        return self.props(self.datacenter)['network'][0]
+
+    def add_network(self, name, cluster=None):
+        """
+            Networks (standard port groups) are shared by
+            all hosts, like port groups with the same name
+            on several hosts are one network in vCenter.
+            The cluster of the host that got the port group
+            can reach the network from then on.
+        """
+        net = None
+        for existing in self.props(self.datacenter)['network']:
+            if self.props(existing)['name'] == name:
+                net = existing
+        if net is None:
+            net_folder = self.props(self.datacenter)['networkFolder']
+            net = self.new(vim.Network, 'network', name=name, parent=net_folder)
+            self.props(self.datacenter)['network'].append(net)
+            self.props(net_folder)['childEntity'].append(net)
+            self.touch(self.datacenter)
+        if cluster is not None and net not in self.props(cluster)['network']:
+            self.props(cluster)['network'].append(net)
+            self.touch(cluster)
+        return net
+
+    def add_host(self, cluster, name):
+        network_system = self.new(vim.host.NetworkSystem, 'networkSystem')
+        host = self.new(vim.HostSystem, 'host', name=name, parent=cluster)
+        self.props(network_system)['networkInfo'] = vim.host.NetworkInfo(
+            vswitch=vim.host.VirtualSwitch.Array([vim.host.VirtualSwitch(name='vSwitch0', key='key-vim.host.VirtualSwitch-vSwitch0', numPorts=128, mtu=1500,
+                                            pnic=['key-vim.host.PhysicalNic-vmnic0'],
+                                            spec=vim.host.VirtualSwitch.Specification(numPorts=128, mtu=1500,
+                                                 bridge=vim.host.VirtualSwitch.BondBridge(nicDevice=['vmnic0']),
+                                                 policy=vim.host.NetworkPolicy(nicTeaming=vim.host.NetworkPolicy.NicTeamingPolicy(
+                                                     policy='loadbalance_srcid',
+                                                     nicOrder=vim.host.NetworkPolicy.NicOrderPolicy(activeNic=['vmnic0'], standbyNic=[])))))]),
+            pnic=vim.host.PhysicalNic.Array([vim.host.PhysicalNic(device='vmnic{}'.format(i), key='key-vim.host.PhysicalNic-vmnic{}'.format(i))
+                                             for i in range(4)]),
+            proxySwitch=vim.host.HostProxySwitch.Array())
+        self.props(host).update(
+            configManager=vim.host.ConfigManager(networkSystem=network_system),
+            summary=vim.host.Summary(hardware=vim.host.Summary.HardwareSummary(numCpuCores=24, memorySize=256 * GB, cpuMhz=2400),
+                                     quickStats=vim.host.Summary.QuickStats(overallCpuUsage=4000, overallMemoryUsage=32 * 1024)),
+            runtime=vim.host.RuntimeInfo(connectionState='connected', inMaintenanceMode=False))
+        self.props(cluster)['host'].append(host)
+        return host
+
+    def add_vm(self, folder, name, CPU, RAM, disks, network, datastore):
+        controller = vim.vm.device.VirtualLsiLogicController(key=1000, busNumber=0, sharedBus='noSharing')
+        devices = [controller, vim.vm.device.VirtualVmxnet3(key=4000, backing=vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(
+                                                                network=network, deviceName=self.props(network)['name']))]
+        for unit, disk in enumerate(disks):
+            devices.append(vim.vm.device.VirtualDisk(key=2000 + unit, controllerKey=1000, unitNumber=unit, capacityInKB=disk))
+        return self.register_vm(folder, name, CPU, RAM, devices, datastore)
+
+    def register_vm(self, folder, name, CPU, RAM, devices, datastore, guest='ubuntu64Guest'):
+        if name in [self.props(vm)['name'] for vm in self.props(folder)['childEntity']]:
+            raise vim.fault.DuplicateName(name=name)
+        used = sum(dev.capacityInKB for dev in devices if isinstance(dev, vim.vm.device.VirtualDisk)) * 1024
+        self.props(datastore)['summary'].freeSpace -= used
+        self.touch(datastore)
+        vm = self.new(vim.VirtualMachine, 'vm', name=name, parent=folder, datastore=[datastore],
+                      config=vim.vm.ConfigInfo(name=name, guestId=guest, template=False,
+                                               hardware=vim.vm.VirtualHardware(numCPU=CPU, memoryMB=RAM,
+                                                                               device=vim.vm.device.VirtualDevice.Array(devices))),
+                      runtime=vim.vm.RuntimeInfo(powerState='poweredOff'))
+        self.props(folder)['childEntity'].append(vm)
+        self.touch(folder)
+        return vm
+
+    # ---- stub adapter ----
+
+    def InvokeMethod(self, mo, info, args):
+        self.round_trip('{}.{}'.format(mo._wsdlName, info.wsdlName))
+        handler = getattr(self, 'do_' + info.wsdlName, None)
+        if handler is None:
+            raise vmodl.fault.MethodNotFound(receiver=mo, method=info.wsdlName)
+        return handler(mo, **dict((param.name, arg) for param, arg in zip(info.params, args)))
+
+    def InvokeAccessor(self, mo, info):
+        self.round_trip('{}.{}'.format(mo._wsdlName, info.name))
+        with self.lock:
+            return typed(copy.deepcopy(self.props(mo).get(info.name)))
+
+    def round_trip(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # ---- tasks ----
+
+    def run_task(self, entity, name, work):
+        """
+            Start a task that runs work() in the background
+            after task_seconds and stores its result or fault.
+            With max_running, tasks above that number wait
+            in state "queued" like on a busy vCenter.
+        """
+        task = self.new(vim.Task, 'task')
+        with self.lock:
+            self.props(task)['info'] = vim.TaskInfo(key=task._moId, task=task, descriptionId=name, entity=entity,
+                                                    state='queued', cancelled=False, cancelable=False,
+                                                    queueTime=self.now(), progress=0)
+            recent = self.props(self.task_manager)['recentTask']
+            recent.append(task)
+            del recent[:-RECENT_TASKS]
+            self.queued.append((task, work))
+            self.start_tasks()
+        return task
+
+    def start_tasks(self):
+        """
+            Start queued tasks while there is room.
+        """
+        while self.queued and (not self.max_running or self.running < self.max_running):
+            task, work = self.queued.pop(0)
+            self.running += 1
+            info = self.props(task)['info']
+            info.state = 'running'
+            info.startTime = self.now()
+            self.touch(task)
+            timer = threading.Timer(self.task_seconds, self.finish_task, (task, work))
+            timer.daemon = True
+            timer.start()
+
+    def finish_task(self, task, work):
+        """
+            Run the work of a task and store the outcome.
+        """
+        try:
+            result = work()
+            error = None
+        except vmodl.MethodFault as fault:
+            result = None
+            error = fault
+        except Exception as err: # a bug in the model fails the task instead of leaving it running forever
+            result = None
+            error = vmodl.fault.SystemError(reason=str(err), msg=str(err))
+        with self.lock:
+            info = self.props(task)['info']
+            info.state = 'error' if error is not None else 'success'
+            info.result = result
+            info.error = error
+            info.progress = 100
+            info.completeTime = self.now()
+            self.touch(task)
+            self.running -= 1
+            self.start_tasks()
+
+    def now(self):
+        import datetime
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    # ---- ServiceInstance, sessions and views ----
+
+    @property
+    def service_instance(self):
+        si = vim.ServiceInstance('ServiceInstance', self)
+        if 'ServiceInstance' not in self.objects:
+            self.objects['ServiceInstance'] = {'mo': si, 'changes': 0, 'props': {'content': vim.ServiceInstanceContent(
+                rootFolder=self.root,
+                propertyCollector=self.new(vmodl.query.PropertyCollector, 'propertyCollector', 'propertyCollector'),
+                viewManager=self.new(vim.view.ViewManager, 'ViewManager', 'ViewManager'),
+                sessionManager=self.new(vim.SessionManager, 'SessionManager', 'SessionManager',
+                                        currentSession=vim.UserSession(key='fake', userName='administrator@vsphere.local')),
+                taskManager=self.task_manager,
+                about=vim.AboutInfo(name='Fake vCenter', fullName='Fake vCenter (bench.py)', vendor='none', version='8.0.0',
+                                    build='0', osType='linux-x64', productLineId='vpx', apiType='VirtualCenter',
+                                    apiVersion='8.0.0.0', instanceUuid=str(uuid.uuid4())))}}
+        return si
+
+    def do_RetrieveServiceContent(self, mo):
+        return copy.deepcopy(self.props(mo)['content'])
+
+    def do_CurrentTime(self, mo):
+        return self.now()
+
+    def do_Logout(self, mo):
+        with self.lock:
+            self.props(mo)['currentSession'] = None # the cookie is no longer logged in
+
+    def do_CreateContainerView(self, mo, container, type, recursive):
+        return self.new(vim.view.ContainerView, 'session[fake]view', container=container, types=list(type or []))
+
+    def do_DestroyView(self, mo):
+        with self.lock:
+            self.objects.pop(mo._moId, None)
+
+    def view_objects(self, view):
+        types = self.props(view)['types']
+        with self.lock:
+            return [entry['mo'] for entry in list(self.objects.values())
+                    if not isinstance(entry['mo'], vim.view.ContainerView) and (not types or isinstance(entry['mo'], tuple(types)))]
+
+    # ---- PropertyCollector ----
+
+    def do_CreatePropertyCollector(self, mo):
+        return self.new(vmodl.query.PropertyCollector, 'session[fake]collector')
+
+    def do_DestroyPropertyCollector(self, mo):
+        with self.lock:
+            for key in [key for key, entry in self.filters.items() if entry['collector'] == mo._moId]:
+                del self.filters[key]
+                self.objects.pop(key, None)
+            self.objects.pop(mo._moId, None)
+
+    def do_CreateFilter(self, mo, spec, partialUpdates):
+        self.props(mo) # the collector must exist
+        for obj_spec in spec.objectSet:
+            self.props(obj_spec.obj) # like vCenter, a filter on an object that is gone fails
+        prop_filter = self.new(vmodl.query.PropertyCollector.Filter, 'session[fake]filter')
+        with self.lock:
+            self.filters[prop_filter._moId] = {'collector': mo._moId, 'spec': spec, 'reported': {}}
+        return prop_filter
+
+    def do_DestroyPropertyFilter(self, mo):
+        with self.lock:
+            self.filters.pop(mo._moId, None)
+            self.objects.pop(mo._moId, None)
+
+    def selected_objects(self, spec):
+        """
+            The objects a FilterSpec points at, a ContainerView
+            with a traversal on "view" selects what is in the view.
+        """
+        selected = []
+        for obj_spec in spec.objectSet:
+            if isinstance(obj_spec.obj, vim.view.ContainerView) and obj_spec.selectSet:
+                selected.extend(self.view_objects(obj_spec.obj))
+            if not obj_spec.skip:
+                selected.append(obj_spec.obj)
+        return selected
+
+    def resolve(self, mo, path):
+        value = self.props(mo).get(path.split('.')[0])
+        for part in path.split('.')[1:]:
+            if value is None:
+                return None
+            value = getattr(value, part, None)
+        return value
+
+    def object_content(self, spec, mo):
+        """
+            The requested properties of one object, None when
+            no PropertySpec of the filter applies to it.
+        """
+        paths = []
+        for prop_spec in spec.propSet:
+            if isinstance(mo, prop_spec.type):
+                paths.extend(prop_spec.pathSet or [])
+        if not paths:
+            return None
+        props = []
+        with self.lock:
+            if mo._moId not in self.objects:
+                return None
+            for path in paths:
+                value = self.resolve(mo, path)
+                if value is not None:
+                    props.append(vmodl.DynamicProperty(name=path, val=typed(copy.deepcopy(value))))
+        return props
+
+    def do_RetrievePropertiesEx(self, mo, specSet, options):
+        objects = []
+        for spec in specSet:
+            for obj in self.selected_objects(spec):
+                props = self.object_content(spec, obj)
+                if props is not None:
+                    objects.append(vmodl.query.PropertyCollector.ObjectContent(obj=obj, propSet=props))
+        return self.page(objects, options.maxObjects if options is not None else None)
+
+    def do_ContinueRetrievePropertiesEx(self, mo, token):
+        with self.lock:
+            objects, page_size = self.tokens.pop(token)
+        return self.page(objects, page_size)
+
+    def page(self, objects, page_size):
+        result = vmodl.query.PropertyCollector.RetrieveResult(objects=objects[:page_size] if page_size else objects)
+        if page_size and len(objects) > page_size:
+            with self.lock:
+                self.counter += 1
+                token = 'token-{}'.format(self.counter)
+                self.tokens[token] = (objects[page_size:], page_size)
+            result.token = token
+        return result
+
+    def collect_changes(self, collector):
+        """
+            Everything that changed for the filters of a
+            collector since it was last reported.
+        """
+        filter_updates = []
+        for filter_id, entry in list(self.filters.items()):
+            if entry['collector'] != collector._moId:
+                continue
+            updates = []
+            current = {}
+            for obj in self.selected_objects(entry['spec']):
+                if obj._moId not in self.objects:
+                    continue
+                changes = self.objects[obj._moId]['changes']
+                current[obj._moId] = changes
+                last = entry['reported'].get(obj._moId)
+                if last == changes:
+                    continue
+                props = self.object_content(entry['spec'], obj)
+                if props is None:
+                    continue
+                updates.append(vmodl.query.PropertyCollector.ObjectUpdate(
+                    kind='enter' if last is None else 'modify', obj=obj,
+                    changeSet=[vmodl.query.PropertyCollector.Change(name=prop.name, op='assign', val=prop.val) for prop in props]))
+            for moid in entry['reported']:
+                if moid not in current:
+                    updates.append(vmodl.query.PropertyCollector.ObjectUpdate(kind='leave', obj=vim.ManagedEntity(moid, self), changeSet=[]))
+            entry['reported'] = current
+            if updates:
+                filter_updates.append(vmodl.query.PropertyCollector.FilterUpdate(
+                    filter=vmodl.query.PropertyCollector.Filter(filter_id, self), objectSet=updates))
+        return filter_updates
+
+    def do_CancelWaitForUpdates(self, mo):
+        with self.lock:
+            self.cancelled.add(mo._moId)
+            self.changed.notify_all()
+
+    def do_WaitForUpdatesEx(self, mo, version, options):
+        self.props(mo) # the collector must exist
+        max_wait = options.maxWaitSeconds if options is not None and options.maxWaitSeconds is not None else 60
+        deadline = time.time() + max_wait
+        with self.lock:
+            while True:
+                if mo._moId in self.cancelled:
+                    self.cancelled.discard(mo._moId)
+                    raise vmodl.fault.RequestCanceled()
+                filter_updates = self.collect_changes(mo)
+                if filter_updates:
+                    self.counter += 1
+                    return vmodl.query.PropertyCollector.UpdateSet(version=str(self.counter), filterSet=filter_updates, truncated=False)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+
+    # ---- virtual machines ----
+
+    def apply_devices(self, devices, changes, datastore=None):
+        """
+            Apply the deviceChange of a ConfigSpec to a list
+            of devices. Temporary (negative) keys are replaced
+            by real ones, also in controllerKey. Two devices
+            on the same unit of a controller are refused.
+        """
+        devices = list(copy.deepcopy(devices))
+        keys = {}
+        next_key = max([dev.key for dev in devices] + [5000]) + 1
+        for change in changes or []:
+            device = copy.deepcopy(change.device)
+            if change.operation == 'add':
+                if device.key is None or device.key <= 0:
+                    keys[device.key] = next_key
+                    device.key = next_key
+                    next_key += 1
+                devices.append(device)
+            elif change.operation == 'edit':
+                devices = [device if dev.key == device.key else dev for dev in devices]
+            elif change.operation == 'remove':
+                devices = [dev for dev in devices if dev.key != device.key]
+        for device in devices:
+            if getattr(device, 'controllerKey', None) in keys:
+                device.controllerKey = keys[device.controllerKey]
+        units = [(device.controllerKey, device.unitNumber) for device in devices
+                 if getattr(device, 'controllerKey', None) is not None and device.unitNumber is not None]
+        for index, unit in enumerate(units):
+            if unit in units[:index]: # like vCenter, two devices cannot share a unit of a controller
+                raise vim.fault.InvalidDeviceSpec(property='unitNumber', deviceIndex=index,
+                                                  msg='Unit {} of controller {} is already in use.'.format(unit[1], unit[0]))
+        return vim.vm.device.VirtualDevice.Array(devices)
+
+    def datastore_from_path(self, path):
+        match = re.match(r'\[(.*?)\]', path or '')
+        for store in self.props(self.datacenter)['datastore']:
+            if match and self.props(store)['name'] == match.group(1):
+                return store
+        return self.props(self.datacenter)['datastore'][0]
+
+    def do_CreateVM_Task(self, mo, config, pool, host):
+        def work():
+            with self.lock:
+                devices = self.apply_devices([], config.deviceChange)
+                return self.register_vm(mo, config.name, config.numCPUs, config.memoryMB, devices,
+                                        self.datastore_from_path(config.files.vmPathName if config.files else None),
+                                        config.guestId)
+        return self.run_task(mo, 'CreateVM_Task', work)
+
+    def do_ReconfigVM_Task(self, mo, spec):
+        def work():
+            with self.lock:
+                config = self.props(mo)['config']
+                config.hardware.device = self.apply_devices(config.hardware.device, spec.deviceChange)
+                if spec.numCPUs:
+                    config.hardware.numCPU = spec.numCPUs
+                if spec.memoryMB:
+                    config.hardware.memoryMB = spec.memoryMB
+                self.touch(mo)
+        return self.run_task(mo, 'ReconfigVM_Task', work)
+
+    def do_CloneVM_Task(self, mo, folder, name, spec):
+        def work():
+            with self.lock:
+                source = self.props(mo)['config']
+                changes = spec.config.deviceChange if spec.config else []
+                devices = self.apply_devices(source.hardware.device, changes)
+                if spec.location.diskMoveType == 'createNewChildDiskBacking': # linked clone, only the new disks take space
+                    shared = [dev.key for dev in source.hardware.device if isinstance(dev, vim.vm.device.VirtualDisk)]
+                    linked = [dev for dev in devices if dev.key in shared]
+                    devices = [dev for dev in devices if dev.key not in shared]
+                else:
+                    linked = []
+                CPU = spec.config.numCPUs if spec.config and spec.config.numCPUs else source.hardware.numCPU
+                RAM = spec.config.memoryMB if spec.config and spec.config.memoryMB else source.hardware.memoryMB
+                vm = self.register_vm(folder, name, CPU, RAM, devices,
+                                      spec.location.datastore or self.props(mo)['datastore'][0], source.guestId)
+                self.props(vm)['config'].hardware.device.extend(linked)
+                return vm
+        return self.run_task(mo, 'CloneVM_Task', work)
+
+    def do_PowerOffVM_Task(self, mo):
+        def work():
+            with self.lock:
+                runtime = self.props(mo)['runtime']
+                if runtime.powerState == 'poweredOff':
+                    raise vim.fault.InvalidPowerState(existingState='poweredOff', requestedState='poweredOff')
+                runtime.powerState = 'poweredOff'
+                self.touch(mo)
+        return self.run_task(mo, 'PowerOffVM_Task', work)
+
+    def do_Destroy_Task(self, mo):
+        def work():
+            with self.lock:
+                props = self.props(mo)
+                if props['runtime'].powerState != 'poweredOff':
+                    raise vim.fault.InvalidPowerState(existingState=props['runtime'].powerState, requestedState='poweredOff')
+                folder = props['parent']
+                self.props(folder)['childEntity'] = [vm for vm in self.props(folder)['childEntity'] if vm._moId != mo._moId]
+                for store in props.get('datastore', []):
+                    used = sum(dev.capacityInKB for dev in props['config'].hardware.device if isinstance(dev, vim.vm.device.VirtualDisk))
+                    self.props(store)['summary'].freeSpace += used * 1024
+                    self.touch(store)
+                del self.objects[mo._moId]
+                self.touch(folder)
+        return self.run_task(mo, 'Destroy_Task', work)
+
+    # ---- host networking ----
+
+    def network_info(self, mo):
+        return self.props(mo)['networkInfo']
+
+    def cluster_of(self, network_system):
+        for entry in list(self.objects.values()):
+            if isinstance(entry['mo'], vim.HostSystem) and entry['props']['configManager'].networkSystem == network_system:
+                return entry['props']['parent']
+        return None
+
+    def check_teaming(self, spec):
+        uplinks = getattr(spec.bridge, 'nicDevice', None) or []
+        nic_order = getattr(getattr(spec.policy, 'nicTeaming', None), 'nicOrder', None)
+        for nic in list(getattr(nic_order, 'activeNic', None) or []) + list(getattr(nic_order, 'standbyNic', None) or []):
+            if nic not in uplinks: # like ESXi, the teaming order may only name uplinks of the switch
+                raise vmodl.fault.InvalidArgument(invalidProperty='spec.policy.nicTeaming.nicOrder')
+
+    def add_switch(self, mo, name, spec):
+        self.check_teaming(spec)
+        info = self.network_info(mo)
+        if name in [vswitch.name for vswitch in info.vswitch]:
+            raise vim.fault.AlreadyExists(name=name)
+        info.vswitch.append(vim.host.VirtualSwitch(name=name, key='key-vim.host.VirtualSwitch-' + name, numPorts=spec.numPorts,
+                                                   mtu=spec.mtu, spec=copy.deepcopy(spec)))
+
+    def edit_switch(self, mo, name, spec):
+        self.check_teaming(spec)
+        for vswitch in self.network_info(mo).vswitch:
+            if vswitch.name == name:
+                vswitch.spec = copy.deepcopy(spec)
+                vswitch.numPorts = spec.numPorts
+                vswitch.mtu = spec.mtu
+                return
+        raise vim.fault.NotFound()
+
+    def add_group(self, mo, spec):
+        info = self.network_info(mo)
+        if spec.vswitchName not in [vswitch.name for vswitch in info.vswitch]:
+            raise vim.fault.NotFound()
+        if spec.name in [portgroup.spec.name for portgroup in info.portgroup]:
+            raise vim.fault.AlreadyExists(name=spec.name)
+        info.portgroup.append(vim.host.PortGroup(key='key-vim.host.PortGroup-' + spec.name,
+                                                 vswitch='key-vim.host.VirtualSwitch-' + spec.vswitchName, spec=copy.deepcopy(spec)))
+        self.add_network(spec.name, self.cluster_of(mo))
+
+    def edit_group(self, mo, spec):
+        for portgroup in self.network_info(mo).portgroup:
+            if portgroup.spec.name == spec.name:
+                portgroup.spec = copy.deepcopy(spec)
+                return
+        raise vim.fault.NotFound()
+
+    def do_AddVirtualSwitch(self, mo, vswitchName, spec):
+        with self.lock:
+            self.add_switch(mo, vswitchName, spec)
+            self.touch(mo)
+
+    def do_AddPortGroup(self, mo, portgrp):
+        with self.lock:
+            self.add_group(mo, portgrp)
+            self.touch(mo)
+
+    def do_UpdateNetworkConfig(self, mo, config, changeMode):
+        with self.lock:
+            before = copy.deepcopy(self.network_info(mo))
+            try:
+                for portgroup in config.portgroup or []: # port groups go first, a vSwitch with port groups cannot be removed
+                    if portgroup.changeOperation == 'remove':
+                        self.remove_group(mo, portgroup.spec.name)
+                for vswitch in config.vswitch or []:
+                    if vswitch.changeOperation == 'add':
+                        self.add_switch(mo, vswitch.name, vswitch.spec)
+                    elif vswitch.changeOperation == 'remove':
+                        self.remove_switch(mo, vswitch.name)
+                    else:
+                        self.edit_switch(mo, vswitch.name, vswitch.spec)
+                for portgroup in config.portgroup or []:
+                    if portgroup.changeOperation == 'add':
+                        self.add_group(mo, portgroup.spec)
+                    elif portgroup.changeOperation != 'remove':
+                        self.edit_group(mo, portgroup.spec)
+            except vmodl.MethodFault:
+                self.props(mo)['networkInfo'] = before # all or nothing, like the real call
+                raise
+            self.touch(mo)
+        return vim.host.NetworkConfig.Result()
+
+    def remove_group(self, mo, name):
+        info = self.network_info(mo)
+        if name not in [portgroup.spec.name for portgroup in info.portgroup]:
+            raise vim.fault.NotFound()
+        info.portgroup = vim.host.PortGroup.Array([portgroup for portgroup in info.portgroup if portgroup.spec.name != name])
+
+    def remove_switch(self, mo, name):
+        info = self.network_info(mo)
+        if name not in [vswitch.name for vswitch in info.vswitch]:
+            raise vim.fault.NotFound()
+        if [portgroup for portgroup in info.portgroup if portgroup.spec.vswitchName == name]:
+            raise vim.fault.ResourceInUse()
+        info.vswitch = vim.host.VirtualSwitch.Array([vswitch for vswitch in info.vswitch if vswitch.name != name])
+
+    def do_RemovePortGroup(self, mo, pgName):
+        with self.lock:
+            self.remove_group(mo, pgName)
+            self.touch(mo)
+
+    def do_RemoveVirtualSwitch(self, mo, vswitchName):
+        with self.lock:
+            self.remove_switch(mo, vswitchName)
+            self.touch(mo)
+
+    # ---- Distributed switches ----
+
+    def check_version(self, config, spec):
+        if spec.configVersion != config.configVersion: # someone else changed it since it was read
+            raise vim.fault.ConcurrentAccess()
+        config.configVersion = str(int(config.configVersion) + 1)
+
+    def apply_members(self, dvs, members):
+        config = self.props(dvs)['config']
+        current = dict((member.config.host._moId, member) for member in config.host)
+        for spec in members or []:
+            network_info = self.network_info(self.props(spec.host)['configManager'].networkSystem)
+            backing = copy.deepcopy(spec.backing) or vim.dvs.HostMember.PnicBacking(pnicSpec=[])
+            proxies = [proxy for proxy in network_info.proxySwitch if proxy.dvsUuid == config.uuid]
+            if spec.operation == 'add':
+                if spec.host._moId in current:
+                    raise vim.fault.AlreadyExists(name=spec.host._moId)
+                member = vim.dvs.HostMember(config=vim.dvs.HostMember.ConfigInfo(host=spec.host, backing=backing),
+                                            status='up')
+                config.host.append(member)
+                current[spec.host._moId] = member
+                network_info.proxySwitch.append(vim.host.HostProxySwitch(dvsUuid=config.uuid, dvsName=config.name, key=config.uuid,
+                                                 numPorts=512, spec=vim.host.HostProxySwitch.Specification(backing=copy.deepcopy(backing))))
+            elif spec.host._moId not in current:
+                raise vim.fault.NotFound()
+            elif spec.operation == 'edit':
+                current[spec.host._moId].config.backing = backing
+                proxies[0].spec.backing = copy.deepcopy(backing)
+            else:
+                config.host.remove(current.pop(spec.host._moId))
+                network_info.proxySwitch.remove(proxies[0])
+            self.touch(self.props(spec.host)['configManager'].networkSystem)
+
+    def do_CreateDVS_Task(self, mo, spec):
+        def work():
+            with self.lock:
+                name = spec.configSpec.name
+                if name in [self.props(child)['name'] for child in self.props(mo)['childEntity']]:
+                    raise vim.fault.DuplicateName(name=name)
+                dvs_uuid = str(uuid.uuid4())
+                dvs = self.new(vim.dvs.VmwareDistributedVirtualSwitch, 'dvs', name=name, parent=mo, uuid=dvs_uuid, portgroup=[],
+                               config=vim.dvs.VmwareDistributedVirtualSwitch.ConfigInfo(name=name, uuid=dvs_uuid, configVersion='1',
+                                   maxMtu=spec.configSpec.maxMtu or 1500, numPorts=0, maxPorts=60000, numStandalonePorts=0,
+                                   host=vim.dvs.HostMember.Array(), createTime=self.now()))
+                self.props(mo)['childEntity'].append(dvs)
+                self.apply_members(dvs, spec.configSpec.host)
+                self.touch(mo)
+                return dvs
+        return self.run_task(mo, 'CreateDVS_Task', work)
+
+    def do_ReconfigureDvs_Task(self, mo, spec):
+        def work():
+            with self.lock:
+                config = self.props(mo)['config']
+                before = copy.deepcopy(config)
+                self.check_version(config, spec)
+                try:
+                    self.apply_members(mo, spec.host)
+                except vmodl.MethodFault:
+                    self.props(mo)['config'] = before
+                    raise
+                if spec.maxMtu:
+                    config.maxMtu = spec.maxMtu
+                self.touch(mo)
+        return self.run_task(mo, 'ReconfigureDvs_Task', work)
+
+    def do_AddDVPortgroup_Task(self, mo, spec):
+        def work():
+            with self.lock:
+                if [pg_spec.name for pg_spec in spec if pg_spec.name in [self.props(net)['name'] for net in self.props(self.datacenter)['network']]]:
+                    raise vim.fault.DuplicateName(name=spec[0].name)
+                net_folder = self.props(self.datacenter)['networkFolder']
+                for pg_spec in spec:
+                    port_group = self.new(vim.dvs.DistributedVirtualPortgroup, 'dvportgroup', name=pg_spec.name, parent=net_folder)
+                    self.props(port_group).update(key=port_group._moId, config=vim.dvs.DistributedVirtualPortgroup.ConfigInfo(
+                        key=port_group._moId, name=pg_spec.name, numPorts=pg_spec.numPorts or 8, type=pg_spec.type or 'earlyBinding',
+                        distributedVirtualSwitch=mo, defaultPortConfig=copy.deepcopy(pg_spec.defaultPortConfig), configVersion='1'))
+                    self.props(mo)['portgroup'].append(port_group)
+                    self.props(net_folder)['childEntity'].append(port_group)
+                    self.props(self.datacenter)['network'].append(port_group)
+                    for entry in list(self.objects.values()):
+                        if isinstance(entry['mo'], vim.ClusterComputeResource):
+                            entry['props']['network'].append(port_group)
+                            self.touch(entry['mo'])
+                self.touch(mo)
+                self.touch(self.datacenter)
+        return self.run_task(mo, 'AddDVPortgroup_Task', work)
+
+    def do_ReconfigureDVPortgroup_Task(self, mo, spec):
+        def work():
+            with self.lock:
+                config = self.props(mo)['config']
+                self.check_version(config, spec)
+                if spec.numPorts is not None:
+                    config.numPorts = spec.numPorts
+                if spec.defaultPortConfig is not None:
+                    config.defaultPortConfig = copy.deepcopy(spec.defaultPortConfig)
+                self.touch(mo)
+        return self.run_task(mo, 'ReconfigureDVPortgroup_Task', work)
@@ -0,0 +1,149 @@
+#! /usr/bin/python3
+
+# Inventory snapshot for create_vm.py and create_vswitch.py.
+# Reading vm.name or datastore.summary one attribute at a time
+# costs one SOAP round-trip per access. Here everything the
+# scripts need is fetched with one PropertyCollector request
+# through a ContainerView and kept in memory, indexed by type
+# and by name.
+
+from pyVmomi import vim, vmodl
+from connection import service
+
+# Properties fetched for every type, name and parent are always included
+PROPERTIES = {
+    vim.Datacenter: ['vmFolder', 'hostFolder', 'networkFolder', 'network', 'datastore'],
+    vim.ClusterComputeResource: ['resourcePool', 'host', 'datastore', 'network',
+                                 'summary.numCpuCores', 'summary.effectiveMemory', 'summary.effectiveCpu'],
+    vim.HostSystem: ['configManager.networkSystem', 'summary.hardware.numCpuCores',
+                     'summary.hardware.memorySize', 'summary.hardware.cpuMhz', 'runtime.connectionState', 'runtime.inMaintenanceMode',
+                     'summary.quickStats.overallCpuUsage', 'summary.quickStats.overallMemoryUsage'],
+    vim.Datastore: ['summary.freeSpace', 'summary.capacity', 'summary.accessible'],
+    vim.Network: [],
+    vim.dvs.DistributedVirtualPortgroup: ['key', 'config.distributedVirtualSwitch'], # indexed as Network (comes first), these are the extra properties
+    vim.DistributedVirtualSwitch: ['uuid'],
+    vim.VirtualMachine: [],
+    vim.Folder: [], # only needed to walk from an object up to its datacenter
+}
+
+PAGE_SIZE = 1000 # objects per RetrievePropertiesEx page
+
+def type_name(obj_type):
+    """
+        The name used as key in the indexes, e.g.
+        vim.ClusterComputeResource -> 'ClusterComputeResource'
+    """
+    return obj_type._wsdlName
+
+def retrieve(connection, properties):
+    """
+        Fetch the given properties for all objects of the
+        given types below the root folder with one request
+        (plus one ContinueRetrievePropertiesEx per extra
+        page on very large inventories).
+
+        Returns a list of (object, {property: value}).
+    """
+    view = service(connection, 'viewManager').CreateContainerView(service(connection, 'rootFolder'), list(properties.keys()), True)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(name='view', type=vim.view.ContainerView, path='view', skip=False)
+        obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=['name', 'parent'] + paths)
+                      for obj_type, paths in properties.items()]
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs)
+        return collect(service(connection, 'propertyCollector'), filter_spec)
+    finally:
+        view.Destroy()
+
+def collect(collector, filter_spec):
+    """
+        Run RetrievePropertiesEx for a filter and follow
+        the pages. Returns a list of (object, {property: value}).
+    """
+    result = collector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=PAGE_SIZE))
+    objects = []
+    while result is not None:
+        for obj_content in result.objects:
+            objects.append((obj_content.obj, dict((prop.name, prop.val) for prop in obj_content.propSet or [])))
+        if not result.token: # no more pages
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return objects
+
+def retrieve_properties(connection, objects, obj_type, paths):
+    """
+        Fetch properties that are not part of the snapshot
+        (e.g. the network configuration of hosts) for a known
+        list of objects, with one request for all of them.
+
+        Returns a dictionary: object -> {property: value}
+    """
+    if not objects:
+        return {}
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objects]
+    filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=paths)]
+    return dict(collect(service(connection, 'propertyCollector'), filter_spec))
+
+def build_index(objects, types):
+    """
+        Build the in-memory indexes for a list of
+        (object, properties) as returned by retrieve.
+    """
+    inventory = {
+        'objects': {}, # object -> properties (including 'type')
+        'by_type': dict((type_name(obj_type), []) for obj_type in types), # type -> [object, ...]
+        'by_name': dict((type_name(obj_type), {}) for obj_type in types) # type -> {name: object}
+    }
+    for obj, props in objects:
+        # index on the requested type, a DistributedVirtualPortgroup is also a Network
+        matching = [obj_type for obj_type in types if isinstance(obj, obj_type)]
+        if not matching:
+            continue
+        props['type'] = type_name(matching[0])
+        inventory['objects'][obj] = props
+        inventory['by_type'][props['type']].append(obj)
+        inventory['by_name'][props['type']].setdefault(props.get('name'), obj) # keep the first one on duplicate names
+    return inventory
+
+def take_inventory(connection, properties=PROPERTIES):
+    """
+        Take a snapshot of the inventory. Every check and
+        lookup in the scripts reads from this dictionary
+        instead of walking the managed objects.
+    """
+    return build_index(retrieve(connection, properties), list(properties.keys()))
+
+def get(inventory, obj, prop, default=None):
+    """
+        Read a property of an object from the snapshot.
+    """
+    return inventory['objects'].get(obj, {}).get(prop, default)
+
+def find(inventory, obj_type, name):
+    """
+        Find an object by type and name, None if it does not exist.
+    """
+    return inventory['by_name'].get(type_name(obj_type), {}).get(name)
+
+def all_of(inventory, obj_type):
+    """
+        All objects of a type, in the order vCenter returned them.
+    """
+    return inventory['by_type'].get(type_name(obj_type), [])
+
+def first(inventory, obj_type):
+    """
+        The first object of a type (e.g. "the" datacenter
+        or cluster in a lab with only one of each).
+    """
+    objects = all_of(inventory, obj_type)
+    if objects:
+        return objects[0]
+    return None
+
+def names(inventory, obj_type):
+    """
+        Set of all names used by objects of a type.
+    """
+    return set(inventory['by_name'].get(type_name(obj_type), {}).keys())
@@ -0,0 +1,192 @@
+#! /usr/bin/python3
+
+# On-disk cache for the inventory snapshot (see inventory.py).
+# The snapshot is stored in a SQLite file, one row per managed
+# object, keyed by the vCenter instance UUID. Together with the
+# rows the PropertyCollector version is stored, so the next run
+# only asks vCenter for what changed since the last run
+# (WaitForUpdatesEx with the old version) instead of downloading
+# the whole inventory again.
+#
+# A PropertyCollector and its version only live as long as the
+# vCenter session that created them. When the session is gone
+# (or the collector was destroyed) the cache is rebuilt with a
+# full sync, so the cache can never be used while it is stale.
+# The collector and view of the previous run are destroyed before
+# new ones are made, so a full sync does not leave them behind.
+#
+# The cache file can be moved with the VMWARE_SCRIPTS_CACHE
+# environment variable, an empty value turns the cache off.
+
+import os
+import json
+import hashlib
+import sqlite3
+from pyVmomi import vim, vmodl, VmomiSupport
+from inventory import PROPERTIES, build_index, type_name, take_inventory
+from connection import service, service_content
+
+CACHE_FILE = os.environ.get('VMWARE_SCRIPTS_CACHE', os.path.join(os.path.expanduser('~'), '.vmware-scripts', 'inventory.db'))
+
+def open_cache(path=CACHE_FILE):
+    """
+        Open (and create if needed) the cache database.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    db = sqlite3.connect(path)
+    columns = [row[1] for row in db.execute('PRAGMA table_info(state)')]
+    if columns and 'view' not in columns: # cache of an older version, it is rebuilt with a full sync
+        db.execute('DROP TABLE state')
+    db.execute('CREATE TABLE IF NOT EXISTS state (instance_uuid TEXT PRIMARY KEY, spec TEXT, collector TEXT, view TEXT, version TEXT)')
+    db.execute('CREATE TABLE IF NOT EXISTS objects (instance_uuid TEXT, type TEXT, moid TEXT, props TEXT, PRIMARY KEY (instance_uuid, type, moid))')
+    return db
+
+def spec_hash(properties):
+    """
+        Fingerprint of the property list, a cache
+        built for other properties cannot be reused.
+    """
+    text = json.dumps(sorted((type_name(obj_type), sorted(paths)) for obj_type, paths in properties.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def encode(value):
+    """
+        Convert a property value into something JSON
+        can store. Managed objects are stored as their
+        type and moref id.
+    """
+    if isinstance(value, VmomiSupport.ManagedObject):
+        return {'_moref': [value._wsdlName, value._moId]}
+    if isinstance(value, (list, tuple)):
+        return [encode(item) for item in value]
+    return value
+
+def decode(value, stub):
+    """
+        Reverse of encode, managed objects are bound
+        to the stub of the current connection.
+    """
+    if isinstance(value, dict) and '_moref' in value:
+        return VmomiSupport.GetWsdlType('urn:vim25', value['_moref'][0])(value['_moref'][1], stub)
+    if isinstance(value, list):
+        return [decode(item, stub) for item in value]
+    return value
+
+def create_collector(connection, properties):
+    """
+        Create a PropertyCollector that watches every object
+        in the inventory. It is not destroyed at the end of
+        the run, the next run continues from its version.
+
+        Returns a tuple: (collector, container view)
+    """
+    collector = service(connection, 'propertyCollector').CreatePropertyCollector()
+    view = service(connection, 'viewManager').CreateContainerView(service(connection, 'rootFolder'), list(properties.keys()), True)
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='view', type=vim.view.ContainerView, path='view', skip=False)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_specs = [vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=['name', 'parent'] + paths)
+                  for obj_type, paths in properties.items()]
+    collector.CreateFilter(vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=prop_specs), True)
+    return collector, view
+
+def destroy_collector(stub, collector_id, view_id):
+    """
+        Remove the collector (and with it its filter) and the
+        view of an earlier run. They may already be gone
+        together with their session.
+    """
+    try:
+        vmodl.query.PropertyCollector(collector_id, stub).DestroyPropertyCollector()
+    except vmodl.MethodFault: # ManagedObjectNotFound, nothing left to clean up
+        pass
+    try:
+        vim.view.ContainerView(view_id, stub).DestroyView()
+    except vmodl.MethodFault:
+        pass
+
+def collect_updates(collector, version):
+    """
+        Ask the collector for every change since version.
+        With an empty version this is the full inventory.
+        Returns (new version, list of ObjectUpdate).
+    """
+    updates = []
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0) # do not block, only return what is there
+    while True:
+        update = collector.WaitForUpdatesEx(version, options)
+        if update is None: # nothing (more) changed
+            return version, updates
+        version = update.version
+        for filter_update in update.filterSet:
+            updates.extend(filter_update.objectSet)
+        if not update.truncated:
+            return version, updates
+
+def apply_updates(db, instance_uuid, updates):
+    """
+        Write the changes of a list of ObjectUpdate into
+        the objects table.
+    """
+    for obj_update in updates:
+        key = (instance_uuid, obj_update.obj._wsdlName, obj_update.obj._moId)
+        if obj_update.kind == 'leave': # object was removed from the inventory
+            db.execute('DELETE FROM objects WHERE instance_uuid=? AND type=? AND moid=?', key)
+            continue
+
+        row = db.execute('SELECT props FROM objects WHERE instance_uuid=? AND type=? AND moid=?', key).fetchone()
+        props = json.loads(row[0]) if row and obj_update.kind == 'modify' else {}
+        for change in obj_update.changeSet:
+            if change.op in ('remove', 'indirectRemove'):
+                props.pop(change.name, None)
+            else:
+                props[change.name] = encode(change.val)
+        db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)', key + (json.dumps(props),))
+
+def load_objects(db, instance_uuid, stub):
+    """
+        Read the cached objects back as (object, properties).
+    """
+    objects = []
+    for obj_type, moid, props in db.execute('SELECT type, moid, props FROM objects WHERE instance_uuid=?', (instance_uuid,)):
+        props = dict((name, decode(value, stub)) for name, value in json.loads(props).items())
+        objects.append((VmomiSupport.GetWsdlType('urn:vim25', obj_type)(moid, stub), props))
+    return objects
+
+def cached_inventory(connection, properties=PROPERTIES, path=CACHE_FILE):
+    """
+        Same snapshot as inventory.take_inventory, but only
+        the changes since the previous run are downloaded
+        when the previous collector is still alive.
+    """
+    if not path: # cache turned off
+        return take_inventory(connection, properties)
+    stub = connection._stub
+    instance_uuid = service_content(connection).about.instanceUuid
+    fingerprint = spec_hash(properties)
+    db = open_cache(path)
+    try:
+        state = db.execute('SELECT spec, collector, view, version FROM state WHERE instance_uuid=?', (instance_uuid,)).fetchone()
+        updates = None
+        if state and state[0] == fingerprint:
+            try: # continue from where the last run stopped
+                collector = vmodl.query.PropertyCollector(state[1], stub)
+                view = vim.view.ContainerView(state[2], stub)
+                version, updates = collect_updates(collector, state[3])
+            except vmodl.MethodFault: # e.g. ManagedObjectNotFound or InvalidCollectorVersion
+                updates = None # session or collector is gone, fall back to a full sync
+
+        if updates is None: # full sync into an empty cache
+            if state:
+                destroy_collector(stub, state[1], state[2]) # an InvalidCollectorVersion or a new spec leaves them alive
+            db.execute('DELETE FROM objects WHERE instance_uuid=?', (instance_uuid,))
+            collector, view = create_collector(connection, properties)
+            version, updates = collect_updates(collector, '')
+
+        apply_updates(db, instance_uuid, updates)
+        db.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?, ?)', (instance_uuid, fingerprint, collector._moId, view._moId, version))
+        db.commit()
+        return build_index(load_objects(db, instance_uuid, stub), list(properties.keys()))
+    finally:
+        db.close()
@@ -0,0 +1,175 @@
+#! /usr/bin/python3
+
+# Write-ahead journal for batch runs, so a run that crashed or was
+# interrupted can be resumed instead of started over.
+#
+# Every batch run writes an append-only JSONL file: first what the
+# run needs to be repeated ("run"), then every item it is going to
+# work on ("planned", a VM or a host, with the steps a VM takes, e.g.
+# create and then its disks), then, as they happen, every vCenter task
+# of an item ("started", with the step and the task moref), the
+# outcome of that step ("step_finished") and the outcome of the item
+# ("finished"). Every line is flushed and synced to disk before the
+# script goes on. The records come from the events of tasks.py and
+# the batch loops (see events.py), so the journal follows whatever
+# the scripts report.
+#
+# An item with steps is only done when its last step has a success
+# record (see item_done). "create_vm.py --resume" and
+# "create_vswitch.py --resume" read the journal, re-attach to tasks
+# that were still running, skip what is done and only redo the rest.
+#
+# Journals are kept in ~/.vmware-scripts/journal, the directory can
+# be moved with the VMWARE_SCRIPTS_JOURNAL environment variable, an
+# empty value turns the journal off.
+
+import os
+import json
+import threading
+import datetime
+from events import add_listener, remove_listener, timestamp
+
+JOURNAL_DIR = os.environ.get('VMWARE_SCRIPTS_JOURNAL', os.path.join(os.path.expanduser('~'), '.vmware-scripts', 'journal'))
+
+journal = None # the journal of this run, see start_journal
+lock = threading.Lock()
+
+def write(kind, **fields):
+    """
+        Append one record to the journal and make
+        sure it is on disk before going on.
+    """
+    with lock:
+        if journal is None:
+            return
+        fields['record'] = kind
+        fields['ts'] = timestamp()
+        journal['file'].write(json.dumps(fields, default=str, sort_keys=True) + '\n')
+        journal['file'].flush()
+        os.fsync(journal['file'].fileno())
+
+def on_event(event, fields):
+    """
+        Listener for the events: the task of an item
+        and the outcome of an item go to the journal.
+    """
+    if journal is None:
+        return
+    if event == 'task_submitted' and fields.get('name') is not None:
+        journal['tasks'][fields.get('task')] = (fields['name'], fields.get('step'))
+        write('started', name=fields['name'], step=fields.get('step'), task=fields.get('task'))
+    elif event == 'task_completed' and fields.get('task') in journal['tasks']:
+        name, step = journal['tasks'].pop(fields['task'])
+        write('step_finished', name=name, step=step, task=fields['task'], state=fields.get('state'), error=fields.get('error'))
+    elif event == 'item_completed':
+        write('finished', name=fields.get('name'), state=fields.get('state'), error=fields.get('error'), status=fields.get('status'))
+
+def start_journal(script, run, items, path=None, steps=None):
+    """
+        Start the journal of a batch run.
+        run: what a resume needs to repeat the run (JSON).
+        items: name -> specification (JSON) of everything
+            the run is going to do.
+        steps: name -> list of the steps (task names) of an
+            item, in order.
+        With path an existing journal is continued (resume),
+        only the items are added again.
+
+        Returns the path of the journal, None when the
+        journal is turned off.
+    """
+    global journal
+    if not JOURNAL_DIR and path is None:
+        return None
+    if path is None:
+        if not os.path.isdir(JOURNAL_DIR):
+            os.makedirs(JOURNAL_DIR)
+        path = os.path.join(JOURNAL_DIR, '{}-{}-{}.jsonl'.format(script, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        continued = False
+    else:
+        continued = True
+    with lock:
+        journal = {'path': path, 'file': open(path, 'a'), 'tasks': {}} # tasks: task moref -> (name, step)
+    if continued == False:
+        write('run', script=script, run=run)
+    else:
+        write('resumed', script=script)
+    for name, spec in items.items():
+        write('planned', name=name, spec=spec, steps=(steps or {}).get(name))
+    add_listener(on_event)
+    return path
+
+def stop_journal():
+    """
+        Close the journal of this run.
+    """
+    global journal
+    remove_listener(on_event)
+    with lock:
+        if journal is not None:
+            journal['file'].close()
+        journal = None
+
+def load_journal(path):
+    """
+        Replay a journal.
+
+        Returns a dictionary: {'script', 'run', 'items'} where
+        items is name -> {'spec', 'steps', 'completed', 'task',
+        'step', 'state', 'error'} in the order the items were
+        planned. completed are the steps with a success record,
+        task and step belong to the last task that was started.
+        state is None while an item has not finished.
+    """
+    state = {'script': None, 'run': None, 'items': {}}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError: # the last line of a run that crashed while writing it
+                continue
+            if record['record'] == 'run':
+                state['script'] = record['script']
+                state['run'] = record['run']
+            elif record['record'] == 'planned':
+                item = state['items'].setdefault(record['name'], {'spec': None, 'steps': None, 'completed': [], 'task': None,
+                                                                  'step': None, 'state': None, 'error': None})
+                item.update(spec=record['spec'], steps=record.get('steps'))
+            elif record['record'] == 'started' and record['name'] in state['items']:
+                item = state['items'][record['name']]
+                if item['steps'] and record.get('step') == item['steps'][0]: # the item is started over
+                    item['completed'] = []
+                item.update(task=record['task'], step=record.get('step'), state=None, error=None) # a new task, whatever happened before
+            elif record['record'] == 'step_finished' and record['name'] in state['items']:
+                item = state['items'][record['name']]
+                if record['state'] == 'success':
+                    item['completed'].append(record['step'])
+                else:
+                    item.update(state='error', error=record['error'])
+            elif record['record'] == 'finished' and record['name'] in state['items']:
+                state['items'][record['name']].update(state=record['state'], error=record.get('error') or record.get('status'))
+    return state
+
+def item_done(item):
+    """
+        True when an item of load_journal is done: its last
+        step has a success record, or, for items without
+        steps (hosts), it finished successfully.
+    """
+    if item['steps']:
+        return item['steps'][-1] in item['completed']
+    return item['state'] == 'success'
+
+def latest_journal(script):
+    """
+        Path of the most recent journal of a script,
+        None when there is none.
+    """
+    if not JOURNAL_DIR or not os.path.isdir(JOURNAL_DIR):
+        return None
+    paths = sorted(name for name in os.listdir(JOURNAL_DIR) if name.startswith(script + '-') and name.endswith('.jsonl'))
+    if not paths:
+        return None
+    return os.path.join(JOURNAL_DIR, paths[-1])
@@ -0,0 +1,139 @@
+#! /usr/bin/python3
+
+# Capacity-aware placement for create_vm.py.
+# Picks the cluster (and its resource pool) and the datastore for
+# every new VM from the figures in the inventory snapshot, so no
+# extra requests are needed. Capacity that is already promised to
+# VMs earlier in the same batch is tracked, so a large batch is
+# spread over the clusters and datastores instead of piling onto
+# one datastore until it is full. Only clusters whose hosts can
+# reach the network of the VM are considered.
+
+from pyVmomi import vim
+from inventory import all_of, get
+
+# How much each resource counts when comparing candidates
+DISK_WEIGHT = 0.5
+MEMORY_WEIGHT = 0.3
+CPU_WEIGHT = 0.2
+
+def new_placement(snapshot):
+    """
+        Start a placement for one run (or batch).
+        reserved holds what earlier VMs of the
+        batch will use: object -> MB (cluster) or KB (datastore),
+        reserved_cpu: cluster -> MHz.
+    """
+    return {'snapshot': snapshot, 'reserved': {}, 'reserved_cpu': {}}
+
+def datacenter_of(snapshot, obj):
+    """
+        Walk up the parents of an object until the datacenter.
+    """
+    while obj is not None and not isinstance(obj, vim.Datacenter):
+        obj = get(snapshot, obj, 'parent')
+    return obj
+
+def usable_hosts(snapshot, cluster):
+    """
+        Hosts of a cluster that can run VMs right now.
+    """
+    return [host for host in get(snapshot, cluster, 'host', [])
+            if get(snapshot, host, 'runtime.connectionState') == 'connected'
+            and get(snapshot, host, 'runtime.inMaintenanceMode') != True]
+
+def cluster_capacity(state, cluster):
+    """
+        Free memory (MB), free CPU (MHz), the speed of the
+        slowest core (MHz) and the largest number of cores of one host (a VM
+        cannot have more vCPUs than that).
+    """
+    snapshot = state['snapshot']
+    hosts = usable_hosts(snapshot, cluster)
+    effective_memory = get(snapshot, cluster, 'summary.effectiveMemory', 0) # MB
+    used_memory = sum(get(snapshot, host, 'summary.quickStats.overallMemoryUsage', 0) or 0 for host in hosts) # MB
+    effective_cpu = get(snapshot, cluster, 'summary.effectiveCpu', 0) # MHz
+    used_cpu = sum(get(snapshot, host, 'summary.quickStats.overallCpuUsage', 0) or 0 for host in hosts) # MHz
+    cores = max([get(snapshot, host, 'summary.hardware.numCpuCores', 0) for host in hosts] or [0])
+    free_cpu = effective_cpu - used_cpu - state['reserved_cpu'].get(cluster, 0)
+    return {
+        'memory': effective_memory - used_memory - state['reserved'].get(cluster, 0),
+        'memory_total': effective_memory,
+        'cpu': free_cpu,
+        'cpu_total': effective_cpu,
+        'core_mhz': min([get(snapshot, host, 'summary.hardware.cpuMhz', 0) or 0 for host in hosts] or [0]),
+        'cores': cores
+    }
+
+def datastore_capacity(state, datastore):
+    """
+        Free space (KB) of a datastore minus what is
+        already promised, and its total capacity (KB).
+    """
+    snapshot = state['snapshot']
+    free_space = get(snapshot, datastore, 'summary.freeSpace', 0) // 1024 # this converted to KB since it comes as bytes from the API
+    return {
+        'free': free_space - state['reserved'].get(datastore, 0),
+        'total': get(snapshot, datastore, 'summary.capacity', 0) // 1024
+    }
+
+def place(state, CPU, RAM, disk, network=None):
+    """
+        Choose where a VM with CPU vCPUs, RAM MB and
+        disk KB goes. Every cluster/datastore pair that
+        fits is scored on what is left after the VM is
+        placed, the pair with the most room left wins and
+        its capacity is reserved for the rest of the batch.
+        A vCPU counts as one core of the cluster at full
+        speed. With network only clusters that can reach
+        it are used.
+
+        Returns a dictionary with datacenter, vm_folder,
+        cluster, resource_pool and datastore, or None
+        when the VM does not fit anywhere.
+    """
+    snapshot = state['snapshot']
+    best = None
+    for cluster in all_of(snapshot, vim.ClusterComputeResource):
+        if network is not None and network not in get(snapshot, cluster, 'network', []):
+            continue # the hosts of this cluster do not have the port group
+        compute = cluster_capacity(state, cluster)
+        if CPU > compute['cores'] or RAM >= compute['memory'] or CPU * compute['core_mhz'] > compute['cpu']:
+            continue
+        for datastore in get(snapshot, cluster, 'datastore', []):
+            if get(snapshot, datastore, 'summary.accessible') == False:
+                continue
+            storage = datastore_capacity(state, datastore)
+            if disk >= storage['free'] or storage['total'] == 0:
+                continue
+            score = DISK_WEIGHT * (storage['free'] - disk) / float(storage['total']) \
+                  + MEMORY_WEIGHT * (compute['memory'] - RAM) / float(compute['memory_total']) \
+                  + CPU_WEIGHT * (compute['cpu'] - CPU * compute['core_mhz']) / float(compute['cpu_total'])
+            if best is None or score > best[0]:
+                best = (score, cluster, datastore)
+
+    if best is None:
+        return None
+    score, cluster, datastore = best
+    state['reserved'][cluster] = state['reserved'].get(cluster, 0) + RAM
+    state['reserved'][datastore] = state['reserved'].get(datastore, 0) + disk
+    cpu = CPU * cluster_capacity(state, cluster)['core_mhz']
+    state['reserved_cpu'][cluster] = state['reserved_cpu'].get(cluster, 0) + cpu
+    datacenter = datacenter_of(snapshot, cluster)
+    return {
+        'datacenter': datacenter,
+        'vm_folder': get(snapshot, datacenter, 'vmFolder'),
+        'cluster': cluster,
+        'resource_pool': get(snapshot, cluster, 'resourcePool'),
+        'datastore': datastore,
+        'cpu': cpu # MHz reserved, given back by release
+    }
+
+def release(state, target, RAM, disk):
+    """
+        Give back what place reserved for a VM
+        that will not be created after all.
+    """
+    state['reserved'][target['cluster']] -= RAM
+    state['reserved'][target['datastore']] -= disk
+    state['reserved_cpu'][target['cluster']] -= target['cpu']
@@ -0,0 +1,115 @@
+#! /usr/bin/python3
+
+# Pre-flight check of a whole batch before anything is changed.
+#
+# A batch file (JSON or YAML) holds the network for a cluster and the
+# VMs that go with it:
+#
+#   cluster: Cluster1
+#   network: {vswitches: [...], portgroups: [...]}   (see create_vswitch.load_network_spec)
+#   vms: [{name, port_group, cpu, ram, disk, provision, ...}, ...]
+#
+# "network" and "vms" may also be paths to a network specification
+# and to a VM manifest (.csv, .jsonl or .yaml). Everything is checked
+# against one inventory snapshot and one read of the host networks:
+# names used twice in the batch or already taken, port groups, uplink
+# NICs on every host, VLAN and MTU ranges and whether all VMs fit in
+# the CPU, memory and disk that is left. Every problem is reported at
+# once; the exit code is 1 when there is any.
+#
+# Usage: python3 preflight.py <batch.json|.yaml>
+
+import sys
+import json
+from pyVmomi import vim
+from connection import connect_or_exit
+from events import setup_events
+from inventory_cache import cached_inventory
+from inventory import find
+from create_vm import load_manifest, validate_batch
+from create_vswitch import check_hosts, host_network_systems, network_spec_errors, print_errors
+
+def read_file(path):
+    """
+        Read a JSON or YAML file.
+    """
+    if path.endswith('.yaml') or path.endswith('.yml'):
+        try:
+            import yaml # only needed for YAML batches
+        except ImportError:
+            raise NameError('PyYAML is required to read YAML batches (pip install pyyaml).')
+        with open(path) as f:
+            return yaml.safe_load(f) or {}
+    with open(path) as f:
+        return json.load(f)
+
+def load_batch(path):
+    """
+        Read a batch file, network and vms given as
+        paths are read from their own files.
+
+        Returns a dictionary: {'cluster', 'network', 'vms'}
+    """
+    batch = read_file(path)
+    network = batch.get('network')
+    if isinstance(network, str):
+        network = read_file(network)
+    vms = batch.get('vms') or []
+    if isinstance(vms, str):
+        vms = load_manifest(vms)
+    return {'cluster': batch.get('cluster'), 'network': network, 'vms': vms}
+
+def check_batch(connection, snapshot, batch):
+    """
+        Check the network and the VMs of a batch. The
+        VMs may use port groups the network of the
+        batch creates.
+
+        Returns a list of (subject, error), empty when
+        the whole batch can be applied.
+    """
+    errors = []
+    planned = []
+    if batch['network']:
+        spec, spec_errors = network_spec_errors(batch['network'])
+        errors.extend(('network spec', err) for err in spec_errors)
+        planned = [portgroup['name'] for portgroup in spec['portgroups']]
+        cluster = find(snapshot, vim.ClusterComputeResource, batch['cluster'] or '')
+        if cluster is None:
+            errors.append(('network spec', 'cluster "{}" does not exist'.format(batch['cluster'])))
+        else:
+            host_errors, networks = check_hosts(connection, snapshot, host_network_systems(snapshot, cluster), spec)
+            errors.extend(host_errors)
+
+    valid, vm_errors = validate_batch(snapshot, batch['vms'], connection, planned_networks=planned)
+    errors.extend(vm_errors)
+    return errors
+
+def main():
+    """
+        Check a batch file and print every problem.
+    """
+    setup_events() # with the events on stdout the output below goes to stderr
+    if len(sys.argv) < 2:
+        print('Missing parameter - Usage:\n python3 preflight.py <batch.json|.yaml>')
+        sys.exit()
+    try:
+        batch = load_batch(sys.argv[1])
+    except (NameError, OSError, ValueError) as err:
+        print(err)
+        sys.exit()
+
+    connection = connect_or_exit()
+
+    snapshot = cached_inventory(connection) # one request (or only the changes since the last run) for every check
+    network = batch['network'] or {}
+    print('\nChecking {} VM(s), {} vSwitch(es) and {} port group(s)...'.format(len(batch['vms']), len(network.get('vswitches', [])),
+                                                                              len(network.get('portgroups', []))))
+    errors = check_batch(connection, snapshot, batch)
+    if errors:
+        print_errors(errors)
+        sys.exit(1)
+    print('\nNo problems found.')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+#! /usr/bin/python3
+
+# Round-trip profiling for the scripts.
+# Every managed object call in pyVmomi goes through the stub adapter
+# of its connection: InvokeMethod for methods, InvokeAccessor for
+# properties (vm.name, datastore.summary, ...). instrument() wraps
+# both on a stub and records for every call the method or property,
+# the managed object type, the latency, the payload size and the
+# function in these scripts that made the call (the helper modules
+# like inventory.py and tasks.py are skipped). This shows where a
+# lazy property read turns into one request per object.
+#
+# Turned on with the VMWARE_SCRIPTS_PROFILE environment variable,
+# connection.py then instruments every connection it creates:
+#   VMWARE_SCRIPTS_PROFILE=/tmp/run python3 create_vm.py ...
+# At exit a summary table is printed, the full trace is written to
+# /tmp/run.json and the call stacks to /tmp/run.folded (the folded
+# format of flamegraph.pl and speedscope, weighted in microseconds).
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from pyVmomi import SoapAdapter, VmomiSupport
+
+PROFILE = os.environ.get('VMWARE_SCRIPTS_PROFILE', '')
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__)) # frames from files in here are "our" code
+HELPERS = ['connection', 'inventory', 'inventory_cache', 'tasks', 'profiling'] # shared modules, their calls are charged to the function using them
+
+calls = [] # one dictionary per call, see record()
+lock = threading.Lock()
+local = threading.local() # depth, so a property read that is sent as a method call is only counted once
+
+def payload_size(value, info, version):
+    """
+        Size in bytes of a value as SOAP XML, None
+        when it cannot be serialized (e.g. the fake
+        stub uses a version pyVmomi does not know).
+    """
+    try:
+        return len(SoapAdapter.Serialize(value, info=info, version=version))
+    except Exception:
+        return None
+
+def request_size(info, args, version):
+    """
+        Size of the arguments of a method call.
+    """
+    sizes = [payload_size(arg, param, version) for param, arg in zip(info.params, args)]
+    if None in sizes:
+        return None
+    return sum(sizes)
+
+def response_size(result, result_type, version):
+    """
+        Size of the value returned by a call.
+    """
+    info = VmomiSupport.Object(name='returnval', type=result_type, version=version, flags=VmomiSupport.F_OPTIONAL)
+    return payload_size(result, info, version)
+
+def call_stack():
+    """
+        The functions of these scripts on the stack, outermost
+        first, e.g. ['create_vm.main', 'create_vm.create_vm'].
+        Frames of pyVmomi, threading and this module are left out.
+    """
+    stack = []
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename) # "<frozen runpy>" and the like end up in the working directory
+        if frame.f_code.co_filename.startswith('<') == False and os.path.dirname(filename) == SCRIPT_DIR and filename != os.path.abspath(__file__):
+            stack.append('{}.{}'.format(os.path.splitext(os.path.basename(filename))[0], frame.f_code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def caller_of(stack):
+    """
+        The innermost function of a stack that is not in
+        one of the HELPERS, e.g. 'create_vm.template_details'
+        rather than 'inventory.retrieve_properties' it
+        called. The innermost frame when all are helpers.
+    """
+    for function in reversed(stack):
+        if function.split('.')[0] not in HELPERS:
+            return function
+    return stack[-1] if stack else '<unknown>'
+
+def record(kind, mo, name, seconds, sent, received, stack, error):
+    """
+        Add one call to the trace.
+    """
+    with lock:
+        calls.append({
+            'kind': kind, # method or property
+            'type': mo._wsdlName,
+            'moid': mo._moId,
+            'name': name,
+            'call': '{}.{}'.format(mo._wsdlName, name),
+            'seconds': seconds,
+            'sent': sent, # bytes, None when unknown
+            'received': received,
+            'caller': caller_of(stack),
+            'stack': stack,
+            'error': error,
+            'thread': threading.current_thread().name
+        })
+
+def wrap(stub, kind, invoke):
+    """
+        Wrap InvokeMethod or InvokeAccessor of a stub.
+    """
+    def profiled(mo, info, *args):
+        local.depth = getattr(local, 'depth', 0) + 1
+        start = time.time()
+        result = None
+        error = None
+        try:
+            result = invoke(mo, info, *args)
+            return result
+        except Exception as err:
+            error = type(err).__name__
+            raise
+        finally:
+            seconds = time.time() - start
+            local.depth -= 1
+            if local.depth == 0: # only the outer call, SoapStubAdapter sends a property read through InvokeMethod as well
+                version = stub.version
+                if kind == 'method':
+                    name = info.wsdlName
+                    sent = request_size(info, args[0], version)
+                    received = response_size(result, info.result, version) if error is None else None
+                else:
+                    name = info.name
+                    sent = payload_size(name, VmomiSupport.Object(name='prop', type=str, version=version, flags=0), version) # sent as Fetch(prop)
+                    received = response_size(result, info.type, version) if error is None else None
+                record(kind, mo, name, seconds, sent, received, call_stack(), error)
+    return profiled
+
+def instrument(connection):
+    """
+        Record every call made through the stub of
+        a connection. Objects returned by the connection
+        share its stub, so they are recorded as well.
+    """
+    stub = connection._stub
+    if getattr(stub, '_profiled', False) == True:
+        return connection
+    stub.InvokeMethod = wrap(stub, 'method', stub.InvokeMethod)
+    stub.InvokeAccessor = wrap(stub, 'property', stub.InvokeAccessor)
+    stub._profiled = True
+    return connection
+
+def summary(trace):
+    """
+        Group a trace per call and per calling function.
+        Returns a list of rows, most expensive first.
+    """
+    rows = {}
+    for call in trace:
+        row = rows.setdefault((call['call'], call['caller']), {'call': call['call'], 'caller': call['caller'],
+                                                                 'count': 0, 'seconds': 0.0, 'bytes': 0})
+        row['count'] += 1
+        row['seconds'] += call['seconds']
+        row['bytes'] += (call['sent'] or 0) + (call['received'] or 0)
+    return sorted(rows.values(), key=lambda row: (-row['seconds'], -row['count']))
+
+def folded(trace):
+    """
+        Call stacks in the folded flamegraph format:
+        "create_vm.main;create_vm.create_vm;Folder.CreateVM_Task 1234"
+        with the time in microseconds.
+    """
+    stacks = {}
+    for call in trace:
+        key = ';'.join(call['stack'] + [call['call']])
+        stacks[key] = stacks.get(key, 0) + int(call['seconds'] * 1000000)
+    return ['{} {}'.format(key, value) for key, value in sorted(stacks.items())]
+
+def print_summary(trace):
+    """
+        Print the summary table.
+    """
+    rows = summary(trace)
+    print('\nRound-trips: {} calls, {:.2f}s'.format(len(trace), sum(call['seconds'] for call in trace)))
+    print(' Call'.ljust(45) + 'Caller'.ljust(35) + 'Count'.ljust(8) + 'Seconds'.ljust(10) + 'KB')
+    for row in rows:
+        print(' {}'.format(row['call']).ljust(45, '.') + '{}'.format(row['caller']).ljust(35, '.') +
+              '{}'.format(row['count']).ljust(8, '.') + '{:.3f}'.format(row['seconds']).ljust(10, '.') +
+              '{:.1f}'.format(row['bytes'] / 1024.0))
+
+def report(path=PROFILE):
+    """
+        Print the summary and write the JSON trace
+        and the folded stacks next to path.
+    """
+    with lock:
+        trace = list(calls)
+    print_summary(trace)
+    with open(path + '.json', 'w') as f:
+        json.dump(trace, f, indent=2)
+    with open(path + '.folded', 'w') as f:
+        f.write('\n'.join(folded(trace)) + '\n')
+    print('Trace written to {0}.json, flamegraph stacks to {0}.folded'.format(path))
+
+if PROFILE:
+    atexit.register(report)
@@ -0,0 +1,269 @@
+#! /usr/bin/python3
+
+# Shared task tracking for create_vm.py and create_vswitch.py.
+# Instead of sleeping and hoping a task is done, the tasks are
+# watched through a PropertyCollector: vCenter tells us when
+# something changes, so there is no polling and no idle time.
+#
+# For batches start_monitor() starts one PropertyCollector that
+# watches every task in flight from a single thread; wait_for_tasks
+# then only adds a filter for its tasks (removed again when they are
+# done) instead of creating and destroying a collector of its own.
+# Every start_monitor() needs its own stop_monitor(), the monitor
+# keeps running until the last user stopped it, so a rollout inside
+# a batch does not stop the monitor of the batch. Task progress and
+# completion are reported as events (see events.py).
+
+import time
+import threading
+from pyVmomi import vim, vmodl
+from events import emit
+from connection import service, rebind
+
+TASK_PROPERTIES = ['info.state', 'info.result', 'info.error', 'info.queueTime', 'info.completeTime', 'info.progress']
+
+MONITOR_WAIT = 60 # seconds vCenter may hold a WaitForUpdatesEx of the monitor
+
+monitor = None # the running task monitor, see start_monitor
+monitor_lock = threading.Lock() # start_monitor and stop_monitor may be called from several threads
+
+def task_duration(info):
+    """
+        Seconds between the moment vCenter queued
+        the task and the moment it completed.
+        Returns None if the times are not known yet.
+    """
+    if info.get('info.queueTime') and info.get('info.completeTime'):
+        return (info['info.completeTime'] - info['info.queueTime']).total_seconds()
+    return None
+
+def apply_changes(task, info, changes, name):
+    """
+        Store the changed task properties and report them.
+        Returns the result of the task once it is finished
+        ({'state', 'result', 'error', 'seconds'}), else None.
+    """
+    progress = info.get('info.progress')
+    for change in changes:
+        info[change.name] = change.val
+    state = info.get('info.state')
+    if state in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+        error = info.get('info.error')
+        result = {
+            'state': state,
+            'result': info.get('info.result'),
+            'error': error.msg if error is not None else None,
+            'seconds': task_duration(info)
+        }
+        emit('task_completed', name=name, task=task._moId, state=state, error=result['error'], seconds=result['seconds'])
+        return result
+    if info.get('info.progress') is not None and info.get('info.progress') != progress:
+        emit('task_progress', name=name, task=task._moId, percent=info['info.progress'])
+    return None
+
+def task_filter(tasks):
+    """
+        FilterSpec for the TASK_PROPERTIES of a list of tasks.
+    """
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec()
+    filter_spec.objectSet = [vmodl.query.PropertyCollector.ObjectSpec(obj=task) for task in tasks]
+    filter_spec.propSet = [vmodl.query.PropertyCollector.PropertySpec(type=vim.Task, pathSet=TASK_PROPERTIES)]
+    return filter_spec
+
+def timed_out(timeout):
+    """
+        Result of a task that did not finish in time.
+    """
+    return {'state': 'timeout', 'result': None, 'error': 'task did not finish within {} seconds'.format(timeout), 'seconds': None}
+
+def wait_for_tasks(connection, tasks, timeout=None, names=None, steps=None):
+    """
+        Wait for a list of vim.Task objects to finish.
+        names (task -> name) labels the task events, steps
+        (task -> step, e.g. 'create') tells which step of
+        an item a task is (see journal.py).
+
+        A private PropertyCollector is created so that
+        several threads can wait for their own tasks at
+        the same time without stealing each others updates.
+        WaitForUpdatesEx blocks on the vCenter side until a
+        task changes, the loop only wakes up when there is
+        something to look at. When the task monitor runs,
+        it does the waiting instead.
+
+        Returns a dictionary: task -> {'state', 'result', 'error', 'seconds'}
+        state is 'success', 'error' or 'timeout'.
+    """
+    results = {}
+    if not tasks:
+        return results
+    names = names or {}
+    steps = steps or {}
+    for task in tasks:
+        emit('task_submitted', name=names.get(task), task=task._moId, step=steps.get(task))
+    if monitor is not None:
+        return wait_with_monitor(monitor, connection, tasks, timeout, names)
+
+    collector = service(connection, 'propertyCollector').CreatePropertyCollector()
+    try:
+        collector.CreateFilter(task_filter(tasks), True)
+
+        info = dict((task, {}) for task in tasks)
+        pending = set(tasks)
+        started = time.time()
+        version = ''
+        while pending:
+            wait_seconds = 60 # let vCenter hold the request for a while, but wake up to check the timeout
+            if timeout is not None:
+                wait_seconds = max(1, min(wait_seconds, int(timeout - (time.time() - started))))
+            update = collector.WaitForUpdatesEx(version, vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=wait_seconds))
+            if update is None: # nothing changed within maxWaitSeconds
+                if timeout is not None and time.time() - started >= timeout:
+                    break
+                continue
+            version = update.version
+
+            for filter_update in update.filterSet:
+                for obj_update in filter_update.objectSet:
+                    task = obj_update.obj
+                    result = apply_changes(task, info[task], obj_update.changeSet, names.get(task))
+                    if task in pending and result is not None:
+                        pending.discard(task)
+                        results[task] = result
+
+        for task in pending: # whatever is left did not finish in time
+            results[task] = timed_out(timeout)
+    finally:
+        collector.DestroyPropertyCollector() # also removes the filter
+    return results
+
+def wait_for_task(connection, task, timeout=None, name=None, step=None):
+    """
+        Wait for a single task, see wait_for_tasks.
+    """
+    return wait_for_tasks(connection, [task], timeout, {task: name}, {task: step})[task]
+
+def start_monitor(connection):
+    """
+        Start watching tasks with one PropertyCollector
+        and one thread for the whole process. Every
+        wait_for_tasks after this goes through it.
+        When the monitor already runs, the caller is
+        counted as one more user of it.
+    """
+    global monitor
+    with monitor_lock:
+        if monitor is not None:
+            monitor['users'] += 1
+            return monitor
+        state = {
+            'collector': service(connection, 'propertyCollector').CreatePropertyCollector(),
+            'tasks': {}, # task -> {'info', 'name', 'done' (threading.Event), 'result'}
+            'lock': threading.Lock(),
+            'users': 1, # start_monitor calls without their stop_monitor yet
+            'stopping': False,
+            'error': None
+        }
+        state['thread'] = threading.Thread(target=monitor_updates, args=(state,), name='task-monitor')
+        state['thread'].daemon = True
+        state['thread'].start()
+        monitor = state
+        return state
+
+def monitor_updates(state):
+    """
+        Thread of the task monitor: hand the updates
+        of all watched tasks to their waiters.
+    """
+    version = ''
+    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=MONITOR_WAIT)
+    while state['stopping'] == False:
+        try:
+            update = state['collector'].WaitForUpdatesEx(version, options)
+        except Exception as err: # cancelled by stop_monitor, or the session is gone
+            if state['stopping'] == False:
+                with state['lock']:
+                    state['error'] = err
+                    for entry in state['tasks'].values():
+                        entry['done'].set() # wake up every waiter, they report the error
+            return
+        if update is None:
+            continue
+        version = update.version
+        for filter_update in update.filterSet:
+            for obj_update in filter_update.objectSet:
+                with state['lock']:
+                    entry = state['tasks'].get(obj_update.obj)
+                if entry is None or entry['result'] is not None:
+                    continue
+                result = apply_changes(obj_update.obj, entry['info'], obj_update.changeSet, entry['name'])
+                if result is not None:
+                    entry['result'] = result
+                    entry['done'].set()
+
+def wait_with_monitor(state, connection, tasks, timeout, names):
+    """
+        wait_for_tasks through the task monitor: one
+        CreateFilter for the tasks, then wait until the
+        monitor thread has seen all of them finish. The
+        filter is destroyed afterwards, so finished tasks
+        are no longer reported to the monitor.
+    """
+    entries = {}
+    with state['lock']:
+        for task in tasks:
+            entries[task] = state['tasks'][task] = {'info': {}, 'name': names.get(task), 'done': threading.Event(), 'result': None}
+        if state['error'] is not None: # the monitor thread is gone, nobody would wake us up
+            for entry in entries.values():
+                entry['done'].set()
+    prop_filter = None
+    try:
+        if state['error'] is None:
+            prop_filter = rebind(state['collector'], connection).CreateFilter(task_filter(tasks), True)
+
+        results = {}
+        started = time.time()
+        for task in tasks:
+            remaining = None if timeout is None else max(0, timeout - (time.time() - started))
+            entries[task]['done'].wait(remaining)
+            if entries[task]['result'] is not None:
+                results[task] = entries[task]['result']
+            elif state['error'] is not None:
+                results[task] = {'state': 'error', 'result': None, 'error': 'task monitor failed: {}'.format(state['error']), 'seconds': None}
+            else:
+                results[task] = timed_out(timeout)
+        return results
+    finally:
+        with state['lock']:
+            for task in tasks:
+                state['tasks'].pop(task, None)
+        if prop_filter is not None:
+            try:
+                prop_filter.DestroyPropertyFilter()
+            except vmodl.MethodFault: # the collector (and its filters) is already gone
+                pass
+
+def stop_monitor():
+    """
+        Stop using the task monitor. The last user
+        stops it and removes its collector.
+    """
+    global monitor
+    with monitor_lock:
+        state = monitor
+        if state is None:
+            return
+        state['users'] -= 1
+        if state['users'] > 0: # someone else still waits through it
+            return
+        monitor = None
+    state['stopping'] = True
+    try:
+        state['collector'].CancelWaitForUpdates() # wakes up the thread
+    except Exception: # the wait already ended
+        pass
+    state['thread'].join(MONITOR_WAIT)
+    try:
+        state['collector'].DestroyPropertyCollector() # also removes the filters
+    except Exception: # session is gone, so is the collector
+        pass
@@ -0,0 +1,316 @@
+#! /usr/bin/python3
+
+# Teardown for what create_vm.py and create_vswitch.py created.
+#
+# VMs are selected by name pattern, folder or manifest. Their power
+# state is read for all of them with one request, then powered-on
+# VMs are powered off and all VMs destroyed, fan_out at a time, with
+# one PropertyCollector wait per wave of tasks. Templates are never
+# touched.
+#
+# vSwitches (with all their port groups) or everything in a network
+# specification are removed from every host of a cluster in parallel,
+# with one UpdateNetworkConfig call per host.
+#
+# Without --yes only the list of what would be removed is shown.
+
+import sys
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim, vmodl
+from connection import connect_or_exit, create_pool, close_pool, borrow, rebind
+from tasks import wait_for_tasks, start_monitor, stop_monitor
+from inventory_cache import cached_inventory
+from inventory import all_of, find, get, retrieve_properties
+from create_vm import load_manifest
+from create_vswitch import host_network_systems, load_network_spec, parse_fan_out, print_host_results, run_hosts
+from events import emit, start_progress, stop_progress, setup_events
+
+def in_folder(snapshot, obj, folder):
+    """
+        True when obj is somewhere below folder.
+    """
+    parent = get(snapshot, obj, 'parent')
+    while parent is not None:
+        if parent == folder:
+            return True
+        parent = get(snapshot, parent, 'parent')
+    return False
+
+def select_vms(snapshot, pattern=None, folder=None, names=None):
+    """
+        VMs whose name matches a shell-style pattern
+        ("ci-*"), that are below a folder, or whose name
+        is in a list (e.g. from a manifest).
+    """
+    selected = []
+    for vm in all_of(snapshot, vim.VirtualMachine):
+        name = get(snapshot, vm, 'name')
+        if pattern is not None and fnmatch.fnmatchcase(name, pattern):
+            selected.append(vm)
+        elif folder is not None and in_folder(snapshot, vm, folder):
+            selected.append(vm)
+        elif names is not None and name in names:
+            selected.append(vm)
+    return selected
+
+def vm_states(connection, vms):
+    """
+        Power state and template flag of all selected
+        VMs, read with one request.
+    """
+    return retrieve_properties(connection, vms, vim.VirtualMachine, ['runtime.powerState', 'config.template'])
+
+def run_wave(pool, objects, start, names=None):
+    """
+        Start a task for every object at the same time
+        (start(connection, obj) returns the task) and wait
+        for all of them with one PropertyCollector.
+        names (object -> name) labels the task events.
+
+        Returns a dictionary: object -> result of tasks.wait_for_tasks,
+        or {'state': 'error', 'error': ...} when the task
+        could not be started.
+    """
+    results = {}
+
+    def worker(obj):
+        with borrow(pool) as own:
+            try:
+                return (obj, start(own, rebind(obj, own)))
+            except vmodl.MethodFault as err:
+                return (obj, err)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(objects))) as executor:
+        started = list(executor.map(worker, objects))
+    tasks = {}
+    for obj, task in started:
+        if isinstance(task, vmodl.MethodFault):
+            results[obj] = {'state': 'error', 'result': None, 'error': task.msg or type(task).__name__, 'seconds': None}
+        else:
+            tasks[task] = obj
+    if tasks:
+        with borrow(pool) as own:
+            for task, result in wait_for_tasks(own, list(tasks.keys()), names=dict((task, (names or {}).get(obj)) for task, obj in tasks.items())).items():
+                results[tasks[task]] = result # managed objects compare on their id, whatever connection they are bound to
+    return results
+
+def teardown_vms(connection, snapshot, vms, states, fan_out=8):
+    """
+        Power off (when needed) and destroy VMs, fan_out
+        VMs per wave. A VM that fails to power off is
+        not destroyed, a failing VM does not stop the rest.
+
+        Returns a list of (name, status) tuples.
+    """
+    pool = create_pool(connection, fan_out) # same session, one HTTP connection per worker
+    names = dict((vm, get(snapshot, vm, 'name')) for vm in vms)
+    results = []
+    start_monitor(connection)
+    start_progress('Removing VMs', len(vms))
+    try:
+        for first in range(0, len(vms), fan_out):
+            wave = vms[first:first + fan_out]
+            running = [vm for vm in wave if states.get(vm, {}).get('runtime.powerState') != vim.VirtualMachine.PowerState.poweredOff]
+            powered_off = run_wave(pool, running, lambda own, vm: vm.PowerOffVM_Task(), names)
+            failed = dict((vm, result['error']) for vm, result in powered_off.items() if result['state'] != 'success')
+
+            destroyed = run_wave(pool, [vm for vm in wave if vm not in failed], lambda own, vm: vm.Destroy_Task(), names)
+            for vm in wave:
+                if vm in failed:
+                    status = 'failed to power off: {}'.format(failed[vm])
+                elif destroyed[vm]['state'] != 'success':
+                    status = 'failed to destroy: {}'.format(destroyed[vm]['error'])
+                else:
+                    status = 'destroyed'
+                emit('item_completed', name=names[vm], state='success' if status == 'destroyed' else 'error', status=status)
+                results.append((names[vm], status))
+    finally:
+        stop_progress()
+        stop_monitor()
+        close_pool(pool)
+    return results
+
+def removal_config(network_info, switch_names, port_group_names):
+    """
+        HostNetworkConfig that removes the given port
+        groups, every port group on the given vSwitches and
+        the vSwitches themselves, as far as the host has them.
+
+        Returns (HostNetworkConfig or None, list of changes as text).
+    """
+    config = vim.host.NetworkConfig(vswitch=[], portgroup=[])
+    changes = []
+    for portgroup in network_info.portgroup or []:
+        if portgroup.spec.name in port_group_names or portgroup.spec.vswitchName in switch_names:
+            config.portgroup.append(vim.host.PortGroup.Config(changeOperation='remove', spec=portgroup.spec))
+            changes.append('remove port group {}'.format(portgroup.spec.name))
+    for vswitch in network_info.vswitch or []:
+        if vswitch.name in switch_names:
+            config.vswitch.append(vim.host.VirtualSwitch.Config(changeOperation='remove', name=vswitch.name))
+            changes.append('remove vSwitch {}'.format(vswitch.name))
+    if not changes:
+        return None, changes
+    return config, changes
+
+def plan_removal(connection, network_systems, switch_names, port_group_names):
+    """
+        What has to be removed on every host, the network
+        of all hosts is read with one request.
+
+        Returns a list of (host name, network system,
+        HostNetworkConfig or None, list of changes as text).
+    """
+    current = retrieve_properties(connection, [network_system for host_name, network_system in network_systems],
+                                  vim.host.NetworkSystem, ['networkInfo.vswitch', 'networkInfo.portgroup'])
+    plan = []
+    for host_name, network_system in network_systems:
+        props = current.get(network_system, {})
+        network_info = vim.host.NetworkInfo(vswitch=props.get('networkInfo.vswitch', []),
+                                            portgroup=props.get('networkInfo.portgroup', []))
+        config, changes = removal_config(network_info, switch_names, port_group_names)
+        plan.append((host_name, network_system, config, changes))
+    return plan
+
+def remove_network(connection, plan, fan_out=8):
+    """
+        Apply a plan from plan_removal on all hosts at the
+        same time, one UpdateNetworkConfig call per host.
+        A port group that is still used by a VM makes the
+        call fail and the host is left as it was.
+
+        Returns a list of (host name, status) tuples.
+    """
+    pool = create_pool(connection, fan_out) # same session, one HTTP connection per worker
+
+    def worker(entry):
+        host_name, network_system, config, changes = entry
+        if config is None:
+            return (host_name, 'nothing to remove')
+        with borrow(pool) as own:
+            try:
+                rebind(network_system, own).UpdateNetworkConfig(config=config, changeMode='modify')
+                return (host_name, 'removed: {}'.format('; '.join(changes)))
+            except Exception as err: # one failing host should not stop the others
+                return (host_name, 'failed: {}'.format(getattr(err, 'msg', None) or err))
+
+    try:
+        return run_hosts(worker, plan, fan_out, 'Removing host networks', lambda status: status.startswith('failed') == False)
+    finally:
+        close_pool(pool)
+
+def print_results(title, results):
+    """
+        Print a result table and a summary line.
+    """
+    print('\n{}:'.format(title))
+    for name, status in results:
+        print(' {}'.format(name).ljust(30, '.') + '{}'.format(status))
+    failed = [name for name, status in results if status.startswith('failed')]
+    print('\n{} done, {} failed.'.format(len(results) - len(failed), len(failed)))
+
+def vms_main(connection, fan_out, confirmed):
+    """
+        Remove VMs selected by --vms <pattern>,
+        --folder <name> or --manifest <file>.
+    """
+    try:
+        if len(sys.argv) < 3:
+            raise IndexError
+        snapshot = cached_inventory(connection) # one request (or only the changes since the last run) to find the VMs
+        if sys.argv[1] == '--vms':
+            vms = select_vms(snapshot, pattern=sys.argv[2])
+        elif sys.argv[1] == '--folder':
+            folder = find(snapshot, vim.Folder, sys.argv[2])
+            if folder is None:
+                raise NameError('Folder "{}" does not exist.'.format(sys.argv[2]))
+            vms = select_vms(snapshot, folder=folder)
+        else:
+            vms = select_vms(snapshot, names=set(str(spec.get('name', '')).strip() for spec in load_manifest(sys.argv[2])))
+    except IndexError as err:
+        print('Missing parameter(s) - Usage:\n python3 teardown.py --vms <name pattern>|--folder <folder>|--manifest <manifest> <OPTIONAL: --fan-out=N> <OPTIONAL: --yes>')
+        sys.exit()
+    except (NameError, OSError, ValueError) as err:
+        print(err)
+        sys.exit()
+
+    states = vm_states(connection, vms)
+    templates = [vm for vm in vms if states.get(vm, {}).get('config.template') == True]
+    vms = [vm for vm in vms if vm not in templates]
+    print('\nSelected {} VM(s):'.format(len(vms)))
+    for vm in vms:
+        print(' {}'.format(get(snapshot, vm, 'name')).ljust(30, '.') + '{}'.format(states.get(vm, {}).get('runtime.powerState')))
+    for vm in templates:
+        print(' {}'.format(get(snapshot, vm, 'name')).ljust(30, '.') + 'template, skipped')
+    if confirmed == False or not vms:
+        print('\nNothing was removed, add --yes to remove the VM(s) above.' if vms else '\nNothing to remove.')
+        return
+
+    print('\nRemoving {} VM(s), {} at a time...'.format(len(vms), fan_out))
+    print_results('VM results', teardown_vms(connection, snapshot, vms, states, fan_out))
+
+def network_main(connection, fan_out, confirmed):
+    """
+        Remove vSwitches (--network <cluster> <vSwitch> ...)
+        or everything in a network specification
+        (--spec <file> <cluster>) from every host of a cluster.
+    """
+    try:
+        if len(sys.argv) < 4:
+            raise IndexError
+        if sys.argv[1] == '--spec':
+            spec = load_network_spec(sys.argv[2])
+            cluster_name = sys.argv[3]
+            switch_names = set(vswitch['name'] for vswitch in spec['vswitches'])
+            port_group_names = set(portgroup['name'] for portgroup in spec['portgroups'])
+        else:
+            cluster_name = sys.argv[2]
+            switch_names = set(sys.argv[3:])
+            port_group_names = set()
+        snapshot = cached_inventory(connection)
+        cluster = find(snapshot, vim.ClusterComputeResource, cluster_name)
+        if cluster is None:
+            raise NameError('Argument error: cluster "{}" does not exist.'.format(cluster_name))
+    except IndexError as err:
+        print('Missing parameter(s) - Usage:\n python3 teardown.py --network <cluster> <vSwitch> [<vSwitch> ...]|--spec <network.json|.yaml> <cluster> <OPTIONAL: --fan-out=N> <OPTIONAL: --yes>')
+        sys.exit()
+    except (NameError, OSError, ValueError, TypeError) as err:
+        print(err)
+        sys.exit()
+
+    plan = plan_removal(connection, host_network_systems(snapshot, cluster), switch_names, port_group_names)
+    print('\nPlan:')
+    for host_name, network_system, config, changes in plan:
+        print(' {}'.format(host_name).ljust(30, '.') + ('; '.join(changes) or 'nothing to remove'))
+    if confirmed == False:
+        print('\nNothing was removed, add --yes to apply the plan above.')
+        return
+    results = remove_network(connection, plan, fan_out)
+    print_host_results(results)
+    print('\n{} host(s) changed, {} failed.'.format(len([status for host_name, status in results if status.startswith('removed')]),
+                                                    len([status for host_name, status in results if status.startswith('failed')])))
+
+def main():
+    setup_events() # with the events on stdout the output below goes to stderr
+    connection = connect_or_exit()
+
+    try:
+        fan_out = parse_fan_out() # optional flag --fan-out=N: VMs or hosts handled at the same time
+    except NameError as err:
+        print(err)
+        sys.exit()
+    confirmed = '--yes' in sys.argv # optional flag: really remove, without it only the selection is shown
+    if confirmed == True:
+        sys.argv.remove('--yes')
+
+    if len(sys.argv) > 1 and sys.argv[1] in ('--vms', '--folder', '--manifest'):
+        vms_main(connection, fan_out, confirmed)
+    elif len(sys.argv) > 1 and sys.argv[1] in ('--network', '--spec'):
+        network_main(connection, fan_out, confirmed)
+    else:
+        print('Usage:\n python3 teardown.py --vms <name pattern>|--folder <folder>|--manifest <manifest> <OPTIONAL: --fan-out=N> <OPTIONAL: --yes>'
+              '\n python3 teardown.py --network <cluster> <vSwitch> [<vSwitch> ...]|--spec <network.json|.yaml> <cluster> <OPTIONAL: --fan-out=N> <OPTIONAL: --yes>')
+        sys.exit()
+
+if __name__ == "__main__":
+    main()
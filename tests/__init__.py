@@ -0,0 +1,48 @@
+# Tests for the scripts, run against the fake vCenter (fake_vcenter.py):
+#
+#   python -m pytest tests      or      python -m unittest discover tests
+#
+# Session reuse, the inventory cache and the journal are turned off
+# before the modules are imported, a test that needs the journal
+# points journal.JOURNAL_DIR at a directory of its own.
+
+import os
+import sys
+
+os.environ['VMWARE_SCRIPTS_SESSION'] = ''
+os.environ['VMWARE_SCRIPTS_CACHE'] = ''
+os.environ['VMWARE_SCRIPTS_JOURNAL'] = ''
+os.environ['VMWARE_SCRIPTS_EVENTS'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import io
+import contextlib
+import connection
+import fake_vcenter
+
+def fake_connection(endpoint='fake://?task_seconds=0.01'):
+    """
+        A connection to a new fake vCenter.
+        Returns (connection, fake).
+    """
+    connection.HOST = endpoint
+    si = fake_vcenter.connect(endpoint)
+    return si, fake_vcenter.INSTANCES[-1]
+
+def run_main(function, argv, *args):
+    """
+        Run a main-style function with sys.argv set to argv,
+        returns what it printed. sys.exit() ends it quietly.
+    """
+    saved = sys.argv
+    sys.argv = ['script'] + list(argv)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            try:
+                function(*args)
+            except SystemExit:
+                pass
+    finally:
+        sys.argv = saved
+    return output.getvalue()
@@ -0,0 +1,102 @@
+import io
+import os
+import ssl
+import json
+import shutil
+import tempfile
+import unittest
+import contextlib
+from tests import fake_connection, run_main
+from pyVmomi import vim, SoapStubAdapter
+from inventory import take_inventory, find
+import connection
+
+class SessionTest(unittest.TestCase):
+    """
+        Saving and reusing the session of a fake vCenter.
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.si, self.fake = fake_connection()
+        for name, value in (('SESSION_FILE', os.path.join(directory, 'sessions', 'session.json')), ('USER', 'admin')):
+            self.addCleanup(setattr, connection, name, getattr(connection, name))
+            setattr(connection, name, value)
+
+    def test_session_file_is_private(self):
+        connection.save_session(self.si, True)
+        self.assertEqual(os.stat(connection.SESSION_FILE).st_mode & 0o777, 0o600)
+        with open(connection.SESSION_FILE) as f:
+            saved = json.load(f)
+        self.assertEqual((saved['host'], saved['user'], saved['cookie']), (connection.HOST, 'admin', self.fake.cookie))
+
+    def test_saved_session_is_reused(self):
+        connection.save_session(self.si, False)
+        reused = connection.load_session()
+        self.assertEqual(reused[0], 2) # the certificate was not valid
+        self.assertIs(reused[1]._stub, self.fake)
+        self.assertEqual(self.fake.calls['SessionManager.Login'], 0)
+
+    def test_session_of_another_user(self):
+        connection.save_session(self.si, True)
+        connection.USER = 'someone-else'
+        self.assertIsNone(connection.load_session())
+
+    def test_logged_out_session(self):
+        connection.save_session(self.si, True)
+        self.si.content.sessionManager.Logout()
+        self.assertIsNone(connection.load_session())
+
+    def test_unreadable_session_file(self):
+        connection.save_session(self.si, True)
+        with open(connection.SESSION_FILE, 'w') as f:
+            f.write('{"host": ')
+        self.assertIsNone(connection.load_session())
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, connection, 'HOST', connection.HOST)
+
+    def test_workers_share_the_session(self):
+        connection.HOST = 'vcenter.example.com' # the stubs are only built, nothing is sent
+        stub = SoapStubAdapter(host=connection.HOST, version='vim.version.version8', sslContext=connection.unverified_context())
+        stub.cookie = 'vmware_soap_session="abc"'
+        si = vim.ServiceInstance('ServiceInstance', stub)
+        pool = connection.create_pool(si, 3)
+        workers = list(pool.queue)
+        self.assertEqual(len(set(id(worker._stub) for worker in workers + [si])), 4) # an HTTP connection each
+        self.assertEqual([worker._stub.cookie for worker in workers], [stub.cookie] * 3)
+        self.assertEqual([worker._stub.schemeArgs['context'].verify_mode for worker in workers], [ssl.CERT_NONE] * 3)
+        connection.close_pool(pool)
+        self.assertTrue(pool.empty())
+
+    def test_borrowed_connection_and_rebind(self):
+        si, fake = fake_connection()
+        vm = find(take_inventory(si), vim.VirtualMachine, 'vm0001')
+        pool = connection.create_pool(si, 2)
+        with connection.borrow(pool) as own:
+            self.assertEqual(pool.qsize(), 1)
+            moved = connection.rebind(vm, own)
+            self.assertEqual((type(moved), moved._moId), (type(vm), vm._moId))
+            self.assertIs(moved._stub, own._stub)
+            self.assertEqual(moved.name, 'vm0001')
+        self.assertEqual(pool.qsize(), 2)
+
+class ConnectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, connection, 'HOST', connection.HOST)
+
+    def test_connected(self):
+        connection.HOST = 'fake://?vms=2'
+        self.assertEqual(run_main(connection.connect_or_exit, []), 'Attempting to connect...\nSuccess\n')
+
+    def test_no_host(self):
+        connection.HOST = ''
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertRaises(SystemExit, connection.connect_or_exit)
+        self.assertIn('VMWARE_HOST is not set', output.getvalue())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import io
+import unittest
+import contextlib
+from tests import fake_connection
+from pyVmomi import vim
+from inventory import take_inventory, find
+from create_vm import validate_batch, provision_vm, add_disk_to_vm
+from tasks import wait_for_task
+
+GB = 1024 * 1024 # KB
+
+def vm(name, cpu='1', ram='1', disk='10', port_group='VM Network', **extra):
+    """
+        One row of a manifest, as load_manifest reads it.
+    """
+    spec = {'name': name, 'port_group': port_group, 'cpu': cpu, 'ram': ram, 'disk': disk, 'provision': 'thin'}
+    spec.update(extra)
+    return spec
+
+class ValidateBatchTest(unittest.TestCase):
+    """
+        validate_batch against one cluster of four hosts
+        with 24 cores of 2400 MHz each.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+
+    def validate(self, specs, **options):
+        valid, errors = validate_batch(self.snapshot, specs, self.si, **options)
+        return [spec['name'] for spec in valid], errors
+
+    def test_valid_batch(self):
+        valid, errors = self.validate([vm('v1'), vm('v2', disk='10,5')])
+        self.assertEqual(valid, ['v1', 'v2'])
+        self.assertEqual(errors, [])
+
+    def test_duplicate_after_an_invalid_copy(self):
+        # the first copy fails on its port group, the second is still a duplicate
+        valid, errors = self.validate([vm('d1', port_group='nope'), vm('d1')])
+        self.assertEqual(valid, [])
+        self.assertIn(('d1', 'port group "nope" does not exist'), errors)
+        self.assertIn(('d1', 'VM name "d1" is used more than once in the manifest'), errors)
+
+    def test_existing_vm(self):
+        valid, errors = self.validate([vm('vm0001')])
+        self.assertEqual(errors, [('vm0001', 'VM with the name "vm0001" already exists')])
+
+    def test_cpu_of_the_batch_adds_up(self):
+        # 3 x 24 vCPUs x 2400 MHz fit in what is left of the cluster, the fourth does not
+        valid, errors = self.validate([vm('c{}'.format(i), cpu='24') for i in range(1, 5)])
+        self.assertEqual(valid, ['c1', 'c2', 'c3'])
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][0], 'c4')
+        self.assertIn('enough CPU', errors[0][1])
+
+    def test_invalid_vm_gives_its_room_back(self):
+        # c2 fits but fails on its provision, c4 gets the room it would have taken
+        specs = [vm('c{}'.format(i), cpu='24') for i in range(1, 5)]
+        specs[1]['provision'] = 'lazy'
+        valid, errors = self.validate(specs)
+        self.assertEqual(valid, ['c1', 'c3', 'c4'])
+        self.assertEqual(errors, [('c2', 'provision can only be "thin" or "thick"')])
+
+    def test_linked_clone_cannot_grow(self):
+        # the template has one 16 GB disk
+        valid, errors = self.validate([vm('l1', disk='20'), vm('l2', disk='16,4'), vm('l3', disk='')],
+                                      template='template-ubuntu', linked=True)
+        self.assertEqual(valid, ['l2', 'l3'])
+        self.assertEqual(errors, [('l1', 'the disk of a linked clone cannot be grown, use a full clone')])
+
+    def test_full_clone_can_grow(self):
+        valid, errors = self.validate([vm('f1', disk='20')], template='template-ubuntu')
+        self.assertEqual(valid, ['f1'])
+
+    def test_missing_template(self):
+        valid, errors = self.validate([vm('t1', template='template-gone')])
+        self.assertEqual(errors, [('t1', 'template "template-gone" does not exist')])
+
+class CreateVmTest(unittest.TestCase):
+    """
+        VMs created on the fake vCenter, which refuses two
+        devices on the same unit of a controller like vCenter.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+
+    def provision(self, spec, two_step=False, **options):
+        valid, errors = validate_batch(self.snapshot, [spec], self.si, **options)
+        self.assertEqual(errors, [])
+        with contextlib.redirect_stdout(io.StringIO()):
+            return provision_vm(self.si, valid[0], two_step)
+
+    def props(self, name):
+        return [entry['props'] for entry in self.fake.objects.values()
+                if isinstance(entry['mo'], vim.VirtualMachine) and entry['props']['name'] == name][0]
+
+    def disks(self, name):
+        """
+            (controller key, unit, size in GB) of every disk of a VM.
+        """
+        return sorted((dev.controllerKey, dev.unitNumber, dev.capacityInKB // GB) for dev in self.props(name)['config'].hardware.device
+                      if isinstance(dev, vim.vm.device.VirtualDisk))
+
+    def free_space(self):
+        """
+            Free space in GB of every datastore.
+        """
+        return dict((entry['props']['name'], entry['props']['summary'].freeSpace // (1024 * GB)) for entry in self.fake.objects.values()
+                    if isinstance(entry['mo'], vim.Datastore))
+
+    def test_disks_in_one_spec(self):
+        steps = self.provision(vm('t1', disk='10,20,30'))
+        self.assertEqual([step for step, result in steps], ['create'])
+        self.assertEqual([(unit, size) for key, unit, size in self.disks('t1')], [(0, 10), (1, 20), (2, 30)])
+
+    def test_two_step_disks_get_their_own_units(self):
+        steps = self.provision(vm('t2', disk='10,20,30'), two_step=True)
+        self.assertEqual([step for step, result in steps], ['create', 'add disk', 'add disk', 'add disk'])
+        disks = self.disks('t2')
+        self.assertEqual([(unit, size) for key, unit, size in disks], [(0, 10), (1, 20), (2, 30)])
+        self.assertEqual(len(set(key for key, unit, size in disks)), 1)
+
+    def test_add_disk_skips_the_controller_unit(self):
+        target = find(self.snapshot, vim.VirtualMachine, 'vm0002') # one disk on unit 0
+        for i in range(14):
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertEqual(wait_for_task(self.si, add_disk_to_vm(target, GB, 'thin'))['state'], 'success')
+        units = [unit for key, unit, size in self.disks('vm0002')]
+        self.assertEqual(units, [unit for unit in range(16) if unit != 7])
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertRaises(NameError, add_disk_to_vm, target, GB, 'thin')
+
+    def test_full_clone(self):
+        # the template has 2 vCPUs, 2 GB and one 16 GB disk
+        before = self.free_space()
+        steps = self.provision(vm('c1', cpu='4', ram='8', disk='20,5', port_group='VLAN101'), template='template-ubuntu')
+        self.assertEqual([step for step, result in steps], ['clone'])
+        hardware = self.props('c1')['config'].hardware
+        self.assertEqual((hardware.numCPU, hardware.memoryMB), (4, 8192))
+        self.assertEqual([(unit, size) for key, unit, size in self.disks('c1')], [(0, 20), (1, 5)])
+        nics = [dev for dev in hardware.device if isinstance(dev, vim.vm.device.VirtualEthernetCard)]
+        self.assertEqual([nic.backing.deviceName for nic in nics], ['VLAN101'])
+        self.assertEqual(sum(before.values()) - sum(self.free_space().values()), 25)
+
+    def test_linked_clone(self):
+        before = self.free_space()
+        steps = self.provision(vm('l1', disk='16,4'), template='template-ubuntu', linked=True)
+        self.assertEqual([step for step, result in steps], ['clone'])
+        self.assertEqual([(unit, size) for key, unit, size in self.disks('l1')], [(0, 16), (1, 4)])
+        self.assertEqual(sum(before.values()) - sum(self.free_space().values()), 4) # only the new disk, the first one is shared
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import io
+import copy
+import unittest
+import contextlib
+from tests import fake_connection, run_main
+from pyVmomi import vim
+from inventory import take_inventory, find
+from create_vswitch import (teaming_order, network_spec_errors, host_network_errors, network_changes,
+                            host_network_systems, reconcile, plan_dvs, apply_dvs)
+from create_vm import validate_batch, provision_vm
+
+def order(active, standby=()):
+    return vim.host.NetworkPolicy.NicOrderPolicy(activeNic=list(active), standbyNic=list(standby))
+
+def network_spec(vswitches, portgroups=()):
+    spec, errors = network_spec_errors({'vswitches': list(vswitches), 'portgroups': list(portgroups)})
+    assert errors == [], errors
+    return spec
+
+class TeamingOrderTest(unittest.TestCase):
+
+    def test_remaining_nics_keep_their_place(self):
+        nic_order = teaming_order(order(['vmnic0', 'vmnic1'], ['vmnic2']), ['vmnic2', 'vmnic1', 'vmnic3'])
+        self.assertEqual(list(nic_order.activeNic), ['vmnic1', 'vmnic3'])
+        self.assertEqual(list(nic_order.standbyNic), ['vmnic2'])
+
+    def test_standby_nic_takes_over(self):
+        nic_order = teaming_order(order(['vmnic0'], ['vmnic1', 'vmnic2']), ['vmnic1', 'vmnic2'])
+        self.assertEqual(list(nic_order.activeNic), ['vmnic1'])
+        self.assertEqual(list(nic_order.standbyNic), ['vmnic2'])
+
+    def test_no_order_yet(self):
+        nic_order = teaming_order(None, ['vmnic1'])
+        self.assertEqual(list(nic_order.activeNic), ['vmnic1'])
+
+class HostNetworkTest(unittest.TestCase):
+    """
+        Plans and checks against the hosts of the fake vCenter,
+        every host has vmnic0-3 and vSwitch0 with vmnic0.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        snapshot = take_inventory(self.si)
+        self.network_systems = host_network_systems(snapshot, find(snapshot, vim.ClusterComputeResource, 'Cluster1'))
+        self.network_system = self.network_systems[0][1]
+
+    def network_info(self):
+        return copy.deepcopy(self.fake.network_info(self.network_system))
+
+    def test_uplink_change_rebuilds_the_order(self):
+        spec = network_spec([{'name': 'vSwitch0', 'uplinks': ['vmnic1', 'vmnic2']}])
+        config, changes = network_changes(self.network_info(), spec)
+        nic_order = config.vswitch[0].spec.policy.nicTeaming.nicOrder
+        self.assertEqual(list(nic_order.activeNic), ['vmnic1', 'vmnic2'])
+        self.assertEqual(list(nic_order.standbyNic), [])
+
+    def test_uplink_change_is_applied(self):
+        # the fake rejects a teaming order that names NICs the vSwitch does not have, like ESXi
+        spec = network_spec([{'name': 'vSwitch0', 'uplinks': ['vmnic1', 'vmnic2']}])
+        output = run_main(reconcile, [], self.si, self.network_systems, spec, 2)
+        self.assertIn('Applied: 4 host(s) updated, 0 failed.', output)
+        vswitch = self.fake.network_info(self.network_system).vswitch[0]
+        self.assertEqual(list(vswitch.spec.bridge.nicDevice), ['vmnic1', 'vmnic2'])
+        self.assertEqual(list(vswitch.spec.policy.nicTeaming.nicOrder.activeNic), ['vmnic1', 'vmnic2'])
+
+    def lock_down(self):
+        """
+            Jumbo frames on vSwitch0 and a port group "Prod"
+            that allows nothing, on every host.
+        """
+        for host_name, network_system in self.network_systems:
+            vswitch = self.fake.network_info(network_system).vswitch[0]
+            vswitch.spec.mtu = vswitch.mtu = 9000
+            vswitch.spec.numPorts = vswitch.numPorts = 1024
+            security = vim.host.NetworkPolicy.SecurityPolicy(allowPromiscuous=False, forgedTransmits=False, macChanges=False)
+            self.fake.add_group(network_system, vim.host.PortGroup.Specification(name='Prod', vswitchName='vSwitch0', vlanId=20,
+                                                                                 policy=vim.host.NetworkPolicy(security=security)))
+
+    def test_values_left_out_are_kept(self):
+        self.lock_down()
+        spec = network_spec([{'name': 'vSwitch0', 'uplinks': ['vmnic1']}], [{'name': 'Prod', 'vswitch': 'vSwitch0'}])
+        config, changes = network_changes(self.network_info(), spec)
+        self.assertEqual(changes, ["edit vSwitch vSwitch0: uplinks ['vmnic0'] -> ['vmnic1']"])
+
+        output = run_main(reconcile, [], self.si, self.network_systems, spec, 2)
+        self.assertIn('Applied: 4 host(s) updated, 0 failed.', output)
+        info = self.fake.network_info(self.network_system)
+        self.assertEqual((info.vswitch[0].spec.mtu, info.vswitch[0].spec.numPorts), (9000, 1024))
+        prod = info.portgroup[0].spec
+        self.assertEqual(prod.vlanId, 20)
+        self.assertEqual((prod.policy.security.allowPromiscuous, prod.policy.security.forgedTransmits), (False, False))
+
+    def test_values_given_are_applied(self):
+        self.lock_down()
+        spec = network_spec([{'name': 'vSwitch0', 'mtu': 1500}],
+                            [{'name': 'Prod', 'vswitch': 'vSwitch0', 'security': {'forged_transmits': True}}])
+        config, changes = network_changes(self.network_info(), spec)
+        self.assertEqual(changes, ['edit vSwitch vSwitch0: MTU 9000 -> 1500', 'edit port group Prod: forgedTransmits False -> True'])
+
+    def test_new_objects_get_the_defaults(self):
+        spec = network_spec([{'name': 'vSwitch1'}], [{'name': 'Test', 'vswitch': 'vSwitch1', 'security': {'allow_promiscuous': False}}])
+        config, changes = network_changes(self.network_info(), spec)
+        self.assertEqual((config.vswitch[0].spec.mtu, config.vswitch[0].spec.numPorts), (1500, 128))
+        pg_spec = config.portgroup[0].spec
+        self.assertEqual(pg_spec.vlanId, 0)
+        self.assertEqual((pg_spec.policy.security.allowPromiscuous, pg_spec.policy.security.forgedTransmits,
+                          pg_spec.policy.security.macChanges), (False, True, False))
+
+    def test_compliant_host_has_no_changes(self):
+        spec = network_spec([{'name': 'vSwitch0', 'uplinks': ['vmnic0']}])
+        self.assertEqual(network_changes(self.network_info(), spec), (None, []))
+
+    def test_removing_the_uplinks_of_a_port_group_in_use(self):
+        info = self.network_info()
+        info.portgroup = [vim.host.PortGroup(key='key-vim.host.PortGroup-VM Network', vswitch='key-vim.host.VirtualSwitch-vSwitch0',
+                                             spec=vim.host.PortGroup.Specification(name='VM Network', vswitchName='vSwitch0', vlanId=0,
+                                                                                   policy=vim.host.NetworkPolicy()),
+                                             port=[vim.host.PortGroup.Port(key='port-1', type='virtualMachine')])]
+        spec = network_spec([{'name': 'vSwitch0', 'uplinks': []}])
+        self.assertEqual(host_network_errors(info, spec),
+                         ['vSwitch vSwitch0 cannot lose its uplinks, port group VM Network is in use'])
+        info.portgroup[0].port = []
+        self.assertEqual(host_network_errors(info, spec), [])
+
+    def test_uplink_of_another_vswitch(self):
+        spec = network_spec([{'name': 'vSwitch1', 'uplinks': ['vmnic0']}])
+        self.assertEqual(host_network_errors(self.network_info(), spec), ['physical NIC vmnic0 is already used by vSwitch0'])
+
+class DistributedSwitchTest(unittest.TestCase):
+    """
+        A distributed switch for the four hosts of Cluster1.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+
+    def plan(self, MTU=9000, VID=10, nic_name='vmnic2'):
+        snapshot = take_inventory(self.si)
+        cluster = find(snapshot, vim.ClusterComputeResource, 'Cluster1')
+        return plan_dvs(self.si, snapshot, cluster, 'DSwitch1', MTU, 64, 'DPG', VID, nic_name)
+
+    def apply(self, plan):
+        results = apply_dvs(self.si, plan)
+        self.assertEqual([status[:2] for step, status in results], ['ok'] * len(results))
+        return [step for step, status in results]
+
+    def test_create(self):
+        plan = self.plan()
+        self.assertEqual(plan['changes'], ['create distributed switch DSwitch1 with 4 host(s)', 'add distributed port group DPG (VLAN 10)'])
+        before = sum(count for call, count in self.fake.calls.items() if call.endswith('_Task'))
+        self.assertEqual(self.apply(plan), ['create switch', 'add port group'])
+        self.assertEqual(sum(count for call, count in self.fake.calls.items() if call.endswith('_Task')) - before, 2) # not one per host
+        self.assertEqual(self.plan()['changes'], [])
+
+    def test_update(self):
+        self.apply(self.plan())
+        plan = self.plan(MTU=1500, VID=20)
+        self.assertEqual(plan['changes'], ['MTU 9000 -> 1500', 'edit distributed port group DPG: VLAN 10 -> 20'])
+        self.assertEqual(self.apply(plan), ['update switch', 'update port group'])
+        self.assertEqual(self.plan(MTU=1500, VID=20)['changes'], [])
+
+    def test_new_uplink(self):
+        self.apply(self.plan())
+        plan = self.plan(nic_name='vmnic3')
+        self.assertEqual(plan['changes'], ['uplink vmnic3 on 4 host(s)'])
+        self.assertEqual(self.apply(plan), ['update switch'])
+
+    def test_vm_on_a_distributed_port_group(self):
+        self.apply(self.plan())
+        snapshot = take_inventory(self.si)
+        valid, errors = validate_batch(snapshot, [{'name': 'd1', 'port_group': 'DPG', 'cpu': '1', 'ram': '1', 'disk': '10'}], self.si)
+        self.assertEqual(errors, [])
+        with contextlib.redirect_stdout(io.StringIO()):
+            vm = provision_vm(self.si, valid[0])[0][1]['result']
+        nic = [dev for dev in self.fake.objects[vm._moId]['props']['config'].hardware.device
+               if isinstance(dev, vim.vm.device.VirtualEthernetCard)][0]
+        port_group = find(snapshot, vim.Network, 'DPG')
+        self.assertEqual(nic.backing.port.portgroupKey, port_group.key)
+        self.assertEqual(nic.backing.port.switchUuid, find(snapshot, vim.DistributedVirtualSwitch, 'DSwitch1').uuid)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_python(code):
+    """
+        Run code in a new interpreter with the events on
+        stdout, returns (stdout, stderr).
+    """
+    env = dict(os.environ, VMWARE_SCRIPTS_EVENTS='-', VMWARE_SCRIPTS_JOURNAL='', VMWARE_SCRIPTS_CACHE='', VMWARE_SCRIPTS_SESSION='')
+    process = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, timeout=60)
+    return process.stdout, process.stderr
+
+class EventsTest(unittest.TestCase):
+
+    def test_import_keeps_stdout(self):
+        # importing a script as a module (a test, another script) must not move its print() output
+        stdout, stderr = run_python('import create_vm, create_vswitch, teardown, preflight, workflows\nprint("hello")')
+        self.assertEqual(stdout, 'hello\n')
+
+    def test_setup_moves_print_to_stderr(self):
+        stdout, stderr = run_python('from events import setup_events, emit\nsetup_events()\nprint("hello")\nemit("validation", name="vm01")')
+        self.assertEqual(stderr, 'hello\n')
+        event = json.loads(stdout)
+        self.assertEqual((event['event'], event['name']), ('validation', 'vm01'))
+        self.assertTrue(event['ts'].endswith('Z'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+from tests import fake_connection
+from pyVmomi import vim, vmodl
+from inventory import PROPERTIES, take_inventory, find, all_of
+from inventory_cache import cached_inventory
+
+class InventoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'inventory.sqlite')
+        self.si, self.fake = fake_connection()
+
+    def alive(self, obj_type):
+        """
+            Objects of a type created for the session (not
+            the fixed ones of the service content).
+        """
+        return len([entry for entry in self.fake.objects.values()
+                    if isinstance(entry['mo'], obj_type) and entry['mo']._moId.startswith('session[')])
+
+    def test_same_snapshot_as_take_inventory(self):
+        cached = cached_inventory(self.si, path=self.path)
+        full = take_inventory(self.si)
+        self.assertEqual(cached['objects'], full['objects'])
+
+    def test_only_changes_are_read_again(self):
+        cached_inventory(self.si, path=self.path)
+        self.fake.add_network('VLAN999')
+        before = self.fake.calls['PropertyCollector.CreatePropertyCollector']
+        snapshot = cached_inventory(self.si, path=self.path)
+        self.assertEqual(self.fake.calls['PropertyCollector.CreatePropertyCollector'], before)
+        self.assertIsNotNone(find(snapshot, vim.Network, 'VLAN999'))
+        self.assertEqual(len(all_of(snapshot, vim.VirtualMachine)), 21)
+
+    def test_full_sync_removes_the_old_collector(self):
+        cached_inventory(self.si, path=self.path)
+        properties = dict(PROPERTIES)
+        properties[vim.VirtualMachine] = ['runtime.powerState'] # a new spec needs a full sync
+        for i in range(3):
+            cached_inventory(self.si, properties if i % 2 == 0 else PROPERTIES, path=self.path)
+        self.assertEqual(self.alive(vmodl.query.PropertyCollector), 1)
+        self.assertEqual(self.alive(vmodl.query.PropertyCollector.Filter), 1)
+        self.assertEqual(self.alive(vim.view.ContainerView), 1)
+
+if __name__ == '__main__':
+    unittest.main()
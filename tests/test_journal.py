@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+import tests # sets the environment before the scripts are imported
+import journal
+from events import emit
+
+class JournalTest(unittest.TestCase):
+    """
+        Journals written through the events, the way the
+        batch loops and tasks.py write them, and read back.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        journal.JOURNAL_DIR = self.directory
+        self.addCleanup(setattr, journal, 'JOURNAL_DIR', '')
+        self.addCleanup(journal.stop_journal)
+
+    def start(self, path=None):
+        return journal.start_journal('test', {'args': ['x']}, {'a': {'cpu': 1}, 'b': {'cpu': 2}, 'host1': {}}, path,
+                                     {'a': ['create', 'disk 1'], 'b': ['create', 'disk 1']})
+
+    def test_turned_off(self):
+        journal.JOURNAL_DIR = ''
+        self.assertIsNone(self.start())
+        self.assertIsNone(journal.latest_journal('test'))
+
+    def test_steps_and_outcomes(self):
+        path = self.start()
+        emit('task_submitted', name='a', task='task-1', step='create')
+        emit('task_completed', name='a', task='task-1', state='success')
+        emit('task_submitted', name='a', task='task-2', step='disk 1')
+        emit('task_completed', name='a', task='task-2', state='success')
+        emit('item_completed', name='a', state='success', status='created')
+        emit('task_submitted', name='b', task='task-3', step='create')
+        emit('task_completed', name='b', task='task-3', state='success')
+        emit('task_submitted', name='b', task='task-4', step='disk 1')
+        emit('item_completed', name='host1', state='success', status='updated')
+        journal.stop_journal()
+
+        state = journal.load_journal(path)
+        self.assertEqual(journal.latest_journal('test'), path)
+        self.assertEqual((state['script'], state['run']), ('test', {'args': ['x']}))
+        self.assertEqual(list(state['items'].keys()), ['a', 'b', 'host1'])
+        a, b, host = state['items']['a'], state['items']['b'], state['items']['host1']
+        self.assertEqual(a['completed'], ['create', 'disk 1'])
+        self.assertTrue(journal.item_done(a))
+        self.assertEqual((b['completed'], b['task'], b['step'], b['state']), (['create'], 'task-4', 'disk 1', None))
+        self.assertFalse(journal.item_done(b))
+        self.assertTrue(journal.item_done(host))
+
+    def test_failed_step(self):
+        path = self.start()
+        emit('task_submitted', name='a', task='task-1', step='create')
+        emit('task_completed', name='a', task='task-1', state='error', error='out of space')
+        journal.stop_journal()
+        a = journal.load_journal(path)['items']['a']
+        self.assertEqual((a['completed'], a['state'], a['error']), ([], 'error', 'out of space'))
+        self.assertFalse(journal.item_done(a))
+
+    def test_resume_starts_the_item_over(self):
+        path = self.start()
+        emit('task_submitted', name='a', task='task-1', step='create')
+        emit('task_completed', name='a', task='task-1', state='error', error='out of space')
+        journal.stop_journal()
+        self.start(path) # the resume continues the same journal
+        emit('task_submitted', name='a', task='task-5', step='create')
+        emit('task_completed', name='a', task='task-5', state='success')
+        emit('task_submitted', name='a', task='task-6', step='disk 1')
+        emit('task_completed', name='a', task='task-6', state='success')
+        journal.stop_journal()
+        a = journal.load_journal(path)['items']['a']
+        self.assertEqual((a['completed'], a['state']), (['create', 'disk 1'], None))
+        self.assertTrue(journal.item_done(a))
+
+    def test_item_without_steps_that_failed(self):
+        path = self.start()
+        emit('item_completed', name='host1', state='error', status='failed: host is not connected')
+        journal.stop_journal()
+        host = journal.load_journal(path)['items']['host1']
+        self.assertEqual(host['error'], 'failed: host is not connected')
+        self.assertFalse(journal.item_done(host))
+
+    def test_half_written_last_line(self):
+        path = self.start()
+        emit('task_submitted', name='a', task='task-1', step='create')
+        journal.stop_journal()
+        with open(path, 'a') as f:
+            f.write('{"record": "step_fini')
+        a = journal.load_journal(path)['items']['a']
+        self.assertEqual((a['task'], a['completed']), ('task-1', []))
+
+    def test_events_of_other_tasks_are_ignored(self):
+        path = self.start()
+        emit('task_submitted', task='task-9') # e.g. a task of preflight.py without an item
+        emit('task_completed', task='task-9', state='success')
+        journal.stop_journal()
+        with open(path) as f:
+            self.assertNotIn('task-9', f.read())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+from tests import fake_connection
+from pyVmomi import vim
+from inventory import take_inventory, find, get
+from placement import new_placement, place, release, cluster_capacity
+
+GB = 1024 * 1024 # KB
+
+class PlacementTest(unittest.TestCase):
+    """
+        Two clusters of four hosts, 24 cores of 2400 MHz
+        per host. Only the hosts of Cluster2 get the
+        port group "Isolated".
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection('fake://?clusters=2&task_seconds=0.01')
+        cluster = [entry['mo'] for entry in self.fake.objects.values()
+                   if isinstance(entry['mo'], vim.ClusterComputeResource) and entry['props']['name'] == 'Cluster2'][0]
+        self.fake.add_network('Isolated', cluster)
+        self.snapshot = take_inventory(self.si)
+        self.cluster1 = find(self.snapshot, vim.ClusterComputeResource, 'Cluster1')
+        self.cluster2 = find(self.snapshot, vim.ClusterComputeResource, 'Cluster2')
+
+    def test_only_clusters_with_the_network(self):
+        state = new_placement(self.snapshot)
+        network = find(self.snapshot, vim.Network, 'Isolated')
+        for i in range(4):
+            target = place(state, 1, 1024, 10 * GB, network)
+            self.assertEqual(target['cluster'], self.cluster2)
+
+    def test_any_cluster_without_a_network(self):
+        state = new_placement(self.snapshot)
+        clusters = set(place(state, 24, 1024, 10 * GB)['cluster'] for i in range(2))
+        self.assertEqual(clusters, set([self.cluster1, self.cluster2]))
+
+    def test_cpu_is_reserved(self):
+        state = new_placement(self.snapshot)
+        free = cluster_capacity(state, self.cluster1)['cpu']
+        self.assertEqual(cluster_capacity(state, self.cluster1)['core_mhz'], 2400)
+        targets = [place(state, 24, 1024, 10 * GB) for i in range(6)] # 3 per cluster
+        self.assertNotIn(None, targets)
+        self.assertEqual([target['cpu'] for target in targets], [24 * 2400] * 6)
+        self.assertEqual(cluster_capacity(state, self.cluster1)['cpu'], free - 3 * 24 * 2400)
+        self.assertIsNone(place(state, 24, 1024, 10 * GB))
+
+    def test_release_gives_cpu_back(self):
+        state = new_placement(self.snapshot)
+        free = cluster_capacity(state, self.cluster1)['cpu']
+        targets = [place(state, 24, 1024, 10 * GB) for i in range(6)]
+        release(state, targets[0], 1024, 10 * GB)
+        self.assertEqual(cluster_capacity(state, targets[0]['cluster'])['cpu'], free - 2 * 24 * 2400)
+        self.assertEqual(place(state, 24, 1024, 10 * GB)['cluster'], targets[0]['cluster'])
+
+    def test_host_in_maintenance_is_not_counted(self):
+        for host in get(self.snapshot, self.cluster1, 'host'):
+            self.snapshot['objects'][host]['runtime.inMaintenanceMode'] = True
+        state = new_placement(self.snapshot)
+        self.assertEqual(cluster_capacity(state, self.cluster1)['cores'], 0)
+        self.assertEqual(place(state, 1, 1024, 10 * GB)['cluster'], self.cluster2)
+
+if __name__ == '__main__':
+    unittest.main()
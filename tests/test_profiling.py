@@ -0,0 +1,39 @@
+import unittest
+from tests import fake_connection
+from pyVmomi import vim
+from inventory import take_inventory, find
+import profiling
+import create_vm
+import tasks
+
+class ProfilingTest(unittest.TestCase):
+    """
+        Calls made through an instrumented fake connection.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+        profiling.instrument(self.si)
+        del profiling.calls[:]
+        self.addCleanup(profiling.calls.__delitem__, slice(None))
+
+    def test_helpers_are_not_the_caller(self):
+        create_vm.template_details(self.si, find(self.snapshot, vim.VirtualMachine, 'template-ubuntu'))
+        call = [call for call in profiling.calls if call['call'] == 'PropertyCollector.RetrievePropertiesEx'][0]
+        self.assertEqual(call['caller'], 'create_vm.template_details')
+        self.assertIn('inventory.retrieve_properties', call['stack']) # the stack itself is complete
+
+    def test_only_helpers_on_the_stack(self):
+        vm = find(self.snapshot, vim.VirtualMachine, 'vm0001')
+        del profiling.calls[:]
+        tasks.wait_for_task(self.si, vm.PowerOffVM_Task())
+        self.assertEqual(set(call['caller'] for call in profiling.calls if call['stack']), set(['tasks.wait_for_tasks']))
+
+    def test_summary_per_caller(self):
+        for i in range(3):
+            create_vm.template_details(self.si, find(self.snapshot, vim.VirtualMachine, 'template-ubuntu'))
+        rows = [row for row in profiling.summary(profiling.calls) if row['call'] == 'PropertyCollector.RetrievePropertiesEx']
+        self.assertEqual([(row['caller'], row['count']) for row in rows], [('create_vm.template_details', 3)])
+
+if __name__ == '__main__':
+    unittest.main()
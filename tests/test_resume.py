@@ -0,0 +1,124 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from tests import fake_connection, run_main
+from pyVmomi import vim
+import journal
+import create_vm
+from inventory import take_inventory, find
+from tasks import wait_for_task
+
+MANIFEST = 'name,port_group,cpu,ram,disk,provision\n' + ''.join('r{},VM Network,1,1,10,thin\n'.format(i) for i in range(1, 5))
+
+def status(output, name):
+    """
+        Status of a VM in the result table of a run.
+    """
+    for line in output.splitlines():
+        if line.startswith(' {}.'.format(name)):
+            return line.split('.', 1)[1].lstrip('.')
+    return None
+
+class ResumeTest(unittest.TestCase):
+    """
+        Interrupted two-step batches (create, then the disk)
+        are simulated by cutting records out of the journal
+        of a finished run.
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        journal.JOURNAL_DIR = self.directory
+        self.addCleanup(setattr, journal, 'JOURNAL_DIR', '')
+        manifest = os.path.join(self.directory, 'manifest.csv')
+        with open(manifest, 'w') as f:
+            f.write(MANIFEST)
+        self.si, self.fake = fake_connection()
+        run_main(create_vm.batch_main, ['--batch', manifest, '2'], self.si, True)
+        self.path = journal.latest_journal('create_vm')
+        with open(self.path) as f:
+            self.records = [json.loads(line) for line in f]
+
+    def rewrite(self, keep):
+        """
+            Keep only the records keep(record) accepts, as if
+            the run stopped before the others were written.
+        """
+        with open(self.path, 'w') as f:
+            for record in self.records:
+                record = keep(record)
+                if record is not None:
+                    f.write(json.dumps(record) + '\n')
+
+    def resume(self):
+        return run_main(create_vm.resume_main, ['--resume', self.path], self.si)
+
+    def test_planned_steps(self):
+        items = journal.load_journal(self.path)['items']
+        self.assertEqual(items['r1']['steps'], ['create', 'disk 1'])
+        self.assertTrue(all(journal.item_done(item) for item in items.values()))
+
+    def test_finished_run_is_not_repeated(self):
+        output = self.resume()
+        for name in ('r1', 'r2', 'r3', 'r4'):
+            self.assertEqual(status(output, name), 'already created')
+
+    def vm_props(self, name):
+        return [entry['props'] for entry in self.fake.objects.values()
+                if isinstance(entry['mo'], vim.VirtualMachine) and entry['props']['name'] == name][0]
+
+    def test_half_built_vm_gets_its_disk(self):
+        # r1 was created, the run stopped before its disk was added
+        hardware = self.vm_props('r1')['config'].hardware
+        hardware.device = [dev for dev in hardware.device if not isinstance(dev, vim.vm.device.VirtualDisk)]
+        self.rewrite(lambda record: None if record.get('name') == 'r1' and record['record'] != 'planned'
+                     and record.get('step') != 'create' else record)
+        output = self.resume()
+        self.assertTrue(status(output, 'r1').startswith('created'))
+        self.assertEqual([dev.unitNumber for dev in self.vm_props('r1')['config'].hardware.device
+                          if isinstance(dev, vim.vm.device.VirtualDisk)], [0])
+        item = journal.load_journal(self.path)['items']['r1']
+        self.assertEqual(item['completed'], ['create', 'disk 1'])
+        self.assertTrue(journal.item_done(item))
+
+    def test_failed_step_is_not_success_because_the_vm_exists(self):
+        def keep(record):
+            if record.get('name') != 'r2':
+                return record
+            if record['record'] == 'step_finished' and record['step'] == 'create':
+                return dict(record, state='error', error='failed for the test')
+            if record['record'] in ('started', 'planned') and record.get('step') in (None, 'create'):
+                return record
+            return None
+        self.rewrite(keep)
+        output = self.resume()
+        self.assertTrue(status(output, 'r2').startswith('incomplete'))
+        self.assertEqual(journal.load_journal(self.path)['items']['r2']['state'], 'error')
+
+    def test_unknown_task_and_missing_vm_is_created_again(self):
+        vm = find(take_inventory(self.si), vim.VirtualMachine, 'r3')
+        self.assertEqual(wait_for_task(self.si, vm.Destroy_Task())['state'], 'success')
+        def keep(record):
+            if record.get('name') != 'r3' or record['record'] == 'planned':
+                return record
+            if record['record'] == 'started' and record['step'] == 'create':
+                return dict(record, task='task-999999') # vCenter no longer knows the task
+            return None
+        self.rewrite(keep)
+        output = self.resume()
+        self.assertTrue(status(output, 'r3').startswith('created'))
+        self.assertIsNotNone(find(take_inventory(self.si), vim.VirtualMachine, 'r3'))
+        self.assertTrue(journal.item_done(journal.load_journal(self.path)['items']['r3']))
+
+    def test_running_task_is_re_attached(self):
+        # the disk task of r4 was submitted, its outcome was not written
+        self.rewrite(lambda record: None if record.get('name') == 'r4' and record['record'] in ('step_finished', 'finished')
+                     and record.get('step') in (None, 'disk 1') else record)
+        output = self.resume()
+        self.assertEqual(status(output, 'r4'), 'created (task re-attached)')
+        self.assertTrue(journal.item_done(journal.load_journal(self.path)['items']['r4']))
+
+if __name__ == '__main__':
+    unittest.main()
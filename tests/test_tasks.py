@@ -0,0 +1,92 @@
+import unittest
+from tests import fake_connection
+from pyVmomi import vim, vmodl
+from inventory import take_inventory, find
+import tasks
+
+class WaitForTasksTest(unittest.TestCase):
+    """
+        wait_for_tasks with a PropertyCollector of its own
+        (no task monitor). vm0001, vm0003, ... are running.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+
+    def power_off(self, name):
+        return find(self.snapshot, vim.VirtualMachine, name).PowerOffVM_Task()
+
+    def test_one_task(self):
+        result = tasks.wait_for_task(self.si, self.power_off('vm0001'), name='vm0001')
+        self.assertEqual(result['state'], 'success')
+        self.assertIsNotNone(result['seconds'])
+
+    def test_failed_task(self):
+        result = tasks.wait_for_task(self.si, self.power_off('vm0002')) # already powered off
+        self.assertEqual((result['state'], result['result']), ('error', None))
+
+    def test_several_tasks_one_collector(self):
+        started = [self.power_off(name) for name in ('vm0001', 'vm0003', 'vm0005')]
+        before = self.fake.calls['PropertyCollector.CreatePropertyCollector']
+        results = tasks.wait_for_tasks(self.si, started)
+        self.assertEqual([results[task]['state'] for task in started], ['success'] * 3)
+        self.assertEqual(self.fake.calls['PropertyCollector.CreatePropertyCollector'], before + 1)
+
+    def test_collector_is_removed(self):
+        tasks.wait_for_task(self.si, self.power_off('vm0001'))
+        self.assertEqual([entry for entry in self.fake.objects.values()
+                          if isinstance(entry['mo'], vmodl.query.PropertyCollector) and entry['mo']._moId.startswith('session[')], [])
+
+class TaskMonitorTest(unittest.TestCase):
+    """
+        wait_for_tasks through the task monitor of start_monitor.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+        self.addCleanup(self.stop_all)
+
+    def stop_all(self):
+        while tasks.monitor is not None:
+            tasks.stop_monitor()
+
+    def power_off(self, name):
+        return find(self.snapshot, vim.VirtualMachine, name).PowerOffVM_Task()
+
+    def filters_of(self, state):
+        return [entry for entry in self.fake.filters.values() if entry['collector'] == state['collector']._moId]
+
+    def test_filters_are_removed(self):
+        state = tasks.start_monitor(self.si)
+        results = tasks.wait_for_tasks(self.si, [self.power_off('vm0001'), self.power_off('vm0003')])
+        self.assertEqual([result['state'] for result in results.values()], ['success', 'success'])
+        self.assertEqual(self.filters_of(state), [])
+        self.assertEqual(state['tasks'], {})
+
+    def test_failed_task(self):
+        tasks.start_monitor(self.si)
+        result = tasks.wait_for_task(self.si, self.power_off('vm0002')) # already powered off
+        self.assertEqual(result['state'], 'error')
+
+    def test_nested_users(self):
+        outer = tasks.start_monitor(self.si)
+        inner = tasks.start_monitor(self.si) # e.g. preflight.py running create_vm inside its own run
+        self.assertIs(inner, outer)
+        tasks.stop_monitor()
+        self.assertIs(tasks.monitor, outer)
+        self.assertEqual(tasks.wait_for_task(self.si, self.power_off('vm0001'))['state'], 'success')
+        tasks.stop_monitor()
+        self.assertIsNone(tasks.monitor)
+        self.assertNotIn(outer['collector']._moId, self.fake.objects)
+        tasks.stop_monitor() # one stop too many does no harm
+
+    def test_monitor_thread_died(self):
+        state = tasks.start_monitor(self.si)
+        state['collector'].CancelWaitForUpdates() # its wait fails, like when the session is gone
+        state['thread'].join(5)
+        result = tasks.wait_for_task(self.si, self.power_off('vm0001'))
+        self.assertEqual(result['state'], 'error')
+        self.assertIn('task monitor failed', result['error'])
+
+if __name__ == '__main__':
+    unittest.main()
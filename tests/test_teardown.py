@@ -0,0 +1,41 @@
+import unittest
+from tests import fake_connection
+from pyVmomi import vim
+from inventory import take_inventory, find, all_of
+from teardown import select_vms, vm_states, teardown_vms
+
+class TeardownTest(unittest.TestCase):
+    """
+        The fake vCenter has vm0001-vm0020, the odd ones
+        (vm0001, vm0003, ...) are running.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection()
+        self.snapshot = take_inventory(self.si)
+
+    def test_select(self):
+        names = lambda vms: sorted(self.snapshot['objects'][vm]['name'] for vm in vms)
+        self.assertEqual(names(select_vms(self.snapshot, pattern='vm000?')), ['vm000{}'.format(i) for i in range(1, 10)])
+        self.assertEqual(names(select_vms(self.snapshot, names=['vm0002', 'nope'])), ['vm0002'])
+        folder = self.snapshot['objects'][find(self.snapshot, vim.Datacenter, 'Datacenter')]['vmFolder']
+        self.assertEqual(len(select_vms(self.snapshot, folder=folder)), 21) # with the template
+
+    def test_running_and_stopped_vms_are_removed(self):
+        vms = select_vms(self.snapshot, pattern='vm000?')
+        results = teardown_vms(self.si, self.snapshot, vms, vm_states(self.si, vms), fan_out=4)
+        self.assertEqual(sorted(results), [('vm000{}'.format(i), 'destroyed') for i in range(1, 10)])
+        left = take_inventory(self.si)
+        self.assertEqual(len(all_of(left, vim.VirtualMachine)), 12)
+        self.assertIsNone(find(left, vim.VirtualMachine, 'vm0001'))
+        self.assertIsNotNone(find(left, vim.VirtualMachine, 'vm0010'))
+
+    def test_vm_already_gone(self):
+        vms = select_vms(self.snapshot, names=['vm0002', 'vm0004'])
+        states = vm_states(self.si, vms)
+        teardown_vms(self.si, self.snapshot, vms[:1], states)
+        results = dict(teardown_vms(self.si, self.snapshot, vms, states))
+        self.assertTrue(results[self.snapshot['objects'][vms[0]]['name']].startswith('failed to destroy'))
+        self.assertEqual(results[self.snapshot['objects'][vms[1]]['name']], 'destroyed')
+
+if __name__ == '__main__':
+    unittest.main()
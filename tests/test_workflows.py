@@ -0,0 +1,84 @@
+import io
+import time
+import asyncio
+import contextlib
+import unittest
+from tests import fake_connection
+from inventory import take_inventory, find
+from pyVmomi import vim
+from create_vswitch import host_network_systems
+import workflows
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_rate_must_be_positive(self):
+        for rate in (0, -1):
+            self.assertRaises(NameError, workflows.new_bucket, rate)
+
+    def test_rate_is_respected(self):
+        bucket = workflows.new_bucket(20, burst=1)
+
+        async def take_all():
+            for i in range(6):
+                await workflows.take(bucket)
+        start = time.monotonic()
+        asyncio.run(take_all())
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 20.0 - 0.01) # the first token was saved up
+
+class WorkflowTest(unittest.TestCase):
+    """
+        Workflows on a fake vCenter that runs one task at
+        a time, the others stay queued.
+    """
+    def setUp(self):
+        self.si, self.fake = fake_connection('fake://?task_seconds=0.3&max_running=1')
+        self.snapshot = take_inventory(self.si)
+        for name, value in (('CHECK_INTERVAL', 0.05), ('BACKOFF_START', 0.05)):
+            self.addCleanup(setattr, workflows, name, getattr(workflows, name))
+            setattr(workflows, name, value)
+
+    def new_workflow(self, **options):
+        workflow = workflows.new_workflow(self.si, workers=2, **options)
+        self.addCleanup(workflows.close_workflow, workflow)
+        return workflow
+
+    def test_wrong_rates_are_rejected(self):
+        self.assertRaises(NameError, workflows.new_workflow, self.si, rate=0)
+        self.assertRaises(NameError, workflows.new_workflow, self.si, host_rate=0)
+
+    def test_waits_while_the_queue_is_full(self):
+        workflow = self.new_workflow(max_queued=2)
+        for name in ('vm0001', 'vm0003', 'vm0005'): # one running, two queued
+            find(self.snapshot, vim.VirtualMachine, name).PowerOffVM_Task()
+        start = time.monotonic()
+        asyncio.run(workflows.wait_for_capacity(workflow))
+        self.assertGreaterEqual(time.monotonic() - start, 0.25) # until the first task finished and the next one runs
+        self.assertEqual(workflow['started'], 1)
+
+    def test_started_operations_count_as_queued(self):
+        workflow = self.new_workflow(max_queued=2)
+
+        async def submit():
+            await workflows.wait_for_capacity(workflow)
+            await workflows.wait_for_capacity(workflow)
+            second = time.monotonic()
+            await workflows.wait_for_capacity(workflow) # two started, vCenter has not shown them yet
+            return time.monotonic() - second
+        self.assertGreaterEqual(asyncio.run(submit()), 0.05)
+        self.assertEqual(workflow['started'], 1) # let through after a new look at the queue
+
+    def test_host_rate_is_respected(self):
+        workflow = self.new_workflow(rate=100, host_rate=5)
+        host_name, network_system = host_network_systems(self.snapshot, find(self.snapshot, vim.ClusterComputeResource, 'Cluster1'))[0]
+
+        async def add_all():
+            return await asyncio.gather(*[workflows.create_port_group_async(workflow, host_name, network_system, 'PG{}'.format(i), 'vSwitch0', i)
+                                          for i in range(8)])
+        start = time.monotonic()
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(add_all())
+        self.assertGreaterEqual(time.monotonic() - start, 3 / 5.0 - 0.01) # 5 saved up, then 5 per second
+        self.assertEqual(len([group for group in self.fake.network_info(network_system).portgroup if group.spec.name.startswith('PG')]), 8)
+
+if __name__ == '__main__':
+    unittest.main()
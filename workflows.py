@@ -0,0 +1,203 @@
+#! /usr/bin/python3
+
+# asyncio front-end for the provisioning operations, for services
+# that want to run many operations at once from one event loop.
+# pyVmomi is blocking, so every operation runs on a bounded pool of
+# worker threads, each with its own ServiceInstance (same session).
+#
+# Before an operation is started it has to pass:
+#   1. vCenter back-pressure: when too many tasks are queued on
+#      vCenter (TaskManager.recentTask in state "queued") new
+#      operations wait, with a growing delay, until the queue drains.
+#   2. a global token bucket (operations per second for the script).
+#   3. a token bucket per host (per ESXi host for network operations,
+#      per cluster for VMs).
+#
+# Example:
+#   workflow = new_workflow(connection, workers=16, rate=10, host_rate=2)
+#   try:
+#       results = await asyncio.gather(*[create_vm_async(workflow, spec) for spec in specs],
+#                                      return_exceptions=True)
+#   finally:
+#       close_workflow(workflow)
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from pyVmomi import vim
+from connection import create_pool, close_pool, borrow, rebind, service
+from inventory import retrieve_properties
+from tasks import wait_for_task
+from create_vm import provision_vm, add_disk_to_vm
+from create_vswitch import create_switch, create_port_group
+
+CHECK_INTERVAL = 5.0 # seconds between two looks at the vCenter task queue
+BACKOFF_START = 1.0 # first wait when vCenter is saturated, doubled every time
+BACKOFF_MAX = 30.0
+
+def new_bucket(rate, burst=None):
+    """
+        Token bucket: rate tokens per second, at most
+        burst tokens saved up (defaults to rate).
+    """
+    if rate <= 0: # take() waits 1 / rate seconds for a token
+        raise NameError('\nRate must be larger than 0, got {}'.format(rate))
+    burst = burst or max(1, rate)
+    return {'rate': float(rate), 'burst': burst, 'tokens': float(burst), 'updated': time.monotonic()}
+
+async def take(bucket):
+    """
+        Wait until the bucket has a token and take it.
+        Only called from the event loop thread, so no
+        lock is needed between the check and the take.
+    """
+    while True:
+        now = time.monotonic()
+        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+        bucket['updated'] = now
+        if bucket['tokens'] >= 1:
+            bucket['tokens'] -= 1
+            return
+        await asyncio.sleep((1 - bucket['tokens']) / bucket['rate'])
+
+def new_workflow(connection, workers=16, rate=10, host_rate=2, max_queued=20):
+    """
+        Create the shared state for a set of operations.
+        workers: operations running at the same time (threads
+            and HTTP connections).
+        rate: operations per second over all hosts.
+        host_rate: operations per second per host or cluster.
+        max_queued: queued vCenter tasks at which new
+            operations wait.
+    """
+    new_bucket(host_rate) # a wrong host_rate fails here, not at the first operation of every host
+    return {
+        'pool': create_pool(connection, workers), # same session, one HTTP connection per worker
+        'executor': ThreadPoolExecutor(max_workers=workers),
+        'rate': new_bucket(rate),
+        'host_rate': host_rate,
+        'hosts': {}, # key -> bucket
+        'max_queued': max_queued,
+        'queued': 0, # queued tasks seen on the last check
+        'started': 0, # operations started since the last check, counted as queued until vCenter shows them
+        'checked': None, # time of the last check
+        'check_lock': None # created on first use, it must belong to the running loop
+    }
+
+def close_workflow(workflow):
+    """
+        Stop the worker threads once the running
+        operations are done and close their connections.
+    """
+    workflow['executor'].shutdown(wait=True)
+    close_pool(workflow['pool'])
+
+async def run_blocking(workflow, function, *args):
+    """
+        Run function(connection, *args) on a worker thread
+        with a connection borrowed from the pool.
+    """
+    def call():
+        with borrow(workflow['pool']) as own:
+            return function(own, *args)
+    return await asyncio.get_running_loop().run_in_executor(workflow['executor'], call)
+
+def queued_tasks(connection):
+    """
+        Number of tasks vCenter has queued but not
+        started, read with one request for all tasks.
+    """
+    recent = service(connection, 'taskManager').recentTask
+    states = retrieve_properties(connection, list(recent or []), vim.Task, ['info.state'])
+    return len([props for props in states.values() if props.get('info.state') == vim.TaskInfo.State.queued])
+
+async def wait_for_capacity(workflow):
+    """
+        Back-pressure: wait while vCenter has max_queued
+        or more tasks in its queue. The queue is looked at
+        every CHECK_INTERVAL seconds, while it is full every
+        BACKOFF_START, 2 * BACKOFF_START, ... seconds.
+        Operations started since the last look count as
+        queued, so a burst cannot overrun the limit between
+        two looks.
+        Operations wait here one after the other, so only
+        one of them polls vCenter.
+    """
+    if workflow['check_lock'] is None:
+        workflow['check_lock'] = asyncio.Lock()
+    async with workflow['check_lock']:
+        delay = BACKOFF_START
+        while True:
+            if workflow['checked'] is None or time.monotonic() - workflow['checked'] >= CHECK_INTERVAL:
+                workflow['queued'] = await run_blocking(workflow, queued_tasks)
+                workflow['checked'] = time.monotonic()
+                workflow['started'] = 0
+            if workflow['queued'] + workflow['started'] < workflow['max_queued']:
+                workflow['started'] += 1
+                return
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, BACKOFF_MAX)
+            workflow['checked'] = None # look again after the wait
+
+async def throttle(workflow, key):
+    """
+        Everything an operation waits for before it
+        starts: back-pressure, global and per-host rate.
+    """
+    await wait_for_capacity(workflow)
+    await take(workflow['rate'])
+    if key not in workflow['hosts']:
+        workflow['hosts'][key] = new_bucket(workflow['host_rate'])
+    await take(workflow['hosts'][key])
+
+async def create_vm_async(workflow, spec, two_step=False):
+    """
+        Create or clone a VM from a spec returned by
+        create_vm.validate_batch. Limited per cluster.
+
+        Returns the steps, see create_vm.create_vm.
+    """
+    await throttle(workflow, spec['placement']['cluster']._moId)
+    return await run_blocking(workflow, provision_vm, spec, two_step)
+
+async def add_disk_async(workflow, vm, disk, provision):
+    """
+        Add a disk of disk KB to an existing VM.
+        Limited per VM (its host is not known without
+        an extra request).
+
+        Returns the tracked result of the task, see tasks.wait_for_task.
+    """
+    await throttle(workflow, vm._moId)
+
+    def add_disk(own):
+        result = wait_for_task(own, add_disk_to_vm(rebind(vm, own), disk, provision))
+        if result['state'] != 'success':
+            raise NameError('Adding disk to VM failed: {}'.format(result['error']))
+        return result
+    return await run_blocking(workflow, add_disk)
+
+async def create_switch_async(workflow, host_name, network_system, switch_name, num_port, MTU, nic_name=None):
+    """
+        Create a vSwitch on one host, see
+        create_vswitch.create_switch. Limited per host.
+    """
+    await throttle(workflow, host_name)
+
+    def add_switch(own):
+        hosts = [(host_name, rebind(network_system, own))]
+        if nic_name is not None:
+            return create_switch(hosts, switch_name, num_port, MTU, nic_name)
+        return create_switch(hosts, switch_name, num_port, MTU)
+    return await run_blocking(workflow, add_switch)
+
+async def create_port_group_async(workflow, host_name, network_system, port_group_name, switch_name, VID):
+    """
+        Create a port group on one host, see
+        create_vswitch.create_port_group. Limited per host.
+    """
+    await throttle(workflow, host_name)
+
+    def add_port_group(own):
+        return create_port_group([(host_name, rebind(network_system, own))], port_group_name, switch_name, VID)
+    return await run_blocking(workflow, add_port_group)